@@ -30,6 +30,7 @@ setup(name='luteus',
    packages=('luteus','luteus.core','luteus.util', 'luteus.bot'),
    scripts=(
       'src/tools/luteus',
+      'src/tools/luteus-logsearch',
    ),
    package_dir={'luteus':'src/luteus'},
    zip_safe=False
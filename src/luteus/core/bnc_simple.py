@@ -15,13 +15,38 @@
 # You should have received a copy of the GNU General Public License
 # along with luteus.  If not, see <http://www.gnu.org/licenses/>.
 
+import calendar
 import os.path
 import logging
+import time
 
 from .event_multiplexing import OrderingEventMultiplexer
 from .s2c_structures import *
 from .irc_num_constants import *
-from .logging import BackLogger, AutoDiscardingBackLogger, BLFormatter, NickLogLine
+from .logging import BackLogger, AutoDiscardingBackLogger, BLFormatter, LogLine, NickLogLine
+
+
+def _format_server_time(ts):
+   """Format unix time as IRCv3 server-time timestamp; this truncates to milliseconds."""
+   ms = int(ts*1000)
+   return '{0}.{1:03}Z'.format(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(ms // 1000)), ms % 1000).encode('ascii')
+
+def _parse_server_time(s):
+   """Parse IRCv3 server-time timestamp into unix time."""
+   s = s.decode('ascii').rstrip('Z')
+   (s, _, frac) = s.partition('.')
+   rv = calendar.timegm(time.strptime(s, '%Y-%m-%dT%H:%M:%S'))
+   if (frac):
+      rv += int(frac[:3].ljust(3, '0'))/1000
+   return rv
+
+
+class _ChatHistoryError(Exception):
+   """Request failure, to be reported to the client as a FAIL CHATHISTORY reply with this code."""
+   def __init__(self, code, *args):
+      super().__init__(code)
+      self.code = code
+      self.args_out = args
 
 
 def _reg_em(em_name, priority=0):
@@ -41,6 +66,13 @@ class SimpleBNC:
    mirror_cmds = set((b'PRIVMSG', b'NOTICE'))
    
    BL_BASEDIR_DEFAULT = os.path.join(b'data', b'backlog')
+   # Maximum number of messages returned for one CHATHISTORY request
+   chathistory_limit = 1000
+   CAP_CHATHISTORY = b'draft/chathistory'
+   CHATHISTORY_SUBCMDS = (b'LATEST', b'BEFORE', b'AFTER', b'AROUND', b'BETWEEN', b'TARGETS')
+   # Commands only sent by the network because we enabled an IRCv3 capability on our uplink, and the capability clients need
+   # to get them.
+   CAP_PUSH_CMDS = {b'AWAY': b'away-notify', b'ACCOUNT': b'account-notify', b'CHGHOST': b'chghost'}
    #EM calling conventions:
    # Input from connected IRC clients.
    #    em_client_in_msg(msg: IRCMessage)
@@ -51,11 +83,21 @@ class SimpleBNC:
    # Dumps of backlog data for specific contexts to a set of ipscs.
    #    em_client_bl_dump(ipscs, bl_contexts: list)
 
-   def __init__(self, network_conn, blf=None, mmlf=None):
+   def __init__(self, network_conn, blf=None, mmlf=None, bl_replay_last=None, bl_replay_since=None):
       self.nc = network_conn
       self.nick = network_conn.get_self_nick()
       self.pcs = network_conn.get_pcs()
       self.ips_conns = set()
+      # Client connections by the channels they want
+      self.chan_ipscs = {}
+      # Prebuilt attach greetings; see _get_greeting()
+      self._greetings = {}
+      self._greetings_pcs = None
+      # Time of the last PRIVMSG/NOTICE seen on each channel
+      self.chan_activity = {}
+      # Deferred attach work per client connection; see _queue_attach()
+      self._attach_pending = {}
+      self._attach_timers = {}
       self.motd = None
       self.bl = None
       if (blf is None):
@@ -66,6 +108,9 @@ class SimpleBNC:
       
       self.blf = blf
       self.mmlf = mmlf
+      # Default limits for backlog replay on attach: max number of lines, and max age in seconds.
+      self.bl_replay_last = bl_replay_last
+      self.bl_replay_since = bl_replay_since
       
       self.em_client_in_msg = OrderingEventMultiplexer(self)
       self.em_client_msg_fwd = OrderingEventMultiplexer(self)
@@ -90,15 +135,48 @@ class SimpleBNC:
          return
       
       for rmsg in query.rv:
-         conn.send_msg(rmsg)
+         rmsg = self._adapt_msg_caps(conn, rmsg)
+         if not (rmsg is None):
+            conn.send_msg(rmsg)
    
    def _process_ipsc_shutdown(self, conn):
       if not (conn in self.ips_conns):
          self.log(40, 'Got bogus shutdown notification for conn {0}.'.format(conn))
       
       self.ips_conns.remove(conn)
+      for chann in conn.wanted_channels:
+         self._process_ipsc_wc_change(conn, chann, False)
+      self._attach_pending.pop(conn, None)
+      timer = self._attach_timers.pop(conn, None)
+      if not (timer is None):
+         timer.cancel()
       conn.mgr = None
    
+   def _process_ipsc_wc_change(self, conn, chann, wanted):
+      if (wanted):
+         try:
+            ipscs = self.chan_ipscs[chann]
+         except KeyError:
+            ipscs = self.chan_ipscs[chann] = set()
+         ipscs.add(conn)
+         return
+      
+      ipscs = self.chan_ipscs.get(chann)
+      if (ipscs is None):
+         return
+      ipscs.discard(conn)
+      if not (ipscs):
+         del(self.chan_ipscs[chann])
+   
+   def _get_chan_ipscs(self, chans):
+      """Return client connections that want any of the specified channels."""
+      if (len(chans) == 1):
+         return self.chan_ipscs.get(chans[0], ())
+      rv = set()
+      for chann in chans:
+         rv.update(self.chan_ipscs.get(chann, ()))
+      return rv
+   
    def _process_potential_nickchange(self, update_peer=True):
       newnick = self.nc.get_self_nick()
       if (newnick is None):
@@ -106,6 +184,7 @@ class SimpleBNC:
       if (self.nick == newnick):
          return
       self.nick = newnick
+      self._greetings.clear()
       for ipsc in self.ips_conns:
          ipsc.change_nick(self.nick, update_peer=update_peer)
    
@@ -145,10 +224,23 @@ class SimpleBNC:
       if (msg_orig.self_nickchange):
          self._process_potential_nickchange(False)
       
-      def chan_filter(chann):
-         return (chann in ipsc.wanted_channels)
-      
       for msg in msg_orig.split_by_target():
+         chans = msg.get_chan_targets()
+         if (chans):
+            if (msg.command in self.mirror_cmds):
+               ts = time.time()
+               for chann in chans:
+                  self.chan_activity[chann] = ts
+            
+            ipscs = self._get_chan_ipscs(chans)
+         else:
+            ipscs = self.ips_conns
+         
+         if not (ipscs):
+            # Nobody to send this to, but backloggers still need to see it.
+            self.em_client_msg_fwd([], msg, False)
+            continue
+         
          if (msg.command == b'ERROR'):
             if (len(msg.parameters) > 0):
                errstr = b' ' + msg.parameters[0]
@@ -167,89 +259,427 @@ class SimpleBNC:
             msg2 = msg
 
          ipscs_out = []
-         for ipsc in self.ips_conns:
-            if (not msg.get_chan_targets()):
-               msg_out = msg2
-            else:
-               msg_out = msg2.copy()
-               target_num = msg_out.filter_chan_targets(chan_filter)
-               if (target_num < 1):
-                  continue
-         
+         for ipsc in ipscs:
+            msg_out = self._adapt_msg_caps(ipsc, msg2)
+            if (msg_out is None):
+               continue
             ipsc.send_msg(msg_out)
             ipscs_out.append(ipsc)
          
          self.em_client_msg_fwd(ipscs_out, msg, False)
    
+   def _adapt_msg_caps(self, conn, msg):
+      """Return msg in a form conn understands given its enabled capabilities, or None if it shouldn't get it at all."""
+      cmd = msg.command
+      caps = conn.caps
+      try:
+         cap = self.CAP_PUSH_CMDS[cmd]
+      except KeyError:
+         pass
+      else:
+         return (msg if (cap in caps) else None)
+      
+      if ((cmd == b'JOIN') and (len(msg.parameters) > 1) and not (b'extended-join' in caps)):
+         rv = msg.copy()
+         del(rv.parameters[1:])
+         return rv
+      
+      if (cmd == b'353'):
+         if (len(msg.parameters) < 4):
+            return msg
+         names = msg.parameters[-1].split()
+         if not (b'userhost-in-names' in caps):
+            names = [n.split(b'!', 1)[0] for n in names]
+         if not (b'multi-prefix' in caps):
+            names = [self._strip_multi_prefix(n) for n in names]
+         rv = msg.copy()
+         rv.parameters[-1] = b' '.join(names)
+         return rv
+      
+      if ((cmd == b'352') and (len(msg.parameters) > 6) and not (b'multi-prefix' in caps)):
+         # WHO reply flags: H or G, optionally *, then channel prefixes.
+         rv = msg.copy()
+         rv.parameters[6] = self._strip_multi_prefix(rv.parameters[6])
+         return rv
+      return msg
+   
+   def _strip_multi_prefix(self, s):
+      """Remove all but the first of a run of channel membership prefixes from s."""
+      flags = self.nc.conn.chm_parser.uflags2modes
+      i = 0
+      while ((i < len(s)) and not (s[i:i+1] in flags)):
+         i += 1
+      j = i + 1
+      while ((j < len(s)) and (s[j:j+1] in flags)):
+         j += 1
+      return s[:i+1] + s[j:]
+   
    @_reg_em('em_out_msg')
    def _process_network_out_msg(self, msg_orig):
       if not (msg_orig.command in self.mirror_cmds):
          return
       
-      def chan_filter(chann):
-         return (chann in ipsc.wanted_channels)
-      
       for msg in msg_orig.split_by_target():
-         msg2 = msg.copy()
-         msg2.src = self
-            
+         (nicks, chans) = msg.get_targets()
+         # Mirrored lines only depend on the client's nick and server name; build each variant once.
+         echo_msgs = {}
+         nick_msgs = {}
+         nick_mll = None
+         
+         if (chans):
+            ipscs = self._get_chan_ipscs(chans)
+            src = msg.src
+            if ((src in self.ips_conns) and (b'echo-message' in src.caps) and not (src in ipscs)):
+               # echo-message clients get their own lines echoed even for channels they don't want.
+               ipscs = list(ipscs) + [src]
+         else:
+            ipscs = self.ips_conns
+         
          aware_clients = []
-         for ipsc in self.ips_conns:
-            msg_out = msg2.copy()
-            msg_out.prefix = ipsc.get_user_ia()
-            
-            if (msg.get_chan_targets()):
-               target_num = msg_out.filter_chan_targets(chan_filter)
-               if (target_num < 1):
-                  continue
-            
+         for ipsc in ipscs:
             aware_clients.append(ipsc)
-            if (msg.src is ipsc):
-               continue
             
-            # TODO:
-            # This is somewhat ugly; BLFs should probably be renamed now that we also use them for message mirror formatting.
-            (nicks, chans) = msg_out.get_targets()
-            if (nicks):
-               for tnick in nicks:
-                  nick_mll = NickLogLine(msg, self.nc.get_self_nick(), True)
-                  nmsgs_out = self.mmlf.format_entry(tnick, ipsc.self_name, nick_mll)
-                  for nmsg in nmsgs_out:
-                     ipsc.send_msg(nmsg)
+            echo = (b'echo-message' in ipsc.caps)
+            if ((msg.src is ipsc) and not echo):
+               continue
             
-            # TODO:
-            # ...and not doing it for chans is a hack, too. Among other things this means we'll still get CTCP reflection in
-            # that case ... it's probably not a huge deal in practice, since channel CTCPs are rather rare.
-            # Forcing backlog-like mirror formatting for channels would be unnecessarily ugly. If we're to do this, BLFs should
-            # get some more config options for nice ts-less formatting first.
-            if (chans):
+            key = (ipsc.nick, ipsc.self_name)
+            if (echo or chans):
+               # Clients with echo-message get the line as sent, from themselves.
+               # TODO:
+               # For others, not doing mirror formatting for chans is a hack. Among other things this means we'll still
+               # get CTCP reflection in that case ... it's probably not a huge deal in practice, since channel CTCPs are
+               # rather rare. Forcing backlog-like mirror formatting for channels would be unnecessarily ugly. If we're to
+               # do this, BLFs should get some more config options for nice ts-less formatting first.
+               try:
+                  msg_out = echo_msgs[key]
+               except KeyError:
+                  msg_out = echo_msgs[key] = msg.copy()
+                  msg_out.src = self
+                  msg_out.prefix = ipsc.get_user_ia()
                ipsc.send_msg(msg_out)
-   
+               if (echo):
+                  continue
+            
+            if (nicks):
+               # TODO:
+               # This is somewhat ugly; BLFs should probably be renamed now that we also use them for message mirror
+               # formatting.
+               try:
+                  nmsgs_out = nick_msgs[key]
+               except KeyError:
+                  if (nick_mll is None):
+                     nick_mll = NickLogLine(msg, self.nc.get_self_nick(), True)
+                  nmsgs_out = nick_msgs[key] = []
+                  for tnick in nicks:
+                     nmsgs_out.extend(self.mmlf.format_entry(tnick, ipsc.self_name, nick_mll))
+               for nmsg in nmsgs_out:
+                  ipsc.send_msg(nmsg)
+         
          self.em_client_msg_fwd(aware_clients, msg, True)
 
-   def replay_backlog(self, conn, context):
+   def _get_replay_window(self, conn):
+      """Return (last, since) backlog replay limits for conn; per-user settings override ours."""
+      last = self.bl_replay_last
+      since = self.bl_replay_since
+      user = conn.luteus_user
+      if not (user is None):
+         if not (user.bl_replay_last is None):
+            last = user.bl_replay_last
+         if not (user.bl_replay_since is None):
+            since = user.bl_replay_since
+      return (last, since)
+   
+   def fetches_history(self, conn):
+     """Return whether conn fetches backlog on demand, instead of getting it pushed."""
+     return (self.CAP_CHATHISTORY in conn.caps)
+   
+   def replay_backlog(self, conn, context, before=None):
      if (self.bl is None):
        return
+     if (self.fetches_history(conn)):
+       return
+     (last, since) = self._get_replay_window(conn)
+     after = None
+     if not (since is None):
+       after = time.time() - since
+     
+     # Clients supporting these get the original messages with their timestamps in tags, instead of reformatted ones.
+     tagged = ((b'batch' in conn.caps) and (b'server-time' in conn.caps) and not (context is None))
      try:
-       msgs = self.blf.format_backlog(self.bl, conn.self_name, context)
+       start = self.bl.get_cursor(conn, context)
+       if (tagged):
+         msgs = self._format_backlog_tagged(conn, context, start=start, after=after, before=before, last=last)
+       else:
+         msgs = self.blf.format_backlog(self.bl, conn.self_name, context, start=start, after=after, before=before,
+           last=last)
      except Exception as exc:
        err_msg = IRCMessage(conn.self_name, b'PRIVMSG', (conn.nick, 'Failed to replay backlog for context {!a} due to internal error: {!a}'.format(context, exc).encode('ascii')), src=self)
        conn.send_msg(err_msg)
        raise
      
-     for msg in msgs:
-       conn.send_msg(msg)
+     if (tagged):
+       if (msgs):
+         self._send_batch(conn, b'chathistory', (context,), msgs)
+     else:
+       for msg in msgs:
+         conn.send_msg(msg)
      
      self.em_client_bl_dump((conn,), (context,))
+   
+   @staticmethod
+   def _is_replayable_verbatim(e):
+      """Return whether backlog entry can be replayed as the original message."""
+      if not (isinstance(e, LogLine) and e.is_msglike()):
+         return False
+      # Replaying CTCP requests as such could make clients answer them.
+      (tf, ctcps) = e.msg.split_ctcp()
+      for ctcp in ctcps:
+         if not (ctcp.startswith(b'ACTION')):
+            return False
+      return True
+   
+   def _format_backlog_tagged(self, conn, context, **kwargs):
+      """Return messages replaying backlog of context to conn with server-time tags; kwargs are passed on to
+         bl.get_bl()."""
+      rv = []
+      for e in self.bl.get_bl(context, **kwargs):
+         if (self._is_replayable_verbatim(e)):
+            rv.append(self._make_history_msg(conn, e, {}))
+            continue
+         
+         # Anything else is formatted as text, as for clients without server-time; the timestamp goes into a tag.
+         ts = _format_server_time(e.ts)
+         for msg in self.mmlf.format_entry(conn.self_name, context, e):
+            text = msg.parameters[-1]
+            if (text.startswith(b' ')):
+               msg.parameters[-1] = text[1:]
+            msg.tags = {b'time': ts}
+            rv.append(msg)
+      return rv
+   
+   # IRCv3 chathistory
+   def _get_history(self, ctx, limit, after=None, before=None, from_end=True):
+      """Return up to limit PRIVMSG/NOTICE backlog records for ctx in the specified time range, in chronological order.
+      
+      If from_end is set, return the most recent matching records; otherwise the oldest ones."""
+      if not (self.bl.has_bl(ctx)):
+         return []
+      
+      # Other records don't count towards the limit, so we may need to fetch more than that.
+      count = limit
+      while (True):
+         if (from_end):
+            recs = self.bl.get_bl(ctx, after=after, before=before, last=count)
+         else:
+            recs = self.bl.get_bl(ctx, after=after, before=before, first=count)
+         rv = [r for r in recs if (isinstance(r, LogLine) and r.is_msglike())]
+         if ((len(rv) >= limit) or (len(recs) < count) or (count >= limit*16)):
+            break
+         count *= 4
+      
+      if (from_end):
+         return rv[-limit:]
+      return rv[:limit]
+   
+   def _make_history_msg(self, conn, r, tags):
+      m = r.msg
+      params = list(m.parameters)
+      if (r.outgoing):
+         prefix = conn.get_user_ia()
+      else:
+         prefix = r.src
+         if (isinstance(r, NickLogLine)):
+            params[0] = conn.nick
+      
+      tags = dict(tags)
+      if (b'server-time' in conn.caps):
+         tags[b'time'] = _format_server_time(r.ts)
+      return IRCMessage(prefix, m.command, params, tags=(tags or None))
+   
+   def _send_batch(self, conn, btype, args, msgs):
+      """Send msgs to conn, wrapped in a batch if it supports those."""
+      if not (b'batch' in conn.caps):
+         for msg in msgs:
+            conn.send_msg(msg)
+         return
+      
+      ref = conn.make_batch_ref()
+      conn.send_msg(IRCMessage(conn.self_name, b'BATCH', (b'+' + ref, btype) + tuple(args)))
+      for msg in msgs:
+         msg.set_tag(b'batch', ref)
+         conn.send_msg(msg)
+      conn.send_msg(IRCMessage(conn.self_name, b'BATCH', (b'-' + ref,)))
+   
+   @staticmethod
+   def _parse_msgref(ref):
+      """Parse CHATHISTORY message reference; returns unix time in milliseconds, or None for '*'."""
+      if (ref == b'*'):
+         return None
+      if (ref.startswith(b'msgid=')):
+         raise _ChatHistoryError(b'INVALID_MSGREFTYPE')
+      if not (ref.startswith(b'timestamp=')):
+         raise _ChatHistoryError(b'INVALID_PARAMS', ref)
+      try:
+         return int(_parse_server_time(ref[10:])*1000)
+      except ValueError:
+         raise _ChatHistoryError(b'INVALID_PARAMS', ref)
+   
+   def _parse_limit(self, s):
+      try:
+         rv = int(s)
+      except ValueError:
+         raise _ChatHistoryError(b'INVALID_PARAMS', s)
+      if (rv < 1):
+         raise _ChatHistoryError(b'INVALID_PARAMS', s)
+      return min(rv, self.chathistory_limit)
+   
+   def _process_chathistory(self, conn, msg):
+      """Answer IRCv3 CHATHISTORY request from our backlog."""
+      cmd = b'CHATHISTORY'
+      p = msg.parameters
+      try:
+         if not (p):
+            raise _ChatHistoryError(b'NEED_MORE_PARAMS')
+         if (self.bl is None):
+            raise _ChatHistoryError(b'MESSAGE_ERROR', p[0], b'No backlog available')
+         sub = p[0].upper()
+         if not (sub in self.CHATHISTORY_SUBCMDS):
+            raise _ChatHistoryError(b'INVALID_PARAMS', p[0])
+         if (sub == b'TARGETS'):
+            if (len(p) < 4):
+               raise _ChatHistoryError(b'NEED_MORE_PARAMS', sub)
+            self._process_chathistory_targets(conn, self._parse_msgref(p[1]), self._parse_msgref(p[2]),
+               self._parse_limit(p[3]))
+            return
+         
+         if (len(p) < 4):
+            raise _ChatHistoryError(b'NEED_MORE_PARAMS', sub)
+         target = p[1]
+         ctx = conn.pcs.make_cib(target)
+         ms = self._parse_msgref(p[2])
+         if (ms is None):
+            if (sub != b'LATEST'):
+               raise _ChatHistoryError(b'INVALID_PARAMS', p[2])
+         else:
+            # Timestamps we send are truncated to milliseconds, so any message within the referenced millisecond
+            # counts as the referenced one.
+            (ts, ts_next) = (ms/1000, (ms+1)/1000)
+         
+         if (sub == b'LATEST'):
+            recs = self._get_history(ctx, self._parse_limit(p[3]), after=(None if (ms is None) else ts_next))
+         elif (sub == b'BEFORE'):
+            recs = self._get_history(ctx, self._parse_limit(p[3]), before=ts)
+         elif (sub == b'AFTER'):
+            recs = self._get_history(ctx, self._parse_limit(p[3]), after=ts_next, from_end=False)
+         elif (sub == b'AROUND'):
+            limit = self._parse_limit(p[3])
+            recs = self._get_history(ctx, limit // 2, before=ts) if (limit > 1) else []
+            recs += self._get_history(ctx, limit - len(recs), after=ts, from_end=False)
+         elif (sub == b'BETWEEN'):
+            if (len(p) < 5):
+               raise _ChatHistoryError(b'NEED_MORE_PARAMS', sub)
+            ms2 = self._parse_msgref(p[3])
+            if (ms2 is None):
+               raise _ChatHistoryError(b'INVALID_PARAMS', p[3])
+            limit = self._parse_limit(p[4])
+            if (ms <= ms2):
+               recs = self._get_history(ctx, limit, after=ts_next, before=ms2/1000, from_end=False)
+            else:
+               recs = self._get_history(ctx, limit, after=(ms2+1)/1000, before=ts)
+      except _ChatHistoryError as exc:
+         conn.send_fail(cmd, exc.code, *(exc.args_out + (b'Invalid CHATHISTORY request',)))
+         return
+      
+      self._send_batch(conn, b'chathistory', (target,), [self._make_history_msg(conn, r, {}) for r in recs])
+   
+   def _process_chathistory_targets(self, conn, ms1, ms2, limit):
+      if ((ms1 is None) or (ms2 is None)):
+         raise _ChatHistoryError(b'INVALID_PARAMS', b'*')
+      (lo, hi) = sorted((ms1, ms2))
+      
+      targets = []
+      for ctx in set(conn.wanted_channels).union(self.bl.get_nick_ctxs()):
+         if ((ctx is None) or (not self.bl.has_bl(ctx))):
+            continue
+         recs = self._get_history(ctx, 1, after=(lo+1)/1000, before=hi/1000)
+         if (recs):
+            targets.append((recs[-1].ts, ctx))
+      targets.sort()
+      if (ms1 > ms2):
+         targets = targets[-limit:]
+      else:
+         targets = targets[:limit]
+      
+      msgs = [IRCMessage(conn.self_name, b'CHATHISTORY', (b'TARGETS', ctx, _format_server_time(ts)))
+         for (ts, ctx) in targets]
+      self._send_batch(conn, b'draft/chathistory-targets', (), msgs)
 
    def _fake_join(self, conn, chnn):
-      chan = self.nc.conn.channels[chnn]
       conn.fake_join(chnn)
+      self._queue_attach(conn, chnn, True)
+   
+   # Progressive attach: clients get JOINs for their channels right away, while the NAMES replies and backlog replay for
+   # channels and query partners are sent one context per event loop iteration, so live traffic and client input don't
+   # wait for all of them. Recently active channels go first, and a context the client uses is served immediately.
+   def _queue_attach(self, conn, ctx, is_chan):
+      try:
+         pending = self._attach_pending[conn]
+      except KeyError:
+         pending = self._attach_pending[conn] = {}
+      # Anything that happens from now on is forwarded to the client live, so we only replay backlog from before.
+      pending[ctx] = (is_chan, len(pending), time.time())
       
-      for msg in chan.make_join_msgs(conn.nick, prefix=conn.self_name):
-         conn.send_msg(msg)
+      if not (conn in self._attach_timers):
+         self._attach_timers[conn] = conn._ed.set_timer(0, self._process_attach_step, parent=conn, interval_relative=False,
+            args=(conn,))
+   
+   def get_attach_pending(self, conn):
+      """Return contexts whose attach data hasn't been sent to conn yet."""
+      return self._attach_pending.get(conn, ())
+   
+   def _get_attach_prio(self, ctx, item):
+      (is_chan, seq, ts) = item
+      return (self.chan_activity.get(ctx, 0), -seq)
+   
+   def _process_attach_step(self, conn):
+      del(self._attach_timers[conn])
+      pending = self._attach_pending.get(conn)
+      if (not pending):
+         return
       
-      self.replay_backlog(conn, chnn)
+      ctx = max(pending, key=lambda c: self._get_attach_prio(c, pending[c]))
+      self._process_attach(conn, ctx)
+      if (pending):
+         self._attach_timers[conn] = conn._ed.set_timer(0, self._process_attach_step, parent=conn, interval_relative=False,
+            args=(conn,))
+      else:
+         del(self._attach_pending[conn])
+   
+   def _process_attach(self, conn, ctx):
+      """Send deferred attach data for ctx to conn now."""
+      (is_chan, seq, ts) = self._attach_pending[conn].pop(ctx)
+      if (is_chan):
+         if not (ctx in conn.wanted_channels):
+            return
+         chan = self.nc.conn.channels.get(ctx)
+         if (chan is None):
+            return
+         for msg in chan.make_join_msgs(conn.nick, prefix=conn.self_name, multi_prefix=(b'multi-prefix' in conn.caps)):
+            conn.send_msg(msg)
+      self.replay_backlog(conn, ctx, before=ts)
+   
+   def _promote_attach(self, conn, msg):
+      """Serve pending attach data for contexts msg from conn refers to before processing it."""
+      pending = self._attach_pending.get(conn)
+      if (not pending):
+         return
+      (nicks, chans) = msg.get_targets()
+      targets = (nicks or []) + (chans or [])
+      if ((msg.command in (b'NAMES', b'WHO')) and msg.parameters):
+         targets.append(self.pcs.make_cib(msg.parameters[0]))
+      for ctx in [c for c in pending if (c in targets)]:
+         self._process_attach(conn, ctx)
    
    def _process_client_msg(self, conn, msg):
       msg.eaten = False
@@ -257,7 +687,13 @@ class SimpleBNC:
       if (msg.eaten):
          return
       
-      if (msg.command in (b'PING',b'QUIT')):
+      if (msg.command in (b'PING', b'QUIT', b'CAP')):
+         return
+      
+      self._promote_attach(conn, msg)
+      
+      if (msg.command == b'CHATHISTORY'):
+         self._process_chathistory(conn, msg)
          return
       
       if (msg.command == b'AWAY'):
@@ -273,6 +709,9 @@ class SimpleBNC:
          conn.send_msg_num(RPL_TRYAGAIN, msg.command, b"Bouncer disconnected; please wait for reconnect.")
          return
       
+      if (self._answer_chan_query(conn, msg)):
+         return
+      
       if (msg.command == b'JOIN'):
          jd = msg.parse_JOIN()
          if (jd != 0):
@@ -292,14 +731,85 @@ class SimpleBNC:
       
       self.nc.conn.put_msg(msg, cb)
    
-   def attach_backlogger(self, basedir=BL_BASEDIR_DEFAULT, filter=None, auto_discard=True):
+   def _answer_chan_query(self, conn, msg):
+      """Answer a NAMES, TOPIC or MODE query about one of our channels from tracked state, if that is complete.
+      
+      Returns whether we did; if not, the query needs to go to the network."""
+      cmd = msg.command
+      params = msg.parameters
+      if (not (cmd in (b'NAMES', b'TOPIC', b'MODE')) or (len(params) < 1) or (b',' in params[0])):
+         return False
+      chan = self.nc.conn.channels.get(self.pcs.make_cib(params[0]))
+      if (chan is None):
+         return False
+      
+      target = conn.nick
+      prefix = conn.self_name
+      if ((cmd == b'NAMES') and (len(params) == 1)):
+         if not (chan.names_known()):
+            return False
+         msgs = chan.make_names_reply(target, prefix, multi_prefix=(b'multi-prefix' in conn.caps))
+      elif ((cmd == b'TOPIC') and (len(params) == 1)):
+         msgs = chan.make_topic_reply(target, prefix)
+      elif ((cmd == b'MODE') and (len(params) == 1)):
+         if not (chan.modes_synced):
+            return False
+         msgs = chan.make_modes_reply(target, prefix)
+      elif ((cmd == b'MODE') and (len(params) == 2)):
+         mode = params[1].lstrip(b'+')
+         if not (mode in chan.lists_synced):
+            return False
+         msgs = chan.make_list_reply(target, mode, prefix)
+      else:
+         return False
+      
+      if (not msgs):
+         return False
+      for msg_out in msgs:
+         conn.send_msg(msg_out)
+      return True
+   
+   # Cached greetings are only dropped wholesale, so don't let them pile up if clients use many different nicks.
+   GREETINGS_MAX = 64
+   def _get_greeting(self, conn):
+      """Return (msgs, data) for the part of the attach greeting after 001, and the raw lines to send for it.
+      
+      This only depends on a few properties of the client connection, so we build it once and reuse it for later clients."""
+      pcs = self.pcs
+      if not (self._greetings_pcs is pcs):
+         self._greetings.clear()
+         self._greetings_pcs = pcs
+      
+      host = conn.get_local_host()
+      chathistory = (self.CAP_CHATHISTORY in conn.caps)
+      key = (pcs.version, conn.nick, conn.self_name, host, conn.ssts, chathistory)
+      try:
+         return self._greetings[key]
+      except KeyError:
+         pass
+      
+      msgs = [conn.make_msg_002(host), conn.make_msg_003(), conn.make_msg_004(host)]
+      msgs.extend(conn.make_msgs_005(pcs))
+      if (chathistory):
+         msgs.append(conn.make_msg_num(5, 'CHATHISTORY={0}'.format(self.chathistory_limit).encode('ascii'),
+            b'MSGREFTYPES=timestamp', b'are supported by this server'))
+      msgs.extend(conn.make_msgs_motd())
+      
+      rv = (msgs, b''.join(msg.line_build() for msg in msgs))
+      if (len(self._greetings) >= self.GREETINGS_MAX):
+         self._greetings.clear()
+      self._greetings[key] = rv
+      return rv
+   
+   def attach_backlogger(self, basedir=BL_BASEDIR_DEFAULT, filter=None, auto_discard=True, writer=None, quota=None,
+         store=None):
       if not (self.bl is None):
          raise Exception('Backlogger attached already.')
       if (auto_discard):
          bl_cls = AutoDiscardingBackLogger
       else:
          bl_cls = BackLogger
-      self.bl = bl_cls(basedir, self, filter=filter)
+      self.bl = bl_cls(basedir, self, filter=filter, writer=writer, quota=quota, store=store)
    
    def take_ips_connection(self, conn):
       if (not conn):
@@ -311,16 +821,20 @@ class SimpleBNC:
       def process_msg(msg):
          self._process_client_msg(conn, msg)
       
+      def process_wc_change(chann, wanted):
+         self._process_ipsc_wc_change(conn, chann, wanted)
+      
       conn.em_shutdown.new_prio_listener(process_shutdown)
       conn.em_in_msg.new_prio_listener(process_msg, priority=-1024)
+      conn.em_wc_change.new_prio_listener(process_wc_change)
       self.ips_conns.add(conn)
+      for chann in conn.wanted_channels:
+         self._process_ipsc_wc_change(conn, chann, True)
       
-      conn.send_msg_001()
-      conn.send_msg_002()
-      conn.send_msg_003()
-      conn.send_msg_004()
-      conn.send_msgs_005(self.pcs)
-      conn.send_msgs_motd()
+      conn.pcs = self.pcs
+      msg_001 = conn.make_msg_001()
+      (msgs, data) = self._get_greeting(conn)
+      conn.send_burst([msg_001] + msgs, msg_001.line_build() + data)
       
       if not (self.nick is None):
          conn.change_nick(self.nick)
@@ -328,5 +842,107 @@ class SimpleBNC:
       if (self.nc.get_self_away()):
          conn.send_msg_306()
 
-      self.replay_backlog(conn, None)
+      if not (self.bl is None):
+         self.bl.register_client(conn)
+         for ctx in self.bl.get_nick_ctxs():
+            self._queue_attach(conn, ctx, False)
    
+
+
+def _bench_mirror_out_msgs(count=2000, client_nums=(1, 5, 20)):
+   """Microbenchmark: CPU per mirrored outgoing message, for legacy and echo-message clients."""
+   class BenchNC:
+      def get_self_nick(self):
+         return b'nick'
+   
+   class BenchClient:
+      def __init__(self, pcs, nick, chan, caps):
+         self.pcs = pcs
+         self.nick = nick
+         self.self_name = b'luteus.bnc'
+         self.caps = caps
+         self.wanted_channels = set((chan,))
+      
+      def get_user_ia(self):
+         return IRCAddress(self.pcs, b''.join((self.nick, b'!luteususer@', self.self_name)))
+      
+      def send_msg(self, msg):
+         msg.line_build()
+   
+   pcs = S2CProtocolCapabilitySet()
+   chan = pcs.make_cib(b'#chan')
+   msgs = [IRCMessage(None, b'PRIVMSG', (chan, b'Some line of text.'), pcs=pcs) for i in range(count)]
+   msgs += [IRCMessage(None, b'PRIVMSG', (b'partner', b'Some line of text.'), pcs=pcs) for i in range(count)]
+   
+   print('===== Outgoing message mirroring benchmark ({0} channel and {0} query messages). ====='.format(count))
+   # Attached clients normally share our nick, so they can share mirrored lines; distinct nicks show the cost without that.
+   for (desc, caps) in (('legacy', set()), ('echo', set((b'echo-message',)))):
+      for (nick_desc, distinct) in (('same nick', False), ('distinct nicks', True)):
+         for client_num in client_nums:
+            bnc = SimpleBNC.__new__(SimpleBNC)
+            bnc.nc = BenchNC()
+            bnc.mmlf = BLFormatter(time_fmt='')
+            bnc.em_client_msg_fwd = OrderingEventMultiplexer(bnc)
+            bnc.ips_conns = set(BenchClient(pcs, (b'nick%d' % i) if distinct else b'nick', chan, caps)
+               for i in range(client_num))
+            bnc.chan_ipscs = {chan: set(bnc.ips_conns)}
+            
+            t0 = time.process_time()
+            for msg in msgs:
+               bnc._process_network_out_msg(msg)
+            t1 = time.process_time()
+            print('{0}, {1}, {2} clients: {3:.1f}us per message.'.format(desc, nick_desc, client_num,
+               (t1-t0)/len(msgs)*1000000))
+
+
+def _main():
+   print('===== Performing BNC selftest. =====')
+   print('==== Executing unwatched channel forwarding test. ====')
+   bnc = SimpleBNC.__new__(SimpleBNC)
+   bnc.ips_conns = set()
+   bnc.chan_ipscs = {}
+   bnc.chan_activity = {}
+   bnc.em_client_msg_fwd = OrderingEventMultiplexer(bnc)
+   fwd = []
+   def process_msg_fwd(ipscs, msg, outgoing):
+      fwd.append((list(ipscs), msg.parameters[0]))
+   bnc.em_client_msg_fwd.new_prio_listener(process_msg_fwd)
+   
+   pcs = S2CProtocolCapabilitySet()
+   for line in (b':a!b@c PRIVMSG #chan :e', b':a!b@c NOTICE #chan,#chan2 :e', b':a!b@c PRIVMSG nick :e'):
+      msg = IRCMessage.build_from_line(line, None, pcs)
+      msg.self_nickchange = False
+      bnc._process_network_bc_msg(msg)
+   if (fwd != [([], b'#chan'), ([], b'#chan'), ([], b'#chan2'), ([], b'nick')]):
+      raise ValueError('Messages without interested clients not passed on to backloggers: {0}'.format(fwd))
+   print('==== Passed. ====')
+   print('==== Executing echo-message test. ====')
+   class TestClient:
+      nick = b'nick'
+      self_name = b'luteus.bnc'
+      wanted_channels = set()
+      def __init__(self, caps):
+         self.caps = caps
+         self.sent = []
+      def get_user_ia(self):
+         return IRCAddress(pcs, b'nick!luteususer@luteus.bnc')
+      def send_msg(self, msg):
+         self.sent.append(msg)
+   
+   (c_echo, c_legacy) = (TestClient(set((b'echo-message',))), TestClient(set()))
+   bnc.ips_conns.update((c_echo, c_legacy))
+   for src in (c_echo, c_legacy):
+      bnc._process_network_out_msg(IRCMessage(None, b'PRIVMSG', (b'#chan', b'e'), src=src, pcs=pcs))
+   if ((len(c_echo.sent) != 1) or c_legacy.sent):
+      raise ValueError('Unexpected echoes to clients not wanting the channel: {0} {1}'.format(c_echo.sent,
+         c_legacy.sent))
+   print('==== Passed. ====')
+   print('===== All done. =====')
+
+
+if (__name__ == '__main__'):
+   import sys
+   if ('--bench' in sys.argv[1:]):
+      _bench_mirror_out_msgs()
+   else:
+      _main()
@@ -28,7 +28,7 @@ from .irc_ui import LuteusIRCUI
 
 class LuteusConfig:
    from .logging import BLFormatter, LogFormatter, LogFilter, RawLogger, \
-      HRLogger
+      HRLogger, SearchLogger, LogWriter, LogRotation, BacklogQuota, SharedBacklogStore, log_file_pool
    
    try:
       from ssl import CERT_OPTIONAL, CERT_REQUIRED, CERT_NONE
@@ -41,6 +41,7 @@ class LuteusConfig:
          sa.add_dnslm()
       self._sa = sa
       self._icncs = []
+      self._bl_stores = {}
       self._config_ns = {}
       
       self.log_formatter_default = self.LogFormatter()
@@ -54,7 +55,8 @@ class LuteusConfig:
       
    def new_network(self, netname, user_spec, servers=[],
          raw_log_dir=b'log/irc_raw', hr_log_dir=b'log/irc',
-         hr_log_formatter=None, *args, **kwargs):
+         hr_log_formatter=None, log_writer=None, search_log_dir=None, log_rotation=None, *args,
+         **kwargs):
       
       if (hr_log_formatter is None):
          hr_log_formatter = self.log_formatter_default
@@ -68,9 +70,12 @@ class LuteusConfig:
       rv.add_target = add_target
       
       if not (raw_log_dir is None):
-         self.RawLogger(basedir=raw_log_dir, nc=rv)
+         self.RawLogger(basedir=raw_log_dir, nc=rv, writer=log_writer, rotation=log_rotation)
       if not (hr_log_dir is None):
-         self.HRLogger(basedir=hr_log_dir, nc=rv, formatter=hr_log_formatter)
+         self.HRLogger(basedir=hr_log_dir, nc=rv, formatter=hr_log_formatter, writer=log_writer,
+            rotation=log_rotation)
+      if not (search_log_dir is None):
+         self.SearchLogger(basedir=search_log_dir, nc=rv, writer=log_writer)
       
       self._icncs.append(rv)
       return rv
@@ -92,6 +97,9 @@ class LuteusConfig:
    def new_ssl_spec(self, *args, **kwargs):
       return SSLSpec(*args, **kwargs)
    
+   def new_log_writer(self, *args, **kwargs):
+      return self.LogWriter(*args, **kwargs)
+   
    def _check_bldir(self, prefix, username, netname):
       key = (prefix, username, netname)
       if (key in self._single_bnc_names):
@@ -104,18 +112,39 @@ class LuteusConfig:
       self._single_bnc_names.add(key)
       return basedir
 
-   def new_bnc(self, nc, *args, attach_ui=True, attach_bl=True, bl_auto_discard=True, bl_basedir=None, filter=None, **kwargs):
+   def _get_bl_store(self, nc, writer=None, quota=None):
+      """Return shared backlog store for network, making it if necessary."""
+      try:
+         return self._bl_stores[nc]
+      except KeyError:
+         pass
+      basedir = self._check_bldir(b'shared', b'', nc.netname)
+      rv = self._bl_stores[nc] = self.SharedBacklogStore(basedir, nc, writer=writer, quota=quota)
+      return rv
+   
+   def _attach_backlogger(self, bnc, basedir, filter, auto_discard, writer, quota, shared):
+      if (shared):
+         # Quota and writer apply to the store, and are taken from the first bnc using it.
+         store = self._get_bl_store(bnc.nc, writer, quota)
+         quota = None
+      else:
+         store = None
+      bnc.attach_backlogger(filter=filter, basedir=basedir, auto_discard=auto_discard, writer=writer, quota=quota,
+         store=store)
+
+   def new_bnc(self, nc, *args, attach_ui=True, attach_bl=True, bl_auto_discard=True, bl_basedir=None, filter=None,
+      bl_writer=None, bl_quota=None, bl_shared=False, **kwargs):
       rv = SimpleBNC(nc, *args, **kwargs)
       if (attach_ui):
          iui = LuteusIRCUI(rv)
       if (attach_bl):
          if (bl_basedir is None):
             bl_basedir = self._check_bldir(b'by_network', b'', nc.netname)
-         rv.attach_backlogger(filter=filter, basedir=bl_basedir, auto_discard=bl_auto_discard)
+         self._attach_backlogger(rv, bl_basedir, filter, bl_auto_discard, bl_writer, bl_quota, bl_shared)
       return rv
 
    def new_single_bnc(self, nc, ah, username, password, *args, attach_ui=True, attach_bl=True, bl_auto_discard=True,
-      filter=None, **kwargs):
+      filter=None, bl_writer=None, bl_quota=None, bl_shared=False, **kwargs):
       rv = SimpleBNC(nc, *args, **kwargs)
       if (attach_ui):
          iui = LuteusIRCUI(rv)
@@ -125,7 +154,7 @@ class LuteusConfig:
          if ((len(username) < 1) or (b'/' in username)):
             raise Exception("Username {0!a} is invalid.".format(username))      
          basedir = self._check_bldir(b'by_user', username, nc.netname)
-         rv.attach_backlogger(filter=filter, basedir=basedir, auto_discard=bl_auto_discard)
+         self._attach_backlogger(rv, basedir, filter, bl_auto_discard, bl_writer, bl_quota, bl_shared)
       user = ah.add_user(username, password)
       user.add_bnc(rv)
       return rv
@@ -22,9 +22,12 @@ from .irc_num_constants import ERR_PASSWDMISMATCH, ERR_NEEDMOREPARAMS
 
 
 class _LuteusUser:
-   def __init__(self, name, password):
+   def __init__(self, name, password, bl_replay_last=None, bl_replay_since=None):
       self.name = name
       self.password = password
+      # Backlog replay limits on attach; None means to use the bnc defaults.
+      self.bl_replay_last = bl_replay_last
+      self.bl_replay_since = bl_replay_since
       self._nets = {}
    
    def add_bnc(self, bnc):
@@ -77,11 +80,15 @@ class NetUserAssocHandler:
       
       arg = msg.parameters[0]
       try:
-         (netname, username, pw) = arg.split(b':',2)
+         (netname, client_id, pw) = arg.split(b':',2)
       except ValueError:
-         conn.send_msg_num(ERR_PASSWDMISMATCH, cmd, b'Invalid pass string; I want <netname>:<user>:<password>.')
+         conn.send_msg_num(ERR_PASSWDMISMATCH, cmd, b'Invalid pass string; I want <netname>:<user>[@<client>]:<password>.')
          return
       
+      # Clients can optionally identify themselves (e.g. one per device) by appending '@<client>' to the username, to get
+      # separate backlog delivery tracking.
+      username = client_id.split(b'@',1)[0]
+      
       try:
          user = self.users[username]
       except KeyError:
@@ -99,6 +106,8 @@ class NetUserAssocHandler:
          return
       
       conn.__conn_mgr = conn_mgr
+      conn.client_id = client_id
+      conn.luteus_user = user
 
    def check_conn(self, conn):
       if not (conn.peer_registered()):
@@ -15,10 +15,11 @@
 # You should have received a copy of the GNU General Public License
 # along with luteus.  If not, see <http://www.gnu.org/licenses/>.
 
+import base64
 import logging
 import time
 
-from collections import deque
+from collections import deque, OrderedDict
 
 from .event_multiplexing import OrderingEventMultiplexer, ccd
 from gonium.fdm.stream import AsyncLineStream
@@ -37,10 +38,10 @@ def build_ping_tok():
 class ChannelModeParser:
    def __init__(self,
       userflags=((b'o',b'@'),(b'v',b'+')), # flags associated with a nick on the channel
-      listmodes=(b'b'),  # modes manipulating list-type channel attributes
+      listmodes=(b'b',),  # modes manipulating list-type channel attributes
       boolmodes=(b'p',b's',b'i',b't',b'n',b'm'),   # boolean channel modes
-      strmodes=(b'k'),    # channel modes defined by a string value
-      strmodes_opt=(b'l') # same, but unsettable by ommitting the argument
+      strmodes=(b'k',),    # channel modes defined by a string value
+      strmodes_opt=(b'l',) # same, but unsettable by ommitting the argument
       ):
       self.userflags_set(userflags)
       self.lmodes = frozenset(listmodes)
@@ -60,8 +61,12 @@ class ChannelModeParser:
          self.umodes2umodes[m] = mode
          level += 1
    
-   def get_uflagstring(self, modes):
-      return b''.join([self.umodes2flags[m.char] for m in reversed(sorted(modes))])
+   def get_uflagstring(self, modes, multi=True):
+      """Return prefix flags for user modes, highest first; if not multi, only the highest one."""
+      rv = [self.umodes2flags[m.char] for m in reversed(sorted(modes))]
+      if not (multi):
+         del(rv[1:])
+      return b''.join(rv)
    
    def process_ISUPPORT_PREFIX(self, prefix):
       """Process PREFIX arg value from RPL_ISUPPORT(005) message"""
@@ -157,6 +162,8 @@ class _BlockQuery:
    BQTypes = {}
    cmd = None
    start = None
+   # Seconds to keep answering identical queries from a response, or None not to cache responses of this type.
+   cache_ttl = None
    def __init__(self, msg, callback):
       if not (msg.prefix is None):
          raise ValueError('Need msg with prefix == None.')
@@ -206,6 +213,9 @@ class _BlockQuery:
           (msg.parameters[0].upper() == self.msg.command)):
          return True
       return False
+   
+   def is_cacheable(self):
+      return (bool(self.rv) and not any(self.is_genericfail(msg) for msg in self.rv))
 
    def process_data(self, msg):
       if (self.is_genericfail(msg)):
@@ -229,6 +239,14 @@ class _BlockQuery:
       
       return True
 
+
+class _SharedQueryReply:
+   """Query queue entry passing the response of an identical earlier query to callback; this keeps the reply from
+      overtaking ones to queries queued in between."""
+   def __init__(self, query, callback):
+      self.query = query
+      self.callback = callback
+
 # If it's stupid but it works, it isn't stupid. It is, however, a hack.
 # There's various queries whose response blocks don't have an end-marker
 # consistent over all common IRC dialects; culprits include LUSERS and ADMIN.
@@ -283,6 +301,7 @@ class BlockQueryGeneric(_BlockQuery):
 @_BlockQuery.reg_class
 class BlockQueryWHOIS(_BlockQuery):
    cmds = (b'WHOIS',)
+   cache_ttl = 30
    end_num = RPL_ENDOFWHOIS
    start_nums = set((RPL_WHOISUSER, RPL_WHOISSERVER, RPL_WHOISOPERATOR,
       RPL_WHOISIDLE, end_num, RPL_WHOISCHANNELS))
@@ -347,6 +366,7 @@ class BlockQueryLINKS(_BlockQuery):
 @_BlockQuery.reg_class
 class BlockQueryLIST(_BlockQuery):
    cmds = (b'LIST',)
+   cache_ttl = 300
    def get_msg_barriers(self, msg):
       num = msg.get_cmd_numeric()
       return (num in (RPL_LISTSTART, RPL_LIST, RPL_LISTEND),
@@ -355,6 +375,7 @@ class BlockQueryLIST(_BlockQuery):
 @_BlockQuery.reg_class
 class BlockQueryWHO(_BlockQuery):
    cmds = (b'WHO',)
+   cache_ttl = 30
    def get_msg_barriers(self, msg):
       num = msg.get_cmd_numeric()
       return (num in (RPL_WHOREPLY, RPL_WHOSPCRPL, RPL_ENDOFWHO), (num == RPL_ENDOFWHO))
@@ -425,11 +446,23 @@ class IRCClientConnection(AsyncLineStream):
    IRCNICK_INITCHARS = set(b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_`abcdefghijklmnopqrstuvwxyz{|}')
    
    maintenance_delay = 32
+   # Maximum number of cached query responses; least recently used ones are dropped first.
+   query_cache_max = 256
+   # Maximum number of channel mode syncs in flight
+   chan_sync_max = 4
+   CHAN_SYNC_NUMS = frozenset((RPL_CHANNELMODEIS, RPL_CREATIONTIME, RPL_BANLIST, RPL_ENDOFBANLIST, ERR_NOSUCHCHANNEL,
+      ERR_NOTONCHANNEL, ERR_CHANOPRIVSNEEDED))
 
    # Freenode capabilities
    FC_IDENTIFY_MSG = 1
    FC_IDENTIFY_CTCP = 2
    
+   # IRCv3 capabilities we request if the server offers them; these let us follow user state from pushed messages.
+   CAPS_WANTED = (b'multi-prefix', b'userhost-in-names', b'extended-join', b'away-notify', b'account-notify', b'chghost',
+      b'server-time')
+   # Maximum length of one AUTHENTICATE payload chunk
+   SASL_CHUNK_LEN = 400
+   
    EM_NAMES = ('em_in_raw', 'em_in_msg', 'em_in_msg_bc', 'em_out_msg',
       'em_link_finish', 'em_shutdown', 'em_chmode', 'em_chan_join',
       'em_chan_leave')
@@ -466,6 +499,12 @@ class IRCClientConnection(AsyncLineStream):
       self.channels = {}
       self.query_queue = deque()
       self.pending_query = None
+      # Queries waiting for a response, and cached responses; both keyed on (command, parameters).
+      self._queries_shared = {}
+      self._query_cache = OrderedDict()
+      # Channel mode syncs in flight, mapping channel names to the PING tokens ending them, and ones waiting to be started.
+      self._chan_syncs = {}
+      self._chan_syncs_queued = deque()
       self.ping_tok = None
       self.away = False
       self.ts_last_in = time.time()
@@ -474,10 +513,21 @@ class IRCClientConnection(AsyncLineStream):
       self.pcs = S2CProtocolCapabilitySet()
       self.pcs.em_argchange.new_prio_listener(self._process_005_update)
       self.out_line_buf = deque()
+      # IRCv3 capabilities: offered by the server (mapping names to values), and enabled
+      self.caps_avail = {}
+      self.caps = set()
+      self.cap_negotiating = False
+      self._caps_offered = []
+      self._cap_reqs_pending = 0
+      # Account we're logged in to, if known
+      self.account = None
+      # IRCUser instances for everyone sharing a channel with us, by nick
+      self.users = {}
       
       super().__init__(*args, lineseps={b'\n', b'\r'}, **kwargs)
    
-   def start(self, ed, sock, read_r, *, nick, username, realname, mode=0, chm_parser=None, timeout=64, server_password=None, tp_limiter, **kwargs):
+   def start(self, ed, sock, read_r, *, nick, username, realname, mode=0, chm_parser=None, timeout=64, server_password=None, tp_limiter,
+         sasl_user=None, sasl_password=None, **kwargs):
       super().start(ed, sock, read_r=read_r)
       
       if (isinstance(nick, str)):
@@ -486,8 +536,14 @@ class IRCClientConnection(AsyncLineStream):
          username = username.encode('ascii')
       if (isinstance(realname, str)):
          realname = realname.encode('ascii')
+      if (isinstance(sasl_user, str)):
+         sasl_user = sasl_user.encode('utf-8')
+      if (isinstance(sasl_password, str)):
+         sasl_password = sasl_password.encode('utf-8')
      
       self.server_password = server_password
+      self.sasl_user = sasl_user
+      self.sasl_password = sasl_password
       self.timeout = timeout + 8
       self.conn_timeout = timeout//2
       self.fc = 0 #freenode capability mask
@@ -520,15 +576,15 @@ class IRCClientConnection(AsyncLineStream):
       setattr(self, attr, OrderingEventMultiplexer(self))
    
    def _check_queries(self):
-      if not (self.pending_query is None):
-         return
-      if (len(self.query_queue) == 0):
-         return
-         
+      while ((self.pending_query is None) and self.query_queue):
+         query = self.query_queue.popleft()
+         if (isinstance(query, _SharedQueryReply)):
+            query.callback(query.query)
+            continue
          
-      self.pending_query = self.query_queue.popleft()
-      self.ping_fresh = False
-      self.pending_query.put_req(self)
+         self.pending_query = query
+         self.ping_fresh = False
+         query.put_req(self)
    
    def _send_ping(self):
       self.ping_tok = tok = build_ping_tok()
@@ -548,18 +604,73 @@ class IRCClientConnection(AsyncLineStream):
             self.close()
    
    def put_msg(self, msg, callback, force_bc=False):
+      """Send msg to peer; if it's a query, pass the response block to callback instead of broadcasting it.
+      
+      Identical queries share one network request and response, and responses of some query types are cached for a while;
+      so the returned query object may be shared with other callers."""
       if (not force_bc):
          try:
-            query = _BlockQuery.build(msg, callback)
+            cls = _BlockQuery.BQTypes[msg.command.upper()]
          except KeyError:
             pass
          else:
-            self.query_queue.append(query)
-            self._check_queries()
-            return query
+            return self._put_query(cls, msg, callback)
       
       self.send_msg(msg)
    
+   def _put_query(self, cls, msg, callback):
+      # Nicks, channels, masks and server names in query parameters are all case-insensitive.
+      key = (msg.command.upper(), tuple(self.pcs.make_cib(p).normalize() for p in msg.parameters))
+      try:
+         (ts_expire, query) = self._query_cache[key]
+      except KeyError:
+         pass
+      else:
+         if (time.time() < ts_expire):
+            self._query_cache.move_to_end(key)
+            if ((self.pending_query is None) and not (self.query_queue)):
+               callback(query)
+            else:
+               self.query_queue.append(_SharedQueryReply(query, callback))
+            return query
+         del(self._query_cache[key])
+      
+      try:
+         (query, callbacks) = self._queries_shared[key]
+      except KeyError:
+         pass
+      else:
+         if (self.query_queue):
+            last = self.query_queue[-1]
+         else:
+            last = self.pending_query
+         if (last is query):
+            callbacks.append(callback)
+         else:
+            self.query_queue.append(_SharedQueryReply(query, callback))
+         return query
+      
+      callbacks = [callback]
+      def cb(query):
+         self._process_query_done(key, query, callbacks)
+      
+      query = cls(msg, cb)
+      self._queries_shared[key] = (query, callbacks)
+      self.query_queue.append(query)
+      self._check_queries()
+      return query
+   
+   def _process_query_done(self, key, query, callbacks):
+      del(self._queries_shared[key])
+      if (query.cache_ttl and query.is_cacheable()):
+         cache = self._query_cache
+         cache[key] = (time.time() + query.cache_ttl, query)
+         while (len(cache) > self.query_cache_max):
+            cache.popitem(last=False)
+      
+      for callback in callbacks:
+         callback(query)
+   
    def add_autojoin_channel(self, chan, key=None):
       """Attempt to join a channel on this connection.
          This should only be used by event handlers that do autojoins of
@@ -606,7 +717,11 @@ class IRCClientConnection(AsyncLineStream):
          return
       if (line_data == b''):
          return
-      msg = IRCMessageIn.build_from_line(line_data, src=self, pcs=self.pcs)
+      try:
+         msg = IRCMessageIn.build_from_line(line_data, src=self, pcs=self.pcs)
+      except IRCProtocolError as exc:
+         self.log(30, 'From {!r}: line {!a} failed to parse: {}'.format(self.peer_address, bytes(line_data), exc.msg))
+         return
       msg.responded = False
       
       self.em_in_msg(msg)
@@ -615,7 +730,10 @@ class IRCClientConnection(AsyncLineStream):
    
    def process_input_query_fetch(self, msg):
       """Do query input processing."""
-      if (self.pending_query):
+      # Check channel syncs first; some queries claim any numeric until they're done.
+      if (self._process_chan_sync_data(msg)):
+         msg.is_query_related = True
+      elif (self.pending_query):
          msg.is_query_related = self.pending_query.process_data(msg)
          if (msg.is_query_related == 2):
             self.pending_query = None
@@ -623,6 +741,44 @@ class IRCClientConnection(AsyncLineStream):
       else:
          msg.is_query_related = False
    
+   # Channel mode syncs: on our own joins, we fetch modes and ban list of the channel. These don't take the query slot,
+   # so client queries don't wait for them; the replies update channel state through the normal numeric handlers, and we
+   # only claim them here to keep them from being broadcast. A PING sent after the requests marks the end of each sync.
+   def _queue_chan_sync(self, chnn):
+      if ((chnn in self._chan_syncs) or (chnn in self._chan_syncs_queued)):
+         return
+      self._chan_syncs_queued.append(chnn)
+      self._start_chan_syncs()
+   
+   def _start_chan_syncs(self):
+      while (self._chan_syncs_queued and (len(self._chan_syncs) < self.chan_sync_max)):
+         chnn = self._chan_syncs_queued.popleft()
+         if not (chnn in self.channels):
+            continue
+         tok = self._chan_syncs[chnn] = build_ping_tok()
+         self._send_msg(b'MODE', chnn)
+         self._send_msg(b'MODE', chnn, b'b')
+         self._send_msg(b'PING', tok)
+   
+   def _process_chan_sync_data(self, msg):
+      """Return whether msg is part of the reply to one of our channel syncs."""
+      if not (self._chan_syncs):
+         return False
+      if (msg.command == b'PONG'):
+         if (len(msg.parameters) != 2):
+            return False
+         for (chnn, tok) in self._chan_syncs.items():
+            if (msg.parameters[1] == tok):
+               break
+         else:
+            return False
+         del(self._chan_syncs[chnn])
+         self._start_chan_syncs()
+         return True
+      
+      return ((msg.get_cmd_numeric() in self.CHAN_SYNC_NUMS) and (len(msg.parameters) > 1) and
+         (self.pcs.make_cib(msg.parameters[1]) in self._chan_syncs))
+   
    def process_input_statekeeping(self, msg):
       """Do local input processing."""
       try:
@@ -702,12 +858,121 @@ class IRCClientConnection(AsyncLineStream):
 
    def _process_connect(self):
       """Process connect finish."""
+      # Servers that don't know about CAP will ignore or reject this, and go on with registration normally.
+      self.cap_negotiating = True
+      self._send_msg(b'CAP', b'LS', b'302')
       if not (self.server_password is None):
          self._send_msg(b'PASS', self.server_password)
 
       self.send_NICK(self.wnick)
       self._send_msg(b'USER', self.username, str(self.mode).encode('ascii'), b'*', self.realname)
    
+   # IRCv3 capability negotiation
+   def _get_caps_wanted(self):
+      rv = list(self.CAPS_WANTED)
+      if not (self.sasl_user is None):
+         mechs = self.caps_avail.get(b'sasl')
+         if ((mechs is None) or (b'PLAIN' in mechs.upper().split(b','))):
+            rv.append(b'sasl')
+         else:
+            self.log(30, '{} offers no SASL PLAIN; not authenticating.'.format(self))
+      return rv
+   
+   def _cap_end(self):
+      if not (self.cap_negotiating):
+         return
+      self.cap_negotiating = False
+      self._send_msg(b'CAP', b'END')
+   
+   def _process_msg_CAP(self, msg):
+      """Process CAP message."""
+      self._pc_check(msg, 3)
+      sub = msg.parameters[1].upper()
+      args = msg.parameters[2:]
+      # Multiline replies have an additional '*' parameter on all but their last line.
+      more = ((len(args) > 1) and (args[0] == b'*'))
+      caps = args[-1].split()
+      
+      if (sub in (b'LS', b'NEW')):
+         for cap in caps:
+            (name, sep, val) = cap.partition(b'=')
+            self.caps_avail[name] = (val if sep else None)
+            self._caps_offered.append(name)
+         if (more):
+            return
+         
+         offered = set(self._caps_offered)
+         del(self._caps_offered[:])
+         req = [cap for cap in self._get_caps_wanted() if ((cap in offered) and not (cap in self.caps))]
+         if (req):
+            self._cap_reqs_pending += 1
+            self._send_msg(b'CAP', b'REQ', b' '.join(req))
+         elif (self._cap_reqs_pending == 0):
+            self._cap_end()
+      
+      elif (sub == b'ACK'):
+         for cap in caps:
+            if (cap.startswith(b'-')):
+               self.caps.discard(cap[1:])
+            else:
+               self.caps.add(cap)
+         if (more):
+            return
+         self._cap_reqs_pending -= 1
+         self.log(20, '{} enabled capabilities: {}'.format(self, b' '.join(sorted(self.caps))))
+         if (self.cap_negotiating and (b'sasl' in caps)):
+            self._send_msg(b'AUTHENTICATE', b'PLAIN')
+            return
+         if (self._cap_reqs_pending == 0):
+            self._cap_end()
+      
+      elif (sub == b'NAK'):
+         if (more):
+            return
+         self._cap_reqs_pending -= 1
+         self.log(30, '{} had capability request rejected: {!a}'.format(self, args[-1]))
+         if (self._cap_reqs_pending == 0):
+            self._cap_end()
+      
+      elif (sub == b'DEL'):
+         for cap in caps:
+            self.caps.discard(cap)
+            self.caps_avail.pop(cap, None)
+   
+   def _process_msg_AUTHENTICATE(self, msg):
+      """Process AUTHENTICATE message; we only do SASL PLAIN, so the server should only send us an empty challenge."""
+      self._pc_check(msg, 1)
+      if (msg.parameters[0] != b'+'):
+         self._send_msg(b'AUTHENTICATE', b'*')
+         return
+      
+      payload = base64.b64encode(b'\x00'.join((self.sasl_user, self.sasl_user, self.sasl_password)))
+      cl = self.SASL_CHUNK_LEN
+      for i in range(0, len(payload), cl):
+         self._send_msg(b'AUTHENTICATE', payload[i:i+cl])
+      if ((len(payload) % cl) == 0):
+         self._send_msg(b'AUTHENTICATE', b'+')
+   
+   def _process_msg_900(self, msg):
+      """Process RPL_LOGGEDIN message."""
+      self._pc_check(msg, 3)
+      self.account = msg.parameters[2]
+      self.log(20, '{} logged in as {!a}.'.format(self, self.account))
+   
+   def _process_msg_901(self, msg):
+      """Process RPL_LOGGEDOUT message."""
+      self.account = None
+   
+   def _process_msg_903(self, msg):
+      """Process RPL_SASLSUCCESS message."""
+      self._cap_end()
+   
+   def _process_sasl_fail(self, msg):
+      self.log(30, '{} failed SASL authentication: {}'.format(self, msg))
+      self._cap_end()
+   
+   _process_msg_902 = _process_msg_904 = _process_msg_905 = _process_msg_906 = _process_msg_907 = _process_sasl_fail
+   
    def process_close(self):
       """Process connection closing."""
       self.log(20, 'process_close() called on 0x{:x}.'.format(id(self)))
@@ -747,6 +1012,14 @@ class IRCClientConnection(AsyncLineStream):
       
       chnns = msg.parse_JOIN()
       affected_channels = msg._set_ac()
+      user = self._get_user(msg.prefix.nick)
+      user.update_from_ia(msg.prefix)
+      if ((b'extended-join' in self.caps) and (len(msg.parameters) >= 3)):
+         # JOIN <channel> <account> :<realname>
+         account = msg.parameters[1]
+         user.account = (False if (account == b'*') else account)
+         user.realname = msg.parameters[2]
+      
       for chnn in chnns:
          if (msg.prefix.nick == self.nick):
             # Our join.
@@ -755,6 +1028,7 @@ class IRCClientConnection(AsyncLineStream):
             chan = IRCChannel(chnn, cmp_=self.chm_parser)
             self.channels[chnn] = chan
             self.chm_parser.chan_init(chan)
+            self._queue_chan_sync(chnn)
             self.em_chan_join(None, chan)
             affected_channels.add(chan)
             continue
@@ -799,7 +1073,9 @@ class IRCClientConnection(AsyncLineStream):
          self.em_chan_leave(msg, nick_em, chan, None)
          if (nick == self.nick):
             del(self.channels[chnn])
+            self._forget_users(chan.users)
          del(chan.users[nick])
+         self._forget_users((nick,))
          affected_channels.add(chan)
    
    def _process_msg_QUIT(self, msg):
@@ -815,6 +1091,7 @@ class IRCClientConnection(AsyncLineStream):
          self.em_chan_leave(msg, nick, chan, nick)
          affected_channels.add(chan)
          del(chan.users[nick])
+      self.users.pop(nick, None)
    
    def _process_msg_KICK(self, msg):
       """Process KICK message."""
@@ -848,10 +1125,12 @@ class IRCClientConnection(AsyncLineStream):
                del(chan.users[nick])
             except KeyError as exc:
                raise IRCProtocolError('KICKed nick {0!a} not on chan.'.format(nick)) from exc
+            self._forget_users((nick,))
             affected_channels.add(chan)
             continue
          # Our part.
          del(self.channels[chnn])
+         self._forget_users(chan.users)
          chnns_left.add(chnn)
          affected_channels.add(chan)
    
@@ -915,7 +1194,61 @@ class IRCClientConnection(AsyncLineStream):
             self.log(35, 'Apparent nickchange collision: {0!a} changed nick to {1!a} on {2!a} on {3!a}. Overwriting.'.format(old_nick, new_nick, chan, self.peer_address))
          chan.users[new_nick] = user_data
          affected_channels.add(chan)
+      
+      user = self.users.pop(old_nick, None)
+      if not (user is None):
+         user.nick = new_nick
+         self.users[new_nick] = user
 
+   # User state pushed to us by away-notify, account-notify and chghost
+   def _get_user(self, nick):
+      try:
+         rv = self.users[nick]
+      except KeyError:
+         rv = self.users[nick] = IRCUser(nick)
+      return rv
+   
+   def _forget_users(self, nicks):
+      """Discard state of those of the specified users we no longer share a channel with."""
+      for nick in tuple(nicks):
+         for chan in self.channels.values():
+            if (nick in chan.users):
+               break
+         else:
+            self.users.pop(nick, None)
+   
+   def _get_msg_user(self, msg):
+      if ((msg.prefix is None) or (msg.prefix.type != IA_NICK)):
+         raise IRCProtocolError(msg, 'Non-nick sending {!a}.'.format(msg.command))
+      return self.users.get(msg.prefix.nick)
+   
+   def _process_msg_AWAY(self, msg):
+      """Process AWAY message (away-notify)."""
+      user = self._get_msg_user(msg)
+      if (user is None):
+         return
+      if (msg.parameters and msg.parameters[0]):
+         user.away = msg.parameters[0]
+      else:
+         user.away = False
+   
+   def _process_msg_ACCOUNT(self, msg):
+      """Process ACCOUNT message (account-notify)."""
+      self._pc_check(msg, 1)
+      user = self._get_msg_user(msg)
+      if (user is None):
+         return
+      account = msg.parameters[0]
+      user.account = (False if (account == b'*') else account)
+   
+   def _process_msg_CHGHOST(self, msg):
+      """Process CHGHOST message."""
+      self._pc_check(msg, 2)
+      user = self._get_msg_user(msg)
+      if (user is None):
+         return
+      (user.user, user.host) = msg.parameters[:2]
+   
    def _process_msg_TOPIC(self, msg):
       """Process TOPIC message"""
       self._pc_check(msg, 2)
@@ -926,6 +1259,7 @@ class IRCClientConnection(AsyncLineStream):
    def _process_msg_001(self, msg):
       """Process RPL_WELCOME message."""
       self.peer = (self.peer or msg.prefix)
+      self.cap_negotiating = False
    
    def _process_msg_004(self, msg):
       """Process RPL_MYINFO message."""
@@ -1020,6 +1354,47 @@ class IRCClientConnection(AsyncLineStream):
       chan = self._get_own_chan(msg, msg.parameters[1])
       chan.topic = msg.parameters[2]
    
+   def _process_msg_324(self, msg):
+      """Process RPL_CHANNELMODEIS message."""
+      self._pc_check(msg, 3)
+      chan = self.channels.get(self.pcs.make_cib(msg.parameters[1]))
+      if (chan is None):
+         # Someone asked about a channel we're not on.
+         return
+      # This lists all non-list modes set, so forget about any others.
+      for (m, val) in chan.modes.items():
+         if (m in self.chm_parser.bmodes):
+            chan.modes[m] = False
+         elif not (isinstance(val, set)):
+            chan.modes[m] = None
+      
+      self.chm_parser.set_chmodes(self.pcs, self.log, chan, msg.parameters[2:])
+      chan.modes_synced = True
+   
+   def _process_msg_329(self, msg):
+      """Process RPL_CREATIONTIME message."""
+      self._pc_check(msg, 3)
+      chan = self.channels.get(self.pcs.make_cib(msg.parameters[1]))
+      if not (chan is None):
+         chan.ts_created = msg.parameters[2]
+   
+   def _process_msg_367(self, msg):
+      """Process RPL_BANLIST message."""
+      self._pc_check(msg, 3)
+      chan = self.channels.get(self.pcs.make_cib(msg.parameters[1]))
+      if ((chan is None) or (b'b' in chan.lists_synced) or not (b'b' in chan.modes)):
+         # Once we have the full list, MODE messages keep it current.
+         return
+      chan.modes[b'b'].add(msg.parameters[2])
+   
+   def _process_msg_368(self, msg):
+      """Process RPL_ENDOFBANLIST message."""
+      self._pc_check(msg, 2)
+      chan = self.channels.get(self.pcs.make_cib(msg.parameters[1]))
+      if ((chan is None) or not (b'b' in chan.modes)):
+         return
+      chan.lists_synced.add(b'b')
+   
    def _process_msg_353(self, msg):
       """Process RPL_NAMREPLY message."""
       self._pc_check(msg, 4)
@@ -1035,7 +1410,10 @@ class IRCClientConnection(AsyncLineStream):
             if (c in self.IRCNICK_INITCHARS):
                break
             i += 1
-         nick = self.pcs.make_cib(nick_str[i:])
+         # With userhost-in-names, we get full nick!user@host addresses here.
+         ia = self.pcs.make_irc_addr(nick_str[i:])
+         nick = ia.nick
+         self._get_user(nick).update_from_ia(ia)
          
          chan.users[nick] = set()
          for b in b2b(nick_str[:i]):
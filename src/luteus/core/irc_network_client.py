@@ -163,11 +163,14 @@ class IRCNick(IRCCIString):
 
 
 class IRCUserSpec:
-   def __init__(self, username, realname, mode=0):
+   def __init__(self, username, realname, mode=0, sasl_user=None, sasl_password=None):
       self.nicks = OrderedDict()
       self.username = username
       self.realname = realname
       self.mode = mode
+      # Account credentials for SASL PLAIN authentication during registration, if the server supports it
+      self.sasl_user = sasl_user
+      self.sasl_password = sasl_password
    
    def add_nick(self, nick, **kwargs):
       self.nicks[IRCCIString(nick)] = IRCNick(nick, **kwargs)
@@ -231,6 +234,10 @@ class IRCClientNetworkLink:
       self.ts_last_link = None
       self.ts_last_unlink = None
       self._away_msg_default = None
+      # Loggers attached to this link; they register themselves here.
+      self.loggers = []
+      # Shared message routing stage for those loggers; see logging.LogRouter.
+      self.log_router = None
    
    def set_away_msg_default(self, reason):
       if not (reason is None):
@@ -368,7 +375,7 @@ class IRCClientNetworkLink:
             qtypes=server.get_dns_qtypes(), nick=nick, username=self.us.username,
             realname=self.us.realname, mode=self.us.mode, family=server.af,
             bind_target=server._get_bt(), timeout=self.conn_timeout, server_password=server.password,
-            tp_limiter=self.tp_limiter)
+            tp_limiter=self.tp_limiter, sasl_user=self.us.sasl_user, sasl_password=self.us.sasl_password)
       except socket.error as exc:
          self.log(30, 'Failed connecting to {}: {!a}'.format(server, str(exc)))
          self.shedule_conn_init()
@@ -47,6 +47,9 @@ __NUM_specs = (
    (354, 'RPL_WHOSPCRPL'),
    (366, 'RPL_ENDOFNAMES'),
    (324, 'RPL_CHANNELMODEIS'),
+   (329, 'RPL_CREATIONTIME'),
+   (367, 'RPL_BANLIST'),
+   (368, 'RPL_ENDOFBANLIST'),
    
    (364, 'RPL_LINKS'),
    (365, 'RPL_ENDOFLINKS'),
@@ -61,6 +64,7 @@ __NUM_specs = (
    (406, 'ERR_WASNOSUCHNICK'),
    (407, 'ERR_TOOMANYTARGETS'),
    (409, 'ERR_NOORIGIN'),
+   (410, 'ERR_INVALIDCAPCMD'),
    (421, 'ERR_UNKNOWNCOMMAND'),
    
    (422, 'ERR_NOMOTD'),
@@ -72,6 +76,7 @@ __NUM_specs = (
    (433, 'ERR_NICKNAMEINUSE'),
    (436, 'ERR_NICKCOLLISION'),
    (437, 'ERR_UNAVAILRESOURCE'),
+   (442, 'ERR_NOTONCHANNEL'),
    (451, 'ERR_NOTREGISTERED'),
    
    (461, 'ERR_NEEDMOREPARAMS'),
@@ -79,7 +84,19 @@ __NUM_specs = (
    (464, 'ERR_PASSWDMISMATCH'),
    
    (481, 'ERR_NOPRIVILEGES'),
-   (484, 'ERR_RESTRICTED')
+   (482, 'ERR_CHANOPRIVSNEEDED'),
+   (484, 'ERR_RESTRICTED'),
+   
+   # IRCv3 SASL
+   (900, 'RPL_LOGGEDIN'),
+   (901, 'RPL_LOGGEDOUT'),
+   (902, 'ERR_NICKLOCKED'),
+   (903, 'RPL_SASLSUCCESS'),
+   (904, 'ERR_SASLFAIL'),
+   (905, 'ERR_SASLTOOLONG'),
+   (906, 'ERR_SASLABORTED'),
+   (907, 'ERR_SASLALREADY'),
+   (908, 'RPL_SASLMECHS')
 )
 
 for (num, name) in __NUM_specs:
@@ -106,17 +106,31 @@ class IRCPseudoServerConnection(AsyncLineStream):
    log = logger.log
    maintenance_delay = 50
    
-   EM_NAMES = ('em_in_raw', 'em_in_msg', 'em_out_msg', 'em_shutdown')
+   EM_NAMES = ('em_in_raw', 'em_in_msg', 'em_out_msg', 'em_shutdown', 'em_wc_change')
+   # em_wc_change(chann, wanted: bool) is called whenever a channel is added to or removed from wanted_channels.
+   # IRCv3 capabilities we offer to clients
+   CAPS_SUPPORTED = (b'batch', b'server-time', b'echo-message', b'multi-prefix', b'draft/chathistory', b'message-tags')
+   # Message tags clients may get without having enabled message-tags, by the capability that enables them
+   CAP_TAGS = ((b'batch', b'batch'), (b'server-time', b'time'))
    def __init__(self, *args, ssts, self_name, **kwargs):
       AsyncLineStream.__init__(self, *args, lineseps={b'\n', b'\r'}, **kwargs)
       self.ts_init = time.time()
       self.mgr = None
+      # Identity of the client on the other end, for backlog delivery tracking; set on authentication.
+      self.client_id = None
+      self.luteus_user = None
       self.ssts = ssts
       self.nick = None
       self.user = None
       self.mode_str = None
       self.realname = None
       self.wanted_channels = set()
+      # IRCv3 capabilities enabled by the client, and whether it has started capability negotiation without ending it
+      self.caps = set()
+      self.cap_negotiating = False
+      # Argument to IRCMessage.line_build() for messages sent to this client
+      self._with_tags = False
+      self._batch_idx = 0
       self.pcs = S2CProtocolCapabilitySet()
       self._ping_idx = 0
       self._pings_pending = {}
@@ -178,7 +192,11 @@ class IRCPseudoServerConnection(AsyncLineStream):
          return
       if (line_data == b''):
          return
-      msg = IRCMessage.build_from_line(line_data, src=self, pcs=self.pcs)
+      try:
+         msg = IRCMessage.build_from_line(line_data, src=self, pcs=self.pcs)
+      except IRCProtocolError as exc:
+         self.log(30, 'From {0}: line {1!a} failed to parse: {2}'.format(self.peer_address, bytes(line_data), exc.msg))
+         return
       if (self.em_in_msg(msg)):
          return
       
@@ -234,6 +252,10 @@ class IRCPseudoServerConnection(AsyncLineStream):
       self._ping_queued = None
       self._ping_timer = None
    
+   def get_queued_ping(self):
+      """Return pending ping object for the next PING to be sent, if any."""
+      return self._ping_queued
+   
    def queue_ping(self, max_delay, cb, cb_args=(), cb_kwargs={}, front=False):
       """Send a PING to our peer, calling back if and when we get a response.
       
@@ -259,9 +281,18 @@ class IRCPseudoServerConnection(AsyncLineStream):
       if (not self):
          return
       self.em_out_msg(msg)
-      line_out = msg.line_build()
+      line_out = msg.line_build(with_tags=self._with_tags)
       self.send_bytes((line_out,))
    
+   def send_burst(self, msgs, data):
+      """Send sequence of untagged msgs, with data their concatenated lines as previously built, in one write."""
+      if (not self):
+         return
+      if (self.em_out_msg.listeners):
+         for msg in msgs:
+            self.em_out_msg(msg)
+      self.send_bytes((data,))
+   
    def _get_nick(self):
       rv = self.nick
       if (rv is None):
@@ -273,54 +304,92 @@ class IRCPseudoServerConnection(AsyncLineStream):
       rv = IRCAddress(self.pcs, b''.join((self.nick, b'!luteususer', b'@', self.self_name)))
       return rv
    
+   def make_msg_num(self, num, *args):
+      cmd = '{0:03}'.format(num).encode('ascii')
+      return IRCMessage(self.self_name, cmd, (self._get_nick(),) + args)
+   
    def send_msg_num(self, num, *args):
       """Send numeric to peer"""
-      cmd = '{0:03}'.format(num).encode('ascii')
-      msg = IRCMessage(self.self_name, cmd, (self._get_nick(),) + args)
-      self.send_msg(msg)
+      self.send_msg(self.make_msg_num(num, *args))
    
-   def send_msg_001(self, netname=b'Luteus IRC bouncer', ia_user=None):
+   def get_local_host(self):
+      return self.fl.getsockname()[0]
+   
+   def make_msg_001(self, netname=b'Luteus IRC bouncer', ia_user=None):
       if (ia_user is None):
          if (self.nick is None):
             raise ValueError('No nick for peer known.')
          
          ia_user = self.get_unhmask()
       
-      self.send_msg_num(1, b''.join((b'Welcome to ', netname, b', ', ia_user)))
+      return self.make_msg_num(1, b''.join((b'Welcome to ', netname, b', ', ia_user)))
    
-   def send_msg_002(self, host=None, version='foo'):
+   def make_msg_002(self, host=None, version='foo'):
       if (host is None):
-         host = self.fl.getsockname()[0]
+         host = self.get_local_host()
       
-      self.send_msg_num(2, 'Your host is {}, running version {}'.format(host, version).encode('ascii'))
+      return self.make_msg_num(2, 'Your host is {}, running version {}'.format(host, version).encode('ascii'))
    
-   def send_msg_003(self, ts=None):
+   def make_msg_003(self, ts=None):
       if (ts is None):
          ts = self.ssts
       
       tstr = time.strftime('%Y-%m-%d', time.gmtime(ts))
       
-      self.send_msg_num(3, 'This server was created {}'.format(tstr).encode('ascii'))
+      return self.make_msg_num(3, 'This server was created {}'.format(tstr).encode('ascii'))
    
-   def send_msg_004(self, host=None, version='foo'):
+   def make_msg_004(self, host=None, version='foo'):
       if (host is None):
-         host = self.fl.getsockname()[0]
-      self.send_msg_num(4, '{} {}'.format(host, version).encode('ascii'))
-
+         host = self.get_local_host()
+      return self.make_msg_num(4, '{} {}'.format(host, version).encode('ascii'))
+   
+   def make_msgs_005(self, isupport_data):
+      return isupport_data.get_005_lines(self.nick, self.self_name)
+   
+   def make_msgs_motd(self):
+      return [self.make_msg_num(ERR_NOMOTD, b'MOTD not passed through by luteus.')]
+   
+   def make_msg_305(self):
+      return self.make_msg_num(RPL_UNAWAY, b'You are no longer marked as being away')
+   
+   def make_msg_306(self):
+      return self.make_msg_num(RPL_NOWAWAY, b'You have been marked as being away')
+   
+   def send_msg_001(self, *args, **kwargs):
+      self.send_msg(self.make_msg_001(*args, **kwargs))
+   
+   def send_msg_002(self, *args, **kwargs):
+      self.send_msg(self.make_msg_002(*args, **kwargs))
+   
+   def send_msg_003(self, *args, **kwargs):
+      self.send_msg(self.make_msg_003(*args, **kwargs))
+   
+   def send_msg_004(self, *args, **kwargs):
+      self.send_msg(self.make_msg_004(*args, **kwargs))
+   
    def send_msgs_005(self, isupport_data):
       self.pcs = isupport_data
-      msgs = isupport_data.get_005_lines(self.nick, self.self_name)
-      for msg in msgs:
+      for msg in self.make_msgs_005(isupport_data):
          self.send_msg(msg)
    
    def send_msgs_motd(self):
-      self.send_msg_num(ERR_NOMOTD, b'MOTD not passed through by luteus.')
-
+      for msg in self.make_msgs_motd():
+         self.send_msg(msg)
+   
    def send_msg_305(self):
-      self.send_msg_num(RPL_UNAWAY, b'You are no longer marked as being away')
-
+      self.send_msg(self.make_msg_305())
+   
    def send_msg_306(self):
-      self.send_msg_num(RPL_NOWAWAY, b'You have been marked as being away')
+      self.send_msg(self.make_msg_306())
+   
+   def make_batch_ref(self):
+      """Return new batch reference tag for use on this connection."""
+      self._batch_idx += 1
+      return 'LB{0}'.format(self._batch_idx).encode('ascii')
+   
+   def send_fail(self, cmd, code, *args):
+      """Send IRCv3 standard reply FAIL."""
+      self.send_msg(IRCMessage(self.self_name, b'FAIL', (cmd, code) + args))
    
    def send_msg_461(self, cmd):
       self.send_msg(IRCMessage(self.self_name, b'461',
@@ -340,6 +409,7 @@ class IRCPseudoServerConnection(AsyncLineStream):
       if (chann in self.wanted_channels):
          return False
       self.wanted_channels.add(chann)
+      self.em_wc_change(chann, True)
       return True
       
    def wc_remove(self, chann):
@@ -348,6 +418,7 @@ class IRCPseudoServerConnection(AsyncLineStream):
       if not (chann in self.wanted_channels):
          return False
       self.wanted_channels.remove(chann)
+      self.em_wc_change(chann, False)
       return True
    
    def fake_part(self, chan):
@@ -408,6 +479,46 @@ class IRCPseudoServerConnection(AsyncLineStream):
       self.mode_str = msg.parameters[1]
       self.realname = msg.parameters[3]
    
+   def _process_msg_CAP(self, msg):
+      """Process IRCv3 capability negotiation."""
+      self._pc_check(msg, 1, send_error=True)
+      sub = msg.parameters[0].upper()
+      nick = self._get_nick()
+      if (sub == b'LS'):
+         if not (self.peer_registered()):
+            self.cap_negotiating = True
+         self.send_msg(IRCMessage(self.self_name, b'CAP', (nick, b'LS', b' '.join(self.CAPS_SUPPORTED))))
+      elif (sub == b'LIST'):
+         self.send_msg(IRCMessage(self.self_name, b'CAP', (nick, b'LIST', b' '.join(sorted(self.caps)))))
+      elif (sub == b'REQ'):
+         self._pc_check(msg, 2, send_error=True)
+         if not (self.peer_registered()):
+            self.cap_negotiating = True
+         reqs = msg.parameters[1].split()
+         caps = set(self.caps)
+         for req in reqs:
+            if (req.startswith(b'-')):
+               caps.discard(req[1:])
+            elif (req in self.CAPS_SUPPORTED):
+               caps.add(req)
+            else:
+               self.send_msg(IRCMessage(self.self_name, b'CAP', (nick, b'NAK', msg.parameters[1])))
+               return
+         self.caps = caps
+         self._update_with_tags()
+         self.send_msg(IRCMessage(self.self_name, b'CAP', (nick, b'ACK', msg.parameters[1])))
+      elif (sub == b'END'):
+         self.cap_negotiating = False
+      else:
+         self.send_msg_num(ERR_INVALIDCAPCMD, sub, b'Invalid CAP subcommand')
+   
+   def _update_with_tags(self):
+      if (b'message-tags' in self.caps):
+         # Pass on all tags, in the format we got them in.
+         self._with_tags = True
+         return
+      self._with_tags = frozenset(tag for (cap, tag) in self.CAP_TAGS if (cap in self.caps)) or False
+   
    def _process_msg_JOIN(self, msg):
       """Process JOIN."""
       chnns = msg.parse_JOIN()
@@ -417,7 +528,7 @@ class IRCPseudoServerConnection(AsyncLineStream):
          self.wc_add(chnn)
    
    def peer_registered(self):
-      return bool(self.nick and self.user)
+      return bool(self.nick and self.user and (not self.cap_negotiating))
    
    def get_unhmask(self):
       return b''.join((self.nick, b'!', self.user, b'@',
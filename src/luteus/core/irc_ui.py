@@ -21,6 +21,7 @@ import time
 from optparse import OptionParser, Option
 
 from .s2c_structures import *
+from .logging import log_file_pool, SearchLogger
 
 class LuteusOPBailout(Exception):
    pass
@@ -262,28 +263,46 @@ class LuteusIRCUI(LuteusUIBase):
          ctx.cc.send_msg(IRCMessage(ctx.cc.get_unhmask(), b'PART', (chan,
             b'Luteus LPART-triggered fake part.')))
    
-   @rch("BLREPLAY", "Force backlog replay for specified contexts.")
+   @rch("BLREPLAY", "Force backlog replay for specified channels or query partners.")
    def _pc_blreplay(self, ctx, *chans,
-      nicks:OS('-n', help="Replay nick backlog.", action='store_true')=False):
-      blcs = [ctx.cc.pcs.make_cib(chan) for chan in chans]
-      if (nicks):
-         blcs.append(None)
-      
+      nicks:OS('-n', help="Replay backlog of all query partners.", action='store_true')=False,
+      since:OS(help="Only replay lines from this long ago until now (e.g. 90m, 12h, 2d).")=None,
+      last:OS(help="Only replay the last N lines.", type='int')=None,
+      before:OS(help="Only replay lines from before this time (YYYY-MM-DD[THH:MM[:SS]] or unix time).")=None,
+      after:OS(help="Only replay lines from this time on (YYYY-MM-DD[THH:MM[:SS]] or unix time).")=None):
       bl = self.bnc.bl
       blf = self.bnc.blf
       cc = ctx.cc
       if not (bl):
          return
       
+      blcs = [ctx.cc.pcs.make_cib(chan) for chan in chans]
+      if (nicks):
+         blcs.extend(bl.get_nick_ctxs())
+      
+      try:
+         if not (since is None):
+            since = time.time() - self._parse_ts_rel(since)
+         if not (after is None):
+            after = self._parse_ts_abs(after)
+         if not (before is None):
+            before = self._parse_ts_abs(before)
+      except ValueError as exc:
+         ctx.output('Invalid time specification: {0}'.format(exc).encode())
+         return
+      
+      if not (since is None):
+         after = max(since, after or since)
+      
       for blc in blcs:
-         msgs = blf.format_backlog(bl, cc.self_name, blc)
+         msgs = blf.format_backlog(bl, cc.self_name, blc, after=after, before=before, last=last)
          for msg in msgs:
             cc.send_msg(msg)
    
-   @rch("BLRESET", "Reset backlog for specified contexts.")
+   @rch("BLRESET", "Reset backlog for specified channels or query partners.")
    def _pc_blreset(self, ctx, *chans,
       quiet:OS('-q', help="Don't confirm success.", action='store_true')=False,
-      nicks:OS('-n', help="Reset nick backlog.", action='store_true')=False,
+      nicks:OS('-n', help="Reset backlog of all query partners.", action='store_true')=False,
       activechans:OS(help="Add channels active on this connection to reset set.",
       action='store_true')=False):
       bl = self.bnc.bl
@@ -296,7 +315,7 @@ class LuteusIRCUI(LuteusUIBase):
          chans.update(ctx.cc.wanted_channels)
       
       if (nicks):
-         chans.add(None)
+         chans.update(bl.get_nick_ctxs())
       
       for chan in chans:
          bl.reset_bl(chan)
@@ -304,12 +323,34 @@ class LuteusIRCUI(LuteusUIBase):
       if (quiet):
          return
       
-      if (nicks):
-         chans.remove(None)
-      
-      ctx.output(b'Reset backlog for chans ' + b' '.join(chans) + b'.')
+      chans.discard(None)
+      ctx.output(b'Reset backlog for ' + b' '.join(sorted(chans)) + b'.')
    
       
+   @rch("BLCLIENTS", "List client identities backlog delivery is tracked for.")
+   def _pc_blclients(self, ctx,
+      forget:OS(help="Stop tracking deliveries to specified identity.")=None):
+      bl = self.bnc.bl
+      if (bl is None):
+         ctx.output(b'No backlogger active.')
+         return
+      
+      if not (forget is None):
+         if not (forget in bl.get_clients()):
+            ctx.output(b'Unknown client identity ' + forget + b'.')
+            return
+         bl.forget_client(forget)
+         ctx.output(b'Stopped tracking deliveries to ' + forget + b'.')
+         return
+      
+      connected = set(ipsc.client_id for ipsc in self.bnc.ips_conns)
+      for ident in sorted(bl.get_clients(), key=lambda i: i or b''):
+         if (ident in connected):
+            state = b' (connected)'
+         else:
+            state = b''
+         ctx.output((ident or b'<anonymous>') + state)
+   
    @rch("JAEC", "Join all chans currently tracked by the bouncer on this network.")
    def _pc_jaec(self, ctx):
       chans = self.bnc.nc.get_channels()
@@ -320,7 +361,7 @@ class LuteusIRCUI(LuteusUIBase):
          if (chan in ctx.cc.wanted_channels):
             continue
          self.bnc._fake_join(ctx.cc, chan)
-         ctx.cc.wanted_channels.add(chan)
+         ctx.cc.wc_add(chan)
    
    def _printchans(self, o, initial_indent='', subsequent_indent='', **kwargs):
       chans = list(self.bnc.nc.get_channels().keys())
@@ -343,6 +384,36 @@ class LuteusIRCUI(LuteusUIBase):
          tt = time.localtime(ts)
       return time.strftime(fmt, tt)
    
+   _TS_ABS_FMTS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d')
+   def _parse_ts_abs(self, s):
+      s = _decode_if_valid(s)
+      try:
+         return float(s)
+      except ValueError:
+         pass
+      
+      for fmt in self._TS_ABS_FMTS:
+         try:
+            tt = time.strptime(s, fmt)
+         except ValueError:
+            continue
+         return time.mktime(tt)
+      raise ValueError('Unable to parse time {0!a}.'.format(s))
+   
+   _TS_REL_UNITS = {'s':1, 'm':60, 'h':3600, 'd':86400, 'w':604800}
+   def _parse_ts_rel(self, s):
+      s = _decode_if_valid(s)
+      mult = self._TS_REL_UNITS.get(s[-1:], None)
+      if not (mult is None):
+         s = s[:-1]
+      else:
+         mult = 1
+      
+      try:
+         return float(s)*mult
+      except ValueError:
+         raise ValueError('Unable to parse timespan {0!a}.'.format(s)) from None
+   
    def _format_ts_rel(self, seconds):
       from gonium.data_formatting import seconds_hr_relative
       return seconds_hr_relative(seconds)
@@ -392,6 +463,89 @@ class LuteusIRCUI(LuteusUIBase):
          ).encode())
          i += 1
          
+   @rch("LOGSTATS", "Print statistics about the loggers attached to this network.")
+   def _pc_logstats(self, ctx):
+      o = ctx.output
+      writers = []
+      for logger in self.bnc.nc.loggers:
+         o('{0}: {1} open files.'.format(type(logger).__name__, logger.get_open_count()).encode())
+         if ((logger.writer is None) or (logger.writer in writers)):
+            continue
+         writers.append(logger.writer)
+
+      for writer in writers:
+         st = writer.get_stats()
+         o(('Log writer: queue depth {depth} (max {depth_max}), {drops} records dropped, {blocks} blocking puts, '
+            '{ops} ops; latency avg {op_time_avg:.6f}s max {op_time_max:.6f}s.').format(**st).encode())
+      
+      st = log_file_pool.get_stats()
+      o(('Log file pool (all networks): {open} of {max_open} files open; {opens} opens, {reopens} reopens, '
+         '{evictions} evictions.').format(**st).encode())
+
+   @rch("BLSEARCH", "Search logs of this network for lines containing all specified terms.")
+   def _pc_blsearch(self, ctx, *terms,
+      context:OS('-c', help="Only return lines from this channel or query nick.")=None,
+      nick:OS('-n', help="Only return lines from this nick.")=None,
+      since:OS(help="Only return lines from this long ago until now (e.g. 90m, 12h, 2d).")=None,
+      before:OS(help="Only return lines from before this time (YYYY-MM-DD[THH:MM[:SS]] or unix time).")=None,
+      after:OS(help="Only return lines from this time on (YYYY-MM-DD[THH:MM[:SS]] or unix time).")=None,
+      limit:OS(help="Maximum number of lines to return.", type='int')=20,
+      raw:OS(help="Interpret terms as SQLite FTS5 query syntax.", action='store_true')=False):
+      import sqlite3
+      from .log_search import LogSearchIndex, format_result
+      
+      for sl in self.bnc.nc.loggers:
+         if (isinstance(sl, SearchLogger)):
+            break
+      else:
+         ctx.output(b'No search logger active on this network.')
+         return
+      if (sl.index is None):
+         ctx.output(b'Log search is disabled on this network; see the luteus log for why.')
+         return
+      
+      if not (terms):
+         ctx.output(b'Need at least one search term.')
+         return
+      
+      try:
+         if not (since is None):
+            since = time.time() - self._parse_ts_rel(since)
+         if not (after is None):
+            after = self._parse_ts_abs(after)
+         if not (before is None):
+            before = self._parse_ts_abs(before)
+      except ValueError as exc:
+         ctx.output('Invalid time specification: {0}'.format(exc).encode())
+         return
+      if not (since is None):
+         after = max(since, after or since)
+      
+      terms = [_decode_if_valid(t) for t in terms]
+      if (raw):
+         query = ' '.join(terms)
+      else:
+         query = LogSearchIndex.make_query(terms)
+      
+      pcs = ctx.cc.pcs
+      if not (context is None):
+         context = pcs.make_cib(context).normalize()
+      if not (nick is None):
+         nick = pcs.make_cib(nick).normalize()
+      
+      # This runs on the event loop, after waiting for queued log writes; the index is meant to answer quickly enough for
+      # that to be fine.
+      sl._sync()
+      try:
+         results = sl.search(query, ctx=context, nick=nick, after=after, before=before, limit=limit)
+      except sqlite3.Error as exc:
+         ctx.output('Search failed: {0}'.format(exc).encode())
+         return
+      
+      for r in results:
+         ctx.output(format_result(r).encode('utf-8', 'surrogateescape'))
+      ctx.output('{0} matching lines.'.format(len(results)).encode())
+   
    @rch("JUMP", "Disconnect from currently linked server (if any), and attempt to reconnect to network.")
    def _pc_jump(self, ctx):
       conn = self.bnc.nc.conn
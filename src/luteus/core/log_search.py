@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# This file is part of luteus.
+#
+# luteus is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# luteus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with luteus.  If not, see <http://www.gnu.org/licenses/>.
+
+# Full-text log search index. This module only depends on the python stdlib, so the offline search tool can use it
+# without pulling in the rest of luteus.
+
+import logging
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+
+class LogSearchIndex:
+   """SQLite FTS5 full-text index over log lines of one network.
+
+   Lines are buffered in memory and written to the database in batches; searches flush the buffer first, so they
+   always see every line added so far. Safe to use from several threads."""
+   logger = logging.getLogger('LogSearchIndex')
+   log = logger.log
+
+   SCHEMA = (
+      'CREATE TABLE IF NOT EXISTS lines (id INTEGER PRIMARY KEY, ts REAL NOT NULL, ctx BLOB, nick BLOB, '
+         'text TEXT NOT NULL)',
+      'CREATE INDEX IF NOT EXISTS lines_ctx_ts ON lines (ctx, ts)',
+      'CREATE INDEX IF NOT EXISTS lines_ts ON lines (ts)',
+      "CREATE VIRTUAL TABLE IF NOT EXISTS lines_fts USING fts5(text, content='lines', content_rowid='id')",
+      'CREATE TRIGGER IF NOT EXISTS lines_ai AFTER INSERT ON lines BEGIN '
+         'INSERT INTO lines_fts(rowid, text) VALUES (new.id, new.text); END',
+      'CREATE TRIGGER IF NOT EXISTS lines_ad AFTER DELETE ON lines BEGIN '
+         "INSERT INTO lines_fts(lines_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+   )
+
+   def __init__(self, fn, batch_size=256, readonly=False):
+      self.fn = fn
+      self.batch_size = batch_size
+      self._pending = []
+      self._lock = threading.Lock()
+      if (readonly):
+         self.db = sqlite3.connect('file:{0}?mode=ro'.format(os.fsdecode(os.path.abspath(fn))), uri=True,
+            check_same_thread=False)
+         return
+
+      d = os.path.dirname(fn)
+      if (d):
+         os.makedirs(d, exist_ok=True)
+      self.db = sqlite3.connect(fn, check_same_thread=False)
+      self.db.execute('PRAGMA journal_mode=WAL')
+      self.db.execute('PRAGMA synchronous=NORMAL')
+      with self.db:
+         for stmt in self.SCHEMA:
+            self.db.execute(stmt)
+
+   def add(self, ts, ctx, nick, text):
+      """Queue line for indexing."""
+      with self._lock:
+         self._pending.append((ts, ctx, nick, text))
+         if (len(self._pending) >= self.batch_size):
+            self._flush()
+
+   def flush(self):
+      """Write queued lines to the database."""
+      with self._lock:
+         self._flush()
+
+   def _flush(self):
+      if not (self._pending):
+         return
+      lines = self._pending
+      self._pending = []
+      with self.db:
+         self.db.executemany('INSERT INTO lines (ts, ctx, nick, text) VALUES (?, ?, ?, ?)', lines)
+
+   def close(self):
+      if (self.db is None):
+         return
+      self.flush()
+      self.db.close()
+      self.db = None
+
+   @staticmethod
+   def make_query(terms):
+      """Build FTS query matching all of the specified terms literally."""
+      return ' '.join('"{0}"'.format(t.replace('"', '""')) for t in terms)
+
+   def search(self, query, ctx=None, nick=None, after=None, before=None, limit=20):
+      """Return up to <limit> most recent (ts, ctx, nick, text) tuples matching FTS query, in chronological order."""
+      conds = ['lines_fts MATCH ?']
+      args = [query]
+      for (cond, val) in (('l.ctx = ?', ctx), ('l.nick = ?', nick), ('l.ts >= ?', after), ('l.ts < ?', before)):
+         if (val is None):
+            continue
+         conds.append(cond)
+         args.append(val)
+      args.append(limit)
+
+      sql = ('SELECT l.ts, l.ctx, l.nick, l.text FROM lines_fts JOIN lines l ON l.id = lines_fts.rowid WHERE {0} '
+         'ORDER BY l.ts DESC LIMIT ?').format(' AND '.join(conds))
+
+      with self._lock:
+         self._flush()
+         rv = self.db.execute(sql, args).fetchall()
+      rv.reverse()
+      return rv
+
+   def get_stats(self):
+      with self._lock:
+         (count,) = self.db.execute('SELECT count(*) FROM lines').fetchone()
+         return {'lines': count, 'pending': len(self._pending)}
+
+
+def format_result(r, utc=False):
+   (ts, ctx, nick, text) = r
+   if (utc):
+      tt = time.gmtime(ts)
+   else:
+      tt = time.localtime(ts)
+
+   def dec(s):
+      if (s is None):
+         return '-'
+      return s.decode('utf-8', 'replace')
+
+   return '{0} {1} <{2}> {3}'.format(time.strftime('%Y-%m-%d %H:%M:%S', tt), dec(ctx), dec(nick), text)
+
+
+def main():
+   import optparse
+   import sys
+
+   op = optparse.OptionParser(usage='%prog [options] <index file> <term> [<term> ...]',
+      description='Search a luteus log search index.')
+   op.add_option('--context', '-c', default=None, help='Only return lines from this channel or query nick (in lower case)')
+   op.add_option('--nick', '-n', default=None, help='Only return lines from this nick (in lower case)')
+   op.add_option('--after', default=None, type='float', help='Only return lines from this unix time on')
+   op.add_option('--before', default=None, type='float', help='Only return lines from before this unix time')
+   op.add_option('--limit', default=100, type='int', help='Maximum number of lines to return')
+   op.add_option('--raw', default=False, action='store_true', help='Interpret terms as FTS5 query syntax')
+   op.add_option('--utc', default=False, action='store_true', help='Print timestamps in UTC')
+
+   (opts, args) = op.parse_args()
+   if (len(args) < 2):
+      op.error('Need an index file and at least one search term.')
+
+   (fn, terms) = (args[0], args[1:])
+   if (opts.raw):
+      query = ' '.join(terms)
+   else:
+      query = LogSearchIndex.make_query(terms)
+
+   def enc(s):
+      if (s is None):
+         return None
+      return os.fsencode(s)
+
+   idx = LogSearchIndex(fn, readonly=True)
+   try:
+      results = idx.search(query, ctx=enc(opts.context), nick=enc(opts.nick), after=opts.after,
+         before=opts.before, limit=opts.limit)
+   except sqlite3.Error as exc:
+      print('Search failed: {0}'.format(exc), file=sys.stderr)
+      sys.exit(1)
+
+   for r in results:
+      print(format_result(r, utc=opts.utc))
+
+
+if (__name__ == '__main__'):
+   main()
@@ -16,14 +16,125 @@
 # along with luteus.  If not, see <http://www.gnu.org/licenses/>.
 
 import collections
+import io
 import logging
 import os
 import os.path
 import pickle
+import struct
+import threading
 import time
+import zlib
 from weakref import WeakValueDictionary
 
-from .s2c_structures import IRCMessage, IA_SERVER, IRCCIString
+from .s2c_structures import IRCMessage, IRCAddress, IA_SERVER, IRCCIString, S2CProtocolCapabilitySet
+
+
+class _TSFormatCache:
+   """Caching strftime() renderer for one time format and time zone setting.
+   
+   We render the parts of the format that don't depend on minute and second once per hour, and just fill in %M and %S
+   digits for timestamps within that hour. Formats with other directives that depend on the minute or second are only
+   cached for the most recent second. Instances can be shared between threads; all state is swapped in atomically."""
+   # Directives we can expand into ones we know how to patch
+   EXPANSIONS = {'T': '%H:%M:%S', 'R': '%H:%M'}
+   # Directives (other than %M and %S) whose output can change within an hour
+   UNPATCHABLE = set('cXrs+EO')
+   # glibc flag characters, which may be followed by a field width, as in '%-M' or '%_3S'
+   FLAGS = set('_-0^#')
+   
+   def __init__(self, fmt, utc):
+      self.fmt = fmt
+      self.utc = utc
+      if (utc):
+         self._get_tt = time.gmtime
+      else:
+         self._get_tt = time.localtime
+      # List of strftime format fragments, and the fields (M or S) to insert after each but the last one.
+      self._frags = self._split_fmt(fmt)
+      # (start of period, period length, minute at start of period, str.format() template taking M and S)
+      self._tmpl = (0, 0, 0, None)
+      # (second, result)
+      self._last = (None, None)
+   
+   @classmethod
+   def _split_fmt(cls, fmt):
+      frags = []
+      fields = []
+      frag = []
+      i = 0
+      while (i < len(fmt)):
+         c = fmt[i]
+         if ((c != '%') or (i + 1 == len(fmt))):
+            frag.append(c)
+            i += 1
+            continue
+         j = i + 1
+         while ((j < len(fmt)) and ((fmt[j] in cls.FLAGS) or fmt[j].isdigit())):
+            j += 1
+         if (j > i + 1):
+            # We'd have to reimplement the flags to patch these in.
+            if ((j == len(fmt)) or (fmt[j] in 'MS') or (fmt[j] in cls.EXPANSIONS) or (fmt[j] in cls.UNPATCHABLE)):
+               return None
+            frag.append(fmt[i:j+1])
+            i = j + 1
+            continue
+         
+         d = fmt[i+1]
+         i += 2
+         if (d in cls.EXPANSIONS):
+            fmt = cls.EXPANSIONS[d] + fmt[i:]
+            i = 0
+            continue
+         if (d in cls.UNPATCHABLE):
+            return None
+         if (d in 'MS'):
+            frags.append(''.join(frag))
+            fields.append(d)
+            frag = []
+         else:
+            frag.append('%' + d)
+      frags.append(''.join(frag))
+      return (frags, fields)
+   
+   def _make_tmpl(self, sec):
+      (frags, fields) = self._frags
+      tt = self._get_tt(sec)
+      start = sec - tt.tm_min*60 - tt.tm_sec
+      length = 3600
+      minute = 0
+      if (self._get_tt(start + length - 1).tm_gmtoff != tt.tm_gmtoff):
+         # Time zone offset changes within this hour; only cache this minute.
+         start = sec - tt.tm_sec
+         length = 60
+         minute = tt.tm_min
+      rv_l = []
+      for (i, frag) in enumerate(frags):
+         rv_l.append(time.strftime(frag, tt).replace('{', '{{').replace('}', '}}'))
+         if (i < len(fields)):
+            rv_l.append('{{{0}:02}}'.format(fields[i]))
+      tmpl = (start, length, minute, ''.join(rv_l))
+      self._tmpl = tmpl
+      return tmpl
+   
+   def format(self, ts):
+      sec = int(ts)
+      (last_sec, rv) = self._last
+      if (sec == last_sec):
+         return rv
+      
+      if (self._frags is None):
+         rv = time.strftime(self.fmt, self._get_tt(sec))
+      else:
+         (start, length, minute, tmpl) = self._tmpl
+         if not (start <= sec < start + length):
+            (start, length, minute, tmpl) = self._make_tmpl(sec)
+         
+         off = sec - start
+         rv = tmpl.format(M=minute + off // 60, S=off % 60)
+      
+      self._last = (sec, rv)
+      return rv
 
 
 class LogEntry:
@@ -92,12 +203,30 @@ class LogProcessShutdown(LogEntry):
    def get_text(self):
       return b'Luteus process shut down.'
 
+class LogBacklogEvicted(LogEntry):
+   def __init__(self, count, ts=None):
+      super().__init__(ts)
+      self.count = count
+   
+   def get_text(self):
+      return '[{0} backlog lines dropped to stay within quota.]'.format(self.count).encode('ascii')
+
 class _LogFormatter:
    cmd_map = {b'ACTION': b'*'}
+   # Maximum number of formatted entry bodies to cache; least recently used ones are dropped first.
+   body_cache_max = 4096
    
    def __init__(self, time_fmt=None, time_color=None, nmcl_color=None, ctcp_color=None, utc=True):
       self.time_fmt = time_fmt
       self.utc = utc
+      # Formatted entry bodies, keyed by entry contents, in LRU order. Formatters can be shared between logger threads,
+      # so this is only accessed with the lock held.
+      self._body_cache = collections.OrderedDict()
+      self._body_cache_lock = threading.Lock()
+      # Timestamp renderers by (time_fmt, utc)
+      self._ts_caches = {}
+      # (time_fmt, utc, time_cfmt, second, formatted timestamp)
+      self._ts_last = (None, None, None, None, None)
       
       self.set_time_color(time_color)
       self.set_nomsg_channel_line_color(nmcl_color)
@@ -120,6 +249,7 @@ class _LogFormatter:
          self.time_cfmt = '\x03{0:02}{{0}}\x0f'.format(c)
    
    def set_ctcp_color(self, c=None):
+      self._body_cache = collections.OrderedDict()
       self._ctcp_color = c
       if (c is None):
          self.ctcp_prefix = b''
@@ -127,6 +257,7 @@ class _LogFormatter:
          self.ctcp_prefix = '\x03{0:02}'.format(c).encode('ascii')
    
    def set_nomsg_channel_line_color(self, c=None):
+      self._body_cache = collections.OrderedDict()
       self._nmcl_color = c
       if (c is None):
          self.nmcl_prefix = b''
@@ -134,8 +265,20 @@ class _LogFormatter:
          self.nmcl_prefix = '\x03{0:02}'.format(c).encode('ascii')
    
    def format_ts(self, e):
-      return self.time_cfmt.format(e.get_time_str(self.time_fmt,
-         utc=self.utc)).encode('ascii')
+      sec = int(e.ts)
+      (fmt, utc, cfmt, last_sec, rv) = self._ts_last
+      if ((sec == last_sec) and (fmt is self.time_fmt) and (utc is self.utc) and (cfmt is self.time_cfmt)):
+         return rv
+      
+      (fmt, utc, cfmt) = (self.time_fmt, self.utc, self.time_cfmt)
+      try:
+         tsc = self._ts_caches[(fmt, utc)]
+      except KeyError:
+         tsc = self._ts_caches[(fmt, utc)] = _TSFormatCache(LogEntry.TS_FMT_DEFAULT if (fmt is None) else fmt, utc)
+      
+      rv = cfmt.format(tsc.format(sec)).encode('ascii')
+      self._ts_last = (fmt, utc, cfmt, sec, rv)
+      return rv
    
    def map_cmd_out(self, cmd):
       """Convert cmd string into output form."""
@@ -181,34 +324,69 @@ class _LogFormatter:
          lprefix = self.ctcp_prefix
       return b''.join((lprefix, self.format_line_prefix(e, cmd), b' ', ctcp_data))
    
-   def format_entry(self, lname, orig_target, e):
-      """Return list of formatted lines to given backlog entry originally
-         targeted to orig_target with luteus name lname."""
-      ctcps = []
-      if (isinstance(e, LogLine)):
-         if not ((e.msg.get_cmd_numeric() is None) or isinstance(e, NickLogLine)):
-            return []
+   def _format_body(self, e):
+      if not ((e.msg.get_cmd_numeric() is None) or isinstance(e, NickLogLine)):
+         return None
+      
+      ctcps = ()
+      msg_like = e.is_msglike()
+      if not (msg_like):
+         text = self.nmcl_prefix
+      else:
+         text = b''
+      
+      text += self.format_line_prefix(e)
+      
+      if (msg_like):
+         (tf, ctcps) = e.msg.split_ctcp()
+         text_ext = b' ' + b''.join(tf)
          
-         msg_like = e.is_msglike()
-         if not (msg_like):
-            text = self.nmcl_prefix
+         if (text_ext == b' '):
+            text = None
          else:
-            text = b''
-         
-         text += self.format_line_prefix(e)
+            text += text_ext
+      else:
+         text += b' '.join([self.nmcl_prefix] + e.msg.get_notarget_parameters())
+      
+      return (text, tuple(self.format_ctcp(e, ctcp) for ctcp in ctcps))
+   
+   def format_body(self, e):
+      """Return (text, ctcp_texts) for entry, without timestamp; text may be None. Returns None for entries that
+         shouldn't be output.
          
-         if (msg_like):
-            (tf, ctcps) = e.msg.split_ctcp()
-            text_ext = b' ' + b''.join(tf)
-            
-            if (text_ext == b' '):
-               text = None
-            else:
-               text += text_ext
+         This doesn't depend on where the entry is replayed to, so we cache the results for LogLines."""
+      if not (isinstance(e, LogLine)):
+         return (e.get_text(), ())
+      
+      msg = e.msg
+      src = e.src
+      if not (src is None):
+         src = bytes(src)
+      key = (type(e), e.outgoing, src, msg.command, tuple(msg.parameters))
+      cache = self._body_cache
+      with self._body_cache_lock:
+         try:
+            rv = cache[key]
+         except KeyError:
+            pass
          else:
-            text += b' '.join([self.nmcl_prefix] + e.msg.get_notarget_parameters())
-      else:
-         text = e.get_text()
+            cache.move_to_end(key)
+            return rv
+      
+      rv = self._format_body(e)
+      with self._body_cache_lock:
+         cache[key] = rv
+         if (len(cache) > self.body_cache_max):
+            cache.popitem(last=False)
+      return rv
+   
+   def format_entry(self, lname, orig_target, e):
+      """Return list of formatted lines to given backlog entry originally
+         targeted to orig_target with luteus name lname."""
+      body = self.format_body(e)
+      if (body is None):
+         return []
+      (text, ctcp_texts) = body
       
       ts_str = self.format_ts(e)
       rt = e.get_replay_target(orig_target)
@@ -218,15 +396,14 @@ class _LogFormatter:
       else:
          rv = self._make_lines(rs, rt, ts_str, text)
 
-      for ctcp in ctcps:
-         text = self.format_ctcp(e, ctcp)
+      for text in ctcp_texts:
          rv.extend(self._make_lines(rs, rt, ts_str, text))
       
       return rv
    
-   def format_backlog(self, bl, lname, orig_target):
-      """Return list of privmsgs to format entire backlog."""
-      bles = bl.get_bl(orig_target)
+   def format_backlog(self, bl, lname, orig_target, **kwargs):
+      """Return list of privmsgs to format backlog; kwargs are passed on to bl.get_bl()."""
+      bles = bl.get_bl(orig_target, **kwargs)
       rv = []
       for entry in bles:
          rv.extend(self.format_entry(lname, orig_target, entry))
@@ -298,6 +475,10 @@ class LogFile:
       self.fn = fn
       self._open_file()
       self._ts_last_use = time.time()
+      # Timestamp of the newest record we've written to the file
+      self.ts_last_record = None
+      # Time at which this file is due for rotation, if any
+      self.rotate_at = None
       
    def _open_file(self):
       f = _get_locked_file(self.fn)
@@ -316,18 +497,120 @@ class LogFile:
       self.f.write(text)
       self.f.flush()
       self._ts_last_use = time.time()
+      self.ts_last_record = r.ts
+   
+   def get_size(self):
+      return self.f.tell()
+   
+   def get_mtime(self):
+      return os.fstat(self.f.fileno()).st_mtime
+
+
+class _BLPickler(pickle.Pickler):
+   """Pickler for backlog records; protocol capability sets are stored by reference only."""
+   def persistent_id(self, obj):
+      if (isinstance(obj, S2CProtocolCapabilitySet)):
+         return 'pcs'
+      return None
+
+
+class _BLUnpickler(pickle.Unpickler):
+   """Unpickler for backlog records; protocol capability set references resolve to that of the records' network."""
+   def __init__(self, f, pcs):
+      super().__init__(f)
+      self.pcs = pcs
+   
+   def persistent_load(self, pid):
+      if (pid == 'pcs'):
+         return self.pcs
+      raise pickle.UnpicklingError('Unsupported persistent id {!a}.'.format(pid))
+
+
+def _fsync_dir(dn):
+   """Make renames within directory dn durable."""
+   if (dn == b''):
+      dn = b'.'
+   fd = os.open(dn, os.O_RDONLY)
+   try:
+      os.fsync(fd)
+   finally:
+      os.close(fd)
 
 
 class BacklogFile(LogFile):
-   def __init__(self, fn):
+   """Pickled backlog records for one context.
+   
+   The data file starts with a header holding the number of records discarded before its first record, followed by
+   the records themselves. Each record is pickled independently, and stored in a frame holding its length and CRC32,
+   so it can be read starting at any record boundary and torn writes can be told apart from complete records. A sidecar
+   index file (<fn> + IDX_SUFFIX) holds a (timestamp, offset) entry per record, used to look up records by count or
+   time without scanning the data file.
+   
+   Records aren't fsync()ed individually; if we're killed mid-write, the next open checks the records after the last
+   indexed one, drops any incomplete or corrupt frames at the tail of the data file and indexes complete ones.
+   
+   Discarding records normally just advances a watermark kept in the index header; the data file is only rewritten
+   once the discarded prefix takes up as much space as the remaining records (and at least compact_min bytes)."""
+   logger = logging.getLogger('BacklogFile')
+   log = logger.log
+   
+   # BEL can't occur in channel names, so this won't collide with the filename of any context.
+   IDX_SUFFIX = b'\x07idx'
+   TMP_SUFFIX = b'\x07tmp'
+   IDX_MAGIC = b'LBLX'
+   IDX_VERSION = 3
+   # magic, version, discarded count at start of data file, discarded count (watermark), quota-evicted count
+   IDX_HEADER = struct.Struct('<4sIQQQ')
+   IDX_ENTRY = struct.Struct('<dQ')
+   DATA_MAGIC = b'LBLD'
+   DATA_VERSION = 1
+   # magic, version, discarded count at start of data file
+   DATA_HEADER = struct.Struct('<4sIQ')
+   # record length, CRC32 of record
+   FRAME = struct.Struct('<II')
+   compact_min = 1024*1024
+   
+   def __init__(self, fn, pcs=None):
+      if (pcs is None):
+         pcs = S2CProtocolCapabilitySet()
+      # Protocol capability set of the network these records are from
+      self.pcs = pcs
+      self.f_idx = None
       super().__init__(fn)
-      self._discarded_record_count = self._get_init_record()
-      self._buffered_record_count = len(self.get_records())
+      # Whether the data file is in the unframed format of older versions.
+      self._legacy = False
+      self._file_drc = self._discarded_record_count = self._read_data_header()
+      self._data_start = self.f.tell()
+      self._data_end = self.f.seek(0, 2)
+      # Number of records evicted to stay within quota, immediately before the watermark.
+      self._evicted = 0
+      self._open_idx()
    
-   def put_record(self, o):
+   def close(self):
+      if not (self.f_idx is None):
+         self.f_idx.close()
+         self.f_idx = None
+      super().close()
+   
+   def _frame_record(self, o):
+      """Return framed pickle of record o."""
+      buf = self._buf
+      buf.seek(0)
+      buf.truncate()
+      self.p.clear_memo()
       self.p.dump(o)
-      self._buffered_record_count += 1
+      data = buf.getvalue()
+      return self.FRAME.pack(len(data), zlib.crc32(data)) + data
+   
+   def put_record(self, o):
+      off = self.f.seek(0, 2)
+      self.f.write(self._frame_record(o))
       self.f.flush()
+      self._data_end = self.f.tell()
+      self.f_idx.seek(0, 2)
+      self.f_idx.write(self.IDX_ENTRY.pack(getattr(o, 'ts', 0), off))
+      self.f_idx.flush()
+      self._buffered_record_count += 1
       #self._ts_last_use = time.time()
    
    def _get_dcb(self):
@@ -335,39 +618,350 @@ class BacklogFile(LogFile):
    
    def _open_file(self):
       super()._open_file()
-      self.p = pickle.Pickler(self.f)
+      self._buf = io.BytesIO()
+      self.p = _BLPickler(self._buf)
    
-   def _get_init_record(self):
+   def _read_data_header(self):
+      """Read data file header and return discarded record count from it."""
       self.f.seek(0)
-      u = pickle.Unpickler(self.f)
-      try:
-         rv = u.load()
-      except EOFError:
-         rv = 0
-         self.f.seek(0)
-         self.p.dump(rv)
-      else:
-         int(rv)
+      header = self.f.read(self.DATA_HEADER.size)
+      if (header.startswith(self.DATA_MAGIC) or self.DATA_MAGIC.startswith(header)):
+         if (len(header) < self.DATA_HEADER.size):
+            # New file, or we were killed while making it.
+            self.f.seek(0)
+            self.f.truncate()
+            self.f.write(self.DATA_HEADER.pack(self.DATA_MAGIC, self.DATA_VERSION, 0))
+            self.f.flush()
+            return 0
+         (magic, version, rv) = self.DATA_HEADER.unpack(header)
+         if (version != self.DATA_VERSION):
+            raise ValueError('Backlog file {0!a} has unsupported format version {1}.'.format(self.fn, version))
+         return rv
+      
+      # Older format: a pickled discarded record count, followed by unframed pickled records.
+      self.f.seek(0)
+      self._legacy = True
+      return int(_BLUnpickler(self.f, self.pcs).load())
+   
+   def _read_frame(self, off, end):
+      """Return (record data, end offset) of frame at off, or None if it's incomplete or corrupt."""
+      if (off + self.FRAME.size > end):
+         return None
+      self.f.seek(off)
+      (length, crc) = self.FRAME.unpack(self.f.read(self.FRAME.size))
+      data_end = off + self.FRAME.size + length
+      if (data_end > end):
+         return None
+      data = self.f.read(length)
+      if (zlib.crc32(data) != crc):
+         return None
+      return (data, data_end)
+   
+   def _load_record(self, data):
+      return _BLUnpickler(io.BytesIO(data), self.pcs).load()
+   
+   def _scan_records(self):
+      """Return all complete records from the data file, by sequential scan."""
+      rv = []
+      if (self._legacy):
+         self.f.seek(self._data_start)
+         u = _BLUnpickler(self.f, self.pcs)
+         while (True):
+            try:
+               rv.append(u.load())
+            except EOFError:
+               break
+            except Exception as exc:
+               self.log(30, 'Dropping unreadable tail of backlog file {0!a} at {1}: {2!a}'.format(self.fn,
+                  self.f.tell(), exc))
+               break
+         return rv
+      
+      off = self._data_start
+      while (True):
+         frame = self._read_frame(off, self._data_end)
+         if (frame is None):
+            break
+         (data, off) = frame
+         rv.append(self._load_record(data))
+      if (off != self._data_end):
+         self.log(30, 'Dropping {0} bytes of incomplete records at end of backlog file {1!a}.'.format(
+            self._data_end - off, self.fn))
       return rv
    
-   def get_records(self, skip=1):
-      self.f.seek(0)
-      u = pickle.Unpickler(self.f)
-      for i in range(skip):
-         u.load()
+   def get_records(self):
+      """Return all buffered records."""
+      self._ts_last_use = time.time()
+      return self._read_records(0, self._buffered_record_count)
+   
+   def _open_idx(self):
+      fn_idx = self.fn + self.IDX_SUFFIX
+      try:
+         self.f_idx = open(fn_idx, 'r+b')
+      except EnvironmentError:
+         self.f_idx = open(fn_idx, 'w+b')
       
-      rv = []
+      if (self._legacy or (not self._check_idx())):
+         # Missing, stale or written for an older data file format; rewriting the data file also rebuilds the index.
+         self.log(20, 'Rebuilding backlog index for {!a}.'.format(self.fn))
+         self._rewrite(self._file_drc, self._scan_records())
+   
+   def _check_idx(self):
+      """Load state from index file; return whether it matches the data file.
+      
+      Also recovers from being killed while appending records: index entries for incomplete records are dropped,
+      complete records after the last indexed one are indexed, and anything after those is truncated from the data
+      file. This only looks at the tail of the data file."""
+      f = self.f_idx
+      f.seek(0)
+      header = f.read(self.IDX_HEADER.size)
+      if (len(header) < self.IDX_HEADER.size):
+         return False
+      (magic, version, file_drc, drc, evicted) = self.IDX_HEADER.unpack(header)
+      if ((magic != self.IDX_MAGIC) or (version != self.IDX_VERSION) or (file_drc != self._file_drc) or
+            (drc < file_drc)):
+         return False
+      
+      count = (f.seek(0, 2) - self.IDX_HEADER.size) // self.IDX_ENTRY.size
+      # Drop entries for records that didn't make it into the data file in full.
+      off = self._data_start
+      while (count > 0):
+         f.seek(self.IDX_HEADER.size + (count-1)*self.IDX_ENTRY.size)
+         frame = self._read_frame(self.IDX_ENTRY.unpack(f.read(self.IDX_ENTRY.size))[1], self._data_end)
+         if not (frame is None):
+            off = frame[1]
+            break
+         count -= 1
+      
+      # Index complete records written after the last indexed one.
+      entries = []
       while (True):
-         try:
-            o = u.load()
-         except EOFError:
+         frame = self._read_frame(off, self._data_end)
+         if (frame is None):
             break
-         rv.append(o)
+         entries.append(self.IDX_ENTRY.pack(getattr(self._load_record(frame[0]), 'ts', 0), off))
+         off = frame[1]
+      
+      idx_end = self.IDX_HEADER.size + count*self.IDX_ENTRY.size
+      if ((off != self._data_end) or (f.seek(0, 2) != idx_end) or entries):
+         self.log(30, 'Recovering backlog file {0!a}: dropping {1} bytes of incomplete records, indexing {2} '
+            'unindexed ones.'.format(self.fn, self._data_end - off, len(entries)))
+         self.f.truncate(off)
+         self._data_end = off
+         f.truncate(idx_end)
+         f.seek(idx_end)
+         f.write(b''.join(entries))
+         count += len(entries)
+      
+      if (drc - file_drc > count):
+         self.log(30, 'Backlog file {0!a} lost records past its discard watermark; discarding all.'.format(self.fn))
+         drc = file_drc + count
+      
+      self._discarded_record_count = drc
+      self._buffered_record_count = count - (drc - file_drc)
+      self._evicted = evicted
+      self._write_idx_header()
+      return True
+   
+   def _write_idx_header(self):
+      self.f_idx.seek(0)
+      self.f_idx.write(self.IDX_HEADER.pack(self.IDX_MAGIC, self.IDX_VERSION, self._file_drc,
+         self._discarded_record_count, self._evicted))
+      self.f_idx.flush()
+   
+   def _get_idx_entry(self, i):
+      """Return (timestamp, offset) index entry of i-th buffered record."""
+      i += self._discarded_record_count - self._file_drc
+      self.f_idx.seek(self.IDX_HEADER.size + i*self.IDX_ENTRY.size)
+      return self.IDX_ENTRY.unpack(self.f_idx.read(self.IDX_ENTRY.size))
+   
+   def _bisect(self, field, val):
+      """Return buffer index of the first record with index entry field at or after val."""
+      lo = 0
+      hi = self._buffered_record_count
+      while (lo < hi):
+         mid = (lo + hi) // 2
+         if (self._get_idx_entry(mid)[field] < val):
+            lo = mid + 1
+         else:
+            hi = mid
+      return lo
+   
+   def _find_ts(self, ts):
+      return self._bisect(0, ts)
+   
+   def _get_live_start(self):
+      """Return data file offset of first buffered record."""
+      if (self._buffered_record_count == 0):
+         return self._data_end
+      return self._get_idx_entry(0)[1]
+   
+   def get_size(self):
+      """Return number of data file bytes used by buffered records."""
+      return self._data_end - self._get_live_start()
+   
+   def get_quota_excess(self, max_records=None, max_bytes=None, max_age=None, now=None):
+      """Return number of oldest records to discard to get within the specified limits.
+      
+      The newest record is always kept."""
+      rv = 0
+      if not (max_records is None):
+         rv = max(rv, self._buffered_record_count - max_records)
+      if ((not (max_bytes is None)) and (self.get_size() > max_bytes)):
+         rv = max(rv, self._bisect(1, self._data_end - max_bytes))
+      if not (max_age is None):
+         if (now is None):
+            now = time.time()
+         rv = max(rv, self._find_ts(now - max_age))
+      return min(rv, self._buffered_record_count - 1)
+   
+   def get_records_range(self, start=None, after=None, before=None, last=None, first=None, filter=None):
+      """Return buffered records selected by index lookups.
+      
+      start: only return records at or after this record count
+      after: only return records with a timestamp at or after this one
+      before: only return records with a timestamp before this one
+      filter: only return records for which this returns True
+      last: only return the last <last> of the records selected by the other arguments
+      first: only return the first <first> of the records selected by the other arguments
+      
+      If records have been evicted to stay within quota immediately before the returned ones, and start doesn't
+      exclude them, the returned list starts with a LogBacklogEvicted entry."""
+      drc = self._discarded_record_count
+      lo = 0
+      hi = self._buffered_record_count
+      if not (start is None):
+         lo = max(lo, start - drc)
+      if not (after is None):
+         lo = max(lo, self._find_ts(after))
+      if not (before is None):
+         hi = min(hi, self._find_ts(before))
       
       self._ts_last_use = time.time()
+      if (filter is None):
+         if not (last is None):
+            lo = max(lo, hi - last)
+         if not (first is None):
+            hi = min(hi, lo + first)
+         rv = self._read_records(lo, hi)
+      else:
+         (lo, rv) = self._read_records_filtered(lo, hi, filter, last, first)
+      
+      if (rv and self._evicted and (lo == 0) and ((start is None) or (start < drc))):
+         rv.insert(0, LogBacklogEvicted(self._evicted, ts=getattr(rv[0], 'ts', None)))
+      return rv
+   
+   def _read_records_filtered(self, lo, hi, filter, last=None, first=None):
+      """Return (index of first returned record, records) for records with indices in [lo, hi) passing filter,
+      limited as for get_records_range().
+      
+      With a limit, records are read in growing chunks from the relevant end of the range, until enough of them have
+      passed the filter."""
+      def read(c_lo, c_hi):
+         return [(i, r) for (i, r) in enumerate(self._read_records(c_lo, c_hi), c_lo) if filter(r)]
+      
+      chunk = 64
+      if not (last is None):
+         rv = []
+         c_hi = hi
+         while ((c_hi > lo) and (len(rv) < last)):
+            c_lo = max(lo, c_hi - chunk)
+            rv[:0] = read(c_lo, c_hi)
+            c_hi = c_lo
+            chunk *= 2
+         del(rv[:max(0, len(rv) - last)])
+         if not (first is None):
+            del(rv[first:])
+      elif not (first is None):
+         rv = []
+         c_lo = lo
+         while ((c_lo < hi) and (len(rv) < first)):
+            c_hi = min(hi, c_lo + chunk)
+            rv.extend(read(c_lo, c_hi))
+            c_lo = c_hi
+            chunk *= 2
+         del(rv[first:])
+      else:
+         rv = read(lo, hi)
+      
+      if not (rv):
+         return (hi, [])
+      return (rv[0][0], [r for (i, r) in rv])
+   
+   def _read_records(self, lo, hi):
+      """Return buffered records with indices in [lo, hi)."""
+      if (lo >= hi):
+         return []
+      start = self._get_idx_entry(lo)[1]
+      if (hi < self._buffered_record_count):
+         end = self._get_idx_entry(hi)[1]
+      else:
+         end = self._data_end
+      self.f.seek(start)
+      buf = memoryview(self.f.read(end - start))
+      
+      rv = []
+      off = 0
+      while (off < len(buf)):
+         (length, crc) = self.FRAME.unpack_from(buf, off)
+         off += self.FRAME.size
+         data = buf[off:off+length]
+         if (zlib.crc32(data) != crc):
+            raise ValueError('Checksum mismatch for record at offset {0} of backlog file {1!a}.'.format(start + off,
+               self.fn))
+         rv.append(self._load_record(data))
+         off += length
       return rv
    
-   def _discard_data(self, target_drc):
+   def _rewrite(self, drc, records):
+      """Replace data and index file with ones holding the specified records, preceded by drc discarded ones.
+      
+      The new files are synced to disk before being renamed over the old ones, so a crash leaves either the old or the
+      new data file in place. A new data file with an old index file is detected by the discarded count mismatch,
+      and gets the index rebuilt on the next open."""
+      fn_tmp = self.fn + self.TMP_SUFFIX
+      fn_idx = self.fn + self.IDX_SUFFIX
+      fn_idx_tmp = fn_idx + self.TMP_SUFFIX
+      f_new = _get_locked_file(fn_tmp, 'w+b')
+      f_new.truncate()
+      f_new.write(self.DATA_HEADER.pack(self.DATA_MAGIC, self.DATA_VERSION, drc))
+      data_start = f_new.tell()
+      
+      idx_data = [self.IDX_HEADER.pack(self.IDX_MAGIC, self.IDX_VERSION, drc, drc, self._evicted)]
+      off = data_start
+      data = []
+      for record in records:
+         frame = self._frame_record(record)
+         idx_data.append(self.IDX_ENTRY.pack(getattr(record, 'ts', 0), off))
+         data.append(frame)
+         off += len(frame)
+      f_new.write(b''.join(data))
+      f_new.flush()
+      os.fsync(f_new.fileno())
+      
+      f_idx_new = open(fn_idx_tmp, 'w+b')
+      f_idx_new.write(b''.join(idx_data))
+      f_idx_new.flush()
+      os.fsync(f_idx_new.fileno())
+      
+      os.rename(fn_tmp, self.fn)
+      os.rename(fn_idx_tmp, fn_idx)
+      _fsync_dir(os.path.dirname(self.fn))
+      self.f.close()
+      if not (self.f_idx is None):
+         self.f_idx.close()
+      
+      self.f = f_new
+      self.f_idx = f_idx_new
+      self._legacy = False
+      self._file_drc = self._discarded_record_count = drc
+      self._buffered_record_count = len(idx_data) - 1
+      self._data_start = data_start
+      self._data_end = f_new.tell()
+      self._ts_last_use = time.time()
+   
+   def _discard_data(self, target_drc, evicted=False):
+      """Discard records before record count target_drc; if evicted is set, note them as evicted for quota."""
       off = target_drc - self._discarded_record_count
       if (off <= 0):
          return
@@ -376,25 +970,21 @@ class BacklogFile(LogFile):
          raise ValueError("Can't discard {0} records from file {1!a}({2}) having {3} (tdrc: {4} drc: {5}).".format(
             off, self.f, self.f.fileno(), self._buffered_record_count, target_drc, self._discarded_record_count))
       
-      fn_tmp = self.fn + b'.tmp'
-      f_old = self.f
-      f_new = _get_locked_file(fn_tmp, 'w+b')
-      
-      sdb_new = off
-      pickler_new = pickle.Pickler(f_new)
-      pickler_new.dump(target_drc)
-      for record in self.get_records(off+1):
-         pickler_new.dump(record)
+      if (evicted):
+         self._evicted += off
+      else:
+         self._evicted = 0
       
-      os.rename(fn_tmp, self.fn)
-      f_new.flush()
-      self.f.close()
-      self._buffered_record_count -= off
       self._discarded_record_count = target_drc
-      
-      self.f = f_new
-      self.p = pickler_new
+      self._buffered_record_count -= off
       self._ts_last_use = time.time()
+      
+      live_start = self._get_live_start()
+      if ((self._buffered_record_count == 0) or
+          (live_start - self._data_start >= max(self.compact_min, self._data_end - live_start))):
+         self._rewrite(target_drc, self._read_records(0, self._buffered_record_count))
+      else:
+         self._write_idx_header()
 
    def clear_records(self):
       data_off = self._discarded_record_count + self._buffered_record_count
@@ -406,10 +996,13 @@ class RawLogFile(LogFile):
       self.fn = fn
       self.utc = utc
       self.time_fmt = time_fmt
+      if (time_fmt is None):
+         time_fmt = LogEntry.TS_FMT_DEFAULT
+      self._tsc = _TSFormatCache(time_fmt, utc)
       super().__init__(fn)
    
    def format_record(self, r):
-      rv_l = [r.get_time_str(self.time_fmt, utc=self.utc).encode('ascii'), b' ']
+      rv_l = [self._tsc.format(r.ts).encode('ascii'), b' ']
       if (isinstance(r, LogLine)):
          if (r.outgoing):
             rv_l.append(b'< ')
@@ -481,115 +1074,441 @@ class LogFilter:
       return True
 
 
-class _Logger:
-   # cmds that don't go to a chan, but should be logged to the same context
-   BC_AUXILIARY = (b'NICK', b'QUIT')
-   logger = logging.getLogger('_Logger')
-   log = logger.log
-   maintenance_delay = 60
-   file_timeout = 60
+class LogWriter:
+   """Worker thread performing log file I/O outside of the event loop thread.
    
-   def __init__(self, basedir, nc, filter=None):
-      if (filter is None):
-         filter = LogFilter()
-      self.basedir = basedir
-      self.nc = nc
-      self.filter = filter
-      self._storage = {}
-      self.maintenance_timer = None
-      self._ems_reg()
+   Operations are executed in the order they were queued. The queue is bounded; 'overflow' specifies what to do when it
+   runs full: 'block' makes the caller wait for the worker to catch up, 'drop_oldest' discards the oldest queued log
+   record (operations that aren't plain log record writes are never dropped)."""
+   logger = logging.getLogger('LogWriter')
+   log = logger.log
    
-   def _ems_reg(self):
-      self.nc.em_in_msg.new_prio_listener(self._process_msg_in, 1)
-      self.nc.em_out_msg.new_prio_listener(self._process_msg_out, -512)
-      self.nc.em_shutdown.new_prio_listener(self._process_conn_shutdown, -512)
-      self.nc.sa.ed.em_shutdown.new_listener(self._process_process_shutdown)
+   OVERFLOW_POLICIES = ('block', 'drop_oldest')
    
-   def _do_maintenance(self):
-      now = time.time()
-      for (ctx,f) in tuple(self._storage.items()):
-         delta = now - f._ts_last_use
-         if (delta < 0):
-            self.log(30, 'File allegedly last accessed {0} seconds into the future; negative clock warp?'.format(-1*delta))
-         elif (delta < self.file_timeout):
-            continue
-         f.close()
-         del(self._storage[ctx])
+   def __init__(self, queue_max=4096, overflow='block'):
+      if (queue_max < 1):
+         raise ValueError('Invalid queue size {0!a}; need at least 1.'.format(queue_max))
+      if not (overflow in self.OVERFLOW_POLICIES):
+         raise ValueError('Unknown overflow policy {0!a}; valid values are {1!a}.'.format(overflow, self.OVERFLOW_POLICIES))
+      
+      self.queue_max = queue_max
+      self.overflow = overflow
+      self._queue = collections.deque()
+      self._cond = threading.Condition()
+      self._busy = False
+      self._thread = None
       
-      if not (self._storage):
-         self.maintenance_timer.cancel()
-         self.maintenance_timer = None
+      self.depth_max = 0
+      self.drop_count = 0
+      self.block_count = 0
+      self.op_count = 0
+      self.op_time_total = 0
+      self.op_time_max = 0
    
-   def _shedule_maintenance(self):
-      if not (self.maintenance_timer is None):
-         return
-      self.maintenance_timer = self.nc.sa.ed.set_timer(self.maintenance_delay,
-         self._do_maintenance, persist=True)
+   def _start(self):
+      # We start the thread lazily, since the config is loaded before we daemonize; threads don't survive the fork.
+      self._thread = threading.Thread(target=self._work, name='luteus log writer', daemon=True)
+      self._thread.start()
    
-   def _get_file(self, chan):
-      try:
-         rv = self._storage[chan]
-      except KeyError:
-         rv = self.make_file(self._get_fn(chan))
-         self._storage[chan] = rv
-         self._shedule_maintenance()
-      
-      return rv
+   def put(self, func, *args, droppable=False):
+      """Queue func(*args) for execution on the worker thread."""
+      with self._cond:
+         if (self._thread is None):
+            self._start()
+         
+         q = self._queue
+         while (len(q) >= self.queue_max):
+            if ((self.overflow == 'drop_oldest') and q[0][2]):
+               q.popleft()
+               self.drop_count += 1
+               continue
+            self.block_count += 1
+            self._cond.wait()
+         
+         q.append((func, args, droppable))
+         if (len(q) > self.depth_max):
+            self.depth_max = len(q)
+         self._cond.notify_all()
    
-   def _put_record_file(self, ctx, r):
-      if not (self.filter(ctx, r)):
+   def sync(self):
+      """Wait until all queued operations have been executed."""
+      if (threading.current_thread() is self._thread):
          return
-      
-      self._get_file(ctx).put_record(r)
+      with self._cond:
+         while (self._queue or self._busy):
+            self._cond.wait()
    
-   def _process_process_shutdown(self):
-      r = LogProcessShutdown()
-      channels = self.nc.get_channels(stale=True)
-      if not (channels is None):
-         for chan in channels:
-            self._put_record_file(chan, r)
-      for f in self._storage.values():
-         f.close()
-      self._storage.clear()
-
-   def _process_conn_shutdown(self):
-      r = LogConnShutdown(self.nc.get_peer_address(stale=True))
-      for chan in self.nc.get_channels(stale=True):
-         self._put_record_file(chan, r)
+   def _work(self):
+      q = self._queue
+      cond = self._cond
+      while (True):
+         with cond:
+            while not (q):
+               self._busy = False
+               cond.notify_all()
+               cond.wait()
+            (func, args, droppable) = q.popleft()
+            self._busy = True
+            cond.notify_all()
+         
+         ts_start = time.time()
+         try:
+            func(*args)
+         except Exception:
+            self.log(40, '{0} caught exception in call {1!a}(*{2!a}):'.format(self, func, args), exc_info=True)
+         dt = time.time() - ts_start
+         
+         with cond:
+            self.op_count += 1
+            self.op_time_total += dt
+            if (dt > self.op_time_max):
+               self.op_time_max = dt
    
-   def _get_src(self, msg, outgoing):
-      src = msg.prefix
-      if (src is None):
-         if (outgoing):
-            src = self.nc.get_self_nick()
+   def get_stats(self):
+      """Return dict of queue and latency statistics."""
+      with self._cond:
+         if (self.op_count):
+            op_time_avg = self.op_time_total/self.op_count
          else:
-            src = self.nc.get_peer()
-            if (src is None):
-               src = b'?'
-            src = msg.pcs.make_irc_addr(src)
-            src.type = IA_SERVER
-      return src
+            op_time_avg = 0
+         
+         return dict(
+            depth=len(self._queue),
+            depth_max=self.depth_max,
+            drops=self.drop_count,
+            blocks=self.block_count,
+            ops=self.op_count,
+            op_time_avg=op_time_avg,
+            op_time_max=self.op_time_max
+         )
+
+
+class LogFilePool:
+   """Process-wide limit on the number of open log files, shared by all loggers.
    
-   def _process_msg_in(self, msg):      
-      self._process_msg(msg, False)
+   Files are tracked in least-recently-used order; when opening a file would exceed the limit, the least recently used
+   ones are closed. Files of loggers executing their file operations in a different thread than the one doing the
+   opening are closed by their owner the next time it touches its files, instead."""
+   def __init__(self, max_open=256):
+      self.max_open = max_open
+      self._files = collections.OrderedDict()
+      self._evicted = set()
+      self._lock = threading.Lock()
       
-   def _process_msg_out(self, msg):
-      self._process_msg(msg, True)
+      self.open_count = 0
+      self.reopen_count = 0
+      self.evict_count = 0
    
-   def _preprocess_in_msg(self, msg):
-      if (not (msg.command in (b'PRIVMSG', b'NOTICE'))):
-         return msg
-      if (len(msg.parameters) < 2):
-         return msg
-      
-      
-      text = msg.parameters[1]
-      (tf, ctcps) = msg.split_ctcp()
+   def set_max_open(self, max_open):
+      """Set maximum number of simultaneously open files. Takes effect on the next file open."""
+      if (max_open < 1):
+         raise ValueError('Invalid open file limit {0!a}; need at least 1.'.format(max_open))
+      self.max_open = max_open
+   
+   def add(self, logger, ctx):
+      """Register newly opened file, and evict LRU files as necessary."""
+      key = (logger, ctx)
+      evict = []
+      with self._lock:
+         self._files[key] = None
+         self.open_count += 1
+         if (key in self._evicted):
+            self._evicted.remove(key)
+            self.reopen_count += 1
+         
+         while (len(self._files) > self.max_open):
+            (key_old, _) = self._files.popitem(last=False)
+            self._evicted.add(key_old)
+            self.evict_count += 1
+            evict.append(key_old)
       
-      for ctcp in ctcps:
-         if (not ctcp.startswith(b'ACTION')):
-            ctcp_like = True
-            break
+      for (logger_old, ctx_old) in evict:
+         if (logger_old.writer is logger.writer):
+            logger_old._drop_file(ctx_old)
+         else:
+            logger_old._queue_file_drop(ctx_old)
+   
+   def touch(self, logger, ctx):
+      """Mark file as most recently used."""
+      with self._lock:
+         try:
+            self._files.move_to_end((logger, ctx))
+         except KeyError:
+            pass
+   
+   def remove(self, logger, ctx):
+      """Unregister file closed by its owner."""
+      with self._lock:
+         self._files.pop((logger, ctx), None)
+   
+   def get_stats(self):
+      with self._lock:
+         return dict(
+            open=len(self._files),
+            max_open=self.max_open,
+            opens=self.open_count,
+            reopens=self.reopen_count,
+            evictions=self.evict_count
+         )
+
+log_file_pool = LogFilePool()
+
+
+class LogRotation:
+   """Rotation policy for text logs.
+   
+   daily: start a new file every day (at midnight UTC if utc is set, else local time)
+   max_bytes: start a new file once the current one has reached this size
+   compress: compression to apply to rotated files; None, 'gzip' or 'xz'
+   
+   Rotated files are renamed to <file>\\x07<time of their last record>, compressed on the log_archiver thread, and
+   listed in the network's LogManifest."""
+   COMPRESSORS = {'gzip': b'.gz', 'xz': b'.xz'}
+   
+   def __init__(self, daily=True, max_bytes=None, compress='gzip', utc=False):
+      if not ((compress is None) or (compress in self.COMPRESSORS)):
+         raise ValueError('Unknown compression {0!a}; valid values are None and {1!a}.'.format(compress,
+            tuple(self.COMPRESSORS)))
+      self.daily = daily
+      self.max_bytes = max_bytes
+      self.compress = compress
+      self.utc = utc
+   
+   def get_period_end(self, ts):
+      """Return time at which a file with records starting at ts is due for rotation by date, or None."""
+      if not (self.daily):
+         return None
+      if (self.utc):
+         import calendar
+         tt = time.gmtime(ts)
+         return calendar.timegm((tt.tm_year, tt.tm_mon, tt.tm_mday + 1, 0, 0, 0, 0, 0, 0))
+      tt = time.localtime(ts)
+      return time.mktime((tt.tm_year, tt.tm_mon, tt.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+   
+   def is_due(self, f, ts):
+      """Return whether file f should be rotated before writing a record with timestamp ts to it."""
+      if ((not (self.max_bytes is None)) and (f.get_size() >= self.max_bytes)):
+         return True
+      return ((not (f.rotate_at is None)) and (ts >= f.rotate_at))
+
+
+class LogManifest:
+   """List of rotated log files in one network log directory.
+   
+   This is kept in a text file with one line per rotated file, holding the fields
+     <start> <end> <context file name> <archive file name>
+   separated by spaces (which can't occur in context names). start and end are the unix times delimiting the
+   records in the archive; start is 0 if unknown. Tools can use this to find the archives covering a time range without
+   opening all of them."""
+   logger = logging.getLogger('LogManifest')
+   log = logger.log
+   SEP = b' '
+   
+   def __init__(self, fn):
+      self.fn = fn
+      self.dn = os.path.dirname(fn)
+      self.entries = []
+      self._lock = threading.Lock()
+      self._load()
+   
+   def _load(self):
+      try:
+         f = open(self.fn, 'rb')
+      except EnvironmentError:
+         return
+      with f:
+         for line in f:
+            try:
+               (start, end, ctx_fn, afn) = line.rstrip(b'\n').split(self.SEP)
+               self.entries.append([float(start), float(end), ctx_fn, afn])
+            except ValueError:
+               self.log(30, 'Ignoring bad line {0!a} in log manifest {1!a}.'.format(line, self.fn))
+   
+   def _write(self):
+      if (self.dn):
+         os.makedirs(self.dn, exist_ok=True)
+      fn_tmp = self.fn + b'.tmp'
+      f = open(fn_tmp, 'wb')
+      for (start, end, ctx_fn, afn) in self.entries:
+         f.write(self.SEP.join((repr(start).encode('ascii'), repr(end).encode('ascii'), ctx_fn, afn)) + b'\n')
+      f.close()
+      os.rename(fn_tmp, self.fn)
+   
+   def add(self, ctx_fn, end, afn):
+      """Add archive afn holding records of context file ctx_fn up to time end."""
+      with self._lock:
+         start = max([e[1] for e in self.entries if (e[2] == ctx_fn)], default=0)
+         self.entries.append([start, end, ctx_fn, afn])
+         self._write()
+   
+   def find(self, ctx_fn, after=None, before=None):
+      """Return paths of archives of ctx_fn that may hold records in the specified time range."""
+      with self._lock:
+         return [os.path.join(self.dn, afn) for (start, end, c, afn) in self.entries if ((c == ctx_fn) and
+            ((after is None) or (end >= after)) and ((before is None) or (start < before)))]
+   
+   def get_uncompressed(self):
+      with self._lock:
+         return [e[3] for e in self.entries if not (e[3].endswith(tuple(LogRotation.COMPRESSORS.values())))]
+   
+   def compress(self, afn, method):
+      """Compress archive file afn and update our entry for it. Blocks for a while; run this on log_archiver."""
+      if (method == 'xz'):
+         import lzma
+         opener = lzma.open
+      else:
+         import gzip
+         opener = gzip.open
+      
+      import shutil
+      path = os.path.join(self.dn, afn)
+      cfn = afn + LogRotation.COMPRESSORS[method]
+      cpath = os.path.join(self.dn, cfn)
+      if (os.path.exists(path)):
+         with open(path, 'rb') as f_in, opener(cpath + b'.tmp', 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+         os.rename(cpath + b'.tmp', cpath)
+      elif not (os.path.exists(cpath)):
+         self.log(30, 'Rotated log file {0!a} has gone missing.'.format(path))
+         return
+      
+      with self._lock:
+         for e in self.entries:
+            if (e[3] == afn):
+               e[3] = cfn
+         self._write()
+      if (os.path.exists(path)):
+         os.unlink(path)
+
+# Worker thread compressing rotated log files.
+log_archiver = LogWriter(queue_max=65536)
+
+
+class LogRoute:
+   """Logging contexts and records for one message.
+   
+   These are computed once per message by the LogRouter and shared by all loggers of the network; the records must not
+   be modified by their consumers."""
+   __slots__ = ('is_aux', 'chan_puts', 'nicks', 'nick_record', '_puts')
+   def __init__(self, is_aux, chan_puts, nicks, nick_record):
+      self.is_aux = is_aux
+      self.chan_puts = chan_puts
+      self.nicks = nicks
+      self.nick_record = nick_record
+      self._puts = {}
+   
+   def get_puts(self, map_nick_ctxs):
+      """Return (contexts, [(context, record), ...]), with nick contexts mapped through map_nick_ctxs."""
+      key = getattr(map_nick_ctxs, '__func__', map_nick_ctxs)
+      try:
+         return self._puts[key]
+      except KeyError:
+         pass
+      
+      puts = list(self.chan_puts)
+      ctxs = set(ctx for (ctx, r) in puts)
+      if (self.nicks):
+         nicks = map_nick_ctxs(self.nicks)
+         ctxs.update(nicks)
+         puts.extend((nick, self.nick_record) for nick in nicks)
+      
+      rv = self._puts[key] = (ctxs, puts)
+      return rv
+
+
+class LogRouter:
+   """Routing stage shared by all loggers of one network link.
+   
+   Determines logging contexts and records once per message, and passes the resulting LogRoute to each attached logger.
+   Loggers with route_raw set get records of incoming messages without freenode message prefix mangling removed; the
+   routing for these is only done separately for messages that were actually changed by that."""
+   logger = logging.getLogger('LogRouter')
+   log = logger.log
+   # cmds that don't go to a chan, but should be logged to the same context
+   BC_AUXILIARY = (b'NICK', b'QUIT')
+   
+   def __init__(self, nc):
+      self.nc = nc
+      self.loggers = []
+      nc.em_in_msg.new_prio_listener(self._process_msg_in, 1)
+      nc.em_out_msg.new_prio_listener(self._process_msg_out, -512)
+   
+   @classmethod
+   def get(cls, nc):
+      """Return router of network link nc, making it if necessary."""
+      if (nc.log_router is None):
+         nc.log_router = cls(nc)
+      return nc.log_router
+   
+   def add_logger(self, logger):
+      self.loggers.append(logger)
+   
+   def _process_msg_in(self, msg):
+      self._process_msg(msg, False)
+   
+   def _process_msg_out(self, msg):
+      self._process_msg(msg, True)
+   
+   def _process_msg(self, msg_orig, outgoing):
+      if not (self.loggers):
+         return
+      route = self.route_msg(msg_orig, outgoing)
+      for logger in self.loggers:
+         if (logger.route_raw):
+            logger._process_route(self.route_msg(msg_orig, outgoing, True))
+         else:
+            logger._process_route(route)
+   
+   def route_msg(self, msg_orig, outgoing, raw=False):
+      """Return LogRoute for message.
+      
+      Routes are kept on the message, so they're only computed once for all loggers and backloggers seeing it."""
+      routes = msg_orig.log_routes
+      if (routes is None):
+         routes = msg_orig.log_routes = {}
+      key = (outgoing, raw)
+      try:
+         return routes[key]
+      except KeyError:
+         pass
+      
+      if (outgoing or raw):
+         msg = msg_orig
+      else:
+         msg = self._preprocess_in_msg(msg_orig)
+      rv = routes[key] = self._route_msg(msg_orig, msg, outgoing)
+      if ((msg is msg_orig) and (outgoing or not raw)):
+         # Preprocessing didn't change anything, so the other variant is the same.
+         routes[(outgoing, not raw)] = rv
+      return rv
+   
+   def _get_src(self, msg, outgoing):
+      src = msg.prefix
+      if (src is None):
+         if (outgoing):
+            src = self.nc.get_self_nick()
+         else:
+            src = self.nc.get_peer()
+            if (src is None):
+               src = b'?'
+            src = msg.pcs.make_irc_addr(src)
+            src.type = IA_SERVER
+      return src
+   
+   def _preprocess_in_msg(self, msg):
+      if (not (msg.command in (b'PRIVMSG', b'NOTICE'))):
+         return msg
+      if (len(msg.parameters) < 2):
+         return msg
+      
+      
+      text = msg.parameters[1]
+      (tf, ctcps) = msg.split_ctcp()
+      
+      for ctcp in ctcps:
+         if (not ctcp.startswith(b'ACTION')):
+            ctcp_like = True
+            break
       else:
          ctcp_like = False
       
@@ -605,17 +1524,8 @@ class _Logger:
             self.log(40, "{} got message {} from {}, which doesn't appear to have undergone freenode prefix mangling even though we expected it. This is ok for this message, but indicates a desync that will most likely lead to silent data corruption elsewhere. FIX THIS!".format(self, msg, self.nc))
       return msg
 
-   @classmethod
-   def _map_nick_ctxs(cls, ctx_s):
-      return ctx_s
-
-   def _process_msg(self, msg_orig, outgoing):
-      rv = set()
-      if (not outgoing):
-         msg = self._preprocess_in_msg(msg_orig)
-      else:
-         msg = msg_orig
-      
+   def _route_msg(self, msg_orig, msg, outgoing):
+      chan_puts = []
       src = self._get_src(msg, outgoing)
       msg2 = msg.copy()
       msg2.src = None
@@ -648,26 +1558,215 @@ class _Logger:
          elif (num == 353):
             chans.append(make_cib(msg.parameters[2]))
       
-      if (chans):
-         rv.update(chans)
-         for chan in chans:
-            self._put_record_file(chan, bll)
+      for chan in chans:
+         chan_puts.append((chan, bll))
       
       if (nicks):
-         nicks = self._map_nick_ctxs(nicks)
-         rv.update(nicks)
          bll_nick = NickLogLine(msg2, src, outgoing)
-         for nick in nicks:
-            self._put_record_file(nick, bll_nick)
+      else:
+         bll_nick = None
       
       is_aux = (msg.command in self.BC_AUXILIARY)
       if (is_aux and (not outgoing)):
          # Log non-channel commands to chan contexts: NICK and QUIT
          for chan in msg_orig.affected_channels:
-            rv.add(chan.name)
-            self._put_record_file(chan.name, bll)
+            chan_puts.append((chan.name, bll))
       
-      return (is_aux, rv)
+      return LogRoute(is_aux, chan_puts, nicks, bll_nick)
+
+
+class _Logger:
+   logger = logging.getLogger('_Logger')
+   log = logger.log
+   maintenance_delay = 60
+   file_timeout = 60
+   # Whether records may be dropped by our writer on queue overflow.
+   records_droppable = True
+   file_pool = log_file_pool
+   # Whether we want records of incoming messages as received, instead of with message prefix mangling removed.
+   route_raw = False
+   
+   def __init__(self, basedir, nc, filter=None, writer=None):
+      if (filter is None):
+         filter = LogFilter()
+      self.basedir = basedir
+      self.nc = nc
+      self.filter = filter
+      self.writer = writer
+      # Open files by context, in LRU order. If we have a writer, this belongs to its thread.
+      self._storage = collections.OrderedDict()
+      self._drops_pending = set()
+      self._drops_lock = threading.Lock()
+      # Exceptions raised by file operations on our writer thread, to be re-raised on the event loop
+      self._write_errors = collections.deque()
+      self.maintenance_timer = None
+      # When we last queued a file operation
+      self._ts_active = 0
+      if not (nc is None):
+         nc.loggers.append(self)
+      self._ems_reg()
+   
+   def _ems_reg(self):
+      LogRouter.get(self.nc).add_logger(self)
+      self.nc.em_shutdown.new_prio_listener(self._process_conn_shutdown, -512)
+      self.nc.sa.ed.em_shutdown.new_listener(self._process_process_shutdown)
+   
+   def _run(self, func, *args, droppable=False):
+      """Execute file operation, on our writer thread if we have one."""
+      if (self.writer is None):
+         func(*args)
+      else:
+         self._check_write_errors()
+         self.writer.put(self._run_queued, func, *args, droppable=droppable)
+   
+   def _run_queued(self, func, *args):
+      try:
+         func(*args)
+      except Exception as exc:
+         self._write_errors.append(exc)
+         raise
+   
+   def _check_write_errors(self):
+      """Re-raise the first exception from a file operation run on our writer thread since the last call."""
+      if (not self._write_errors) or (threading.current_thread() is self.writer._thread):
+         return
+      exc = self._write_errors.popleft()
+      if (self._write_errors):
+         self.log(30, '{0} dropping {1} further file operation failures.'.format(self, len(self._write_errors)))
+         self._write_errors.clear()
+      raise exc
+   
+   def _sync(self):
+      """Wait for all file operations queued so far to finish."""
+      if not (self.writer is None):
+         self.writer.sync()
+         self._check_write_errors()
+   
+   def get_open_count(self):
+      """Return number of files we have open."""
+      self._sync()
+      return len(self._storage)
+   
+   def _do_maintenance(self):
+      if (time.time() - self._ts_active < self.file_timeout):
+         self._run(self._close_idle_files)
+         return
+      # We haven't queued any file operations for a while, so all of our files are idle. Close them, and stop doing
+      # maintenance until they're used again.
+      self._run(self._close_files)
+      self.maintenance_timer.cancel()
+      self.maintenance_timer = None
+   
+   def _close_idle_files(self):
+      self._process_file_drops()
+      now = time.time()
+      while (self._storage):
+         (ctx, f) = next(iter(self._storage.items()))
+         delta = now - f._ts_last_use
+         if (delta < 0):
+            self.log(30, 'File allegedly last accessed {0} seconds into the future; negative clock warp?'.format(-1*delta))
+         elif (delta < self.file_timeout):
+            break
+         self._close_file(ctx)
+   
+   def _drop_file(self, ctx):
+      """Close file for ctx, if open."""
+      f = self._storage.pop(ctx, None)
+      if not (f is None):
+         f.close()
+   
+   def _close_file(self, ctx):
+      self._drop_file(ctx)
+      self.file_pool.remove(self, ctx)
+   
+   def _queue_file_drop(self, ctx):
+      """Ask for file to be closed on our next file operation; safe to call from any thread."""
+      with self._drops_lock:
+         self._drops_pending.add(ctx)
+   
+   def _process_file_drops(self):
+      if not (self._drops_pending):
+         return
+      with self._drops_lock:
+         ctxs = tuple(self._drops_pending)
+         self._drops_pending.clear()
+      for ctx in ctxs:
+         self._drop_file(ctx)
+   
+   def _shedule_maintenance(self):
+      self._ts_active = time.time()
+      if not (self.maintenance_timer is None):
+         return
+      self.maintenance_timer = self.nc.sa.ed.set_timer(self.maintenance_delay,
+         self._do_maintenance, persist=True)
+   
+   def _get_file(self, chan):
+      self._process_file_drops()
+      try:
+         rv = self._storage[chan]
+      except KeyError:
+         rv = self.make_file(self._get_fn(chan))
+         self._storage[chan] = rv
+         self.file_pool.add(self, chan)
+      else:
+         self._storage.move_to_end(chan)
+         self.file_pool.touch(self, chan)
+      
+      rv._ts_last_use = time.time()
+      return rv
+   
+   def _put_record_file(self, ctx, r):
+      if not (self.filter(ctx, r)):
+         return False
+      
+      self._shedule_maintenance()
+      self._run(self._write_record, ctx, r, droppable=self.records_droppable)
+      return True
+   
+   def _write_record(self, ctx, r):
+      self._get_file(ctx).put_record(r)
+   
+   def _close_files(self):
+      for ctx in tuple(self._storage):
+         self._close_file(ctx)
+   
+   def _process_process_shutdown(self):
+      r = LogProcessShutdown()
+      channels = self.nc.get_channels(stale=True)
+      if not (channels is None):
+         for chan in channels:
+            self._put_record_file(chan, r)
+      self._run(self._close_files)
+      self._sync()
+
+   def _process_conn_shutdown(self):
+      r = LogConnShutdown(self.nc.get_peer_address(stale=True))
+      for chan in self.nc.get_channels(stale=True):
+         self._put_record_file(chan, r)
+   
+   def _process_route(self, route):
+      """Write records for a LogRoute; returns (is_aux, contexts)."""
+      (rv, puts) = route.get_puts(self._map_nick_ctxs)
+      for (ctx, r) in puts:
+         self._put_record_file(ctx, r)
+      return (route.is_aux, rv)
+   
+   @classmethod
+   def _map_nick_ctxs(cls, ctx_s):
+      return ctx_s
+   
+   def _route_msg(self, msg_orig, outgoing):
+      """Determine logging contexts and records for message; returns (is_aux, contexts, [(context, record), ...])."""
+      route = LogRouter.get(self.nc).route_msg(msg_orig, outgoing, self.route_raw)
+      (rv, puts) = route.get_puts(self._map_nick_ctxs)
+      return (route.is_aux, rv, puts)
+   
+   def _process_msg(self, msg_orig, outgoing):
+      return self._process_route(LogRouter.get(self.nc).route_msg(msg_orig, outgoing, self.route_raw))
+   
+   def _get_meta_fn(self, name):
+      """Return filename for non-context data of this logger."""
+      return os.path.join(self.basedir, self.nc.netname.encode(), name + b'\x07')
    
    def _get_fn(self, ctx):
       if (ctx is None):
@@ -677,20 +1776,68 @@ class _Logger:
       return os.path.join(self.basedir, self.nc.netname.encode(), ctx)
 
 
-class RawLogger(_Logger):
+class _TextLogger(_Logger):
+   """Base class for loggers writing text files, which can be rotated according to a LogRotation policy."""
+   def __init__(self, *args, rotation=None, **kwargs):
+      self.rotation = rotation
+      super().__init__(*args, **kwargs)
+      if (rotation is None):
+         return
+      
+      self.manifest = LogManifest(self._get_meta_fn(b'manifest'))
+      if not (rotation.compress is None):
+         # Compress files whose compression didn't finish before the last shutdown.
+         for afn in self.manifest.get_uncompressed():
+            log_archiver.put(self.manifest.compress, afn, rotation.compress)
+   
+   def _write_record(self, ctx, r):
+      f = self._get_file(ctx)
+      rot = self.rotation
+      if not (rot is None):
+         if (f.rotate_at is None):
+            if (f.get_size()):
+               f.rotate_at = rot.get_period_end(f.get_mtime())
+            else:
+               f.rotate_at = rot.get_period_end(r.ts)
+         if (rot.is_due(f, r.ts)):
+            self._rotate_file(ctx, f)
+            f = self._get_file(ctx)
+            f.rotate_at = rot.get_period_end(r.ts)
+      f.put_record(r)
+   
+   def _rotate_file(self, ctx, f):
+      fn = f.fn
+      end = f.ts_last_record
+      if (end is None):
+         end = f.get_mtime()
+      self._close_file(ctx)
+      
+      afn_base = b''.join((fn, b'\x07', time.strftime('%Y%m%dT%H%M%S', time.gmtime(end)).encode('ascii')))
+      afn = afn_base
+      i = 1
+      while (os.path.exists(afn) or any(os.path.exists(afn + s) for s in LogRotation.COMPRESSORS.values())):
+         afn = afn_base + '-{0}'.format(i).encode('ascii')
+         i += 1
+      
+      os.rename(fn, afn)
+      afn = os.path.basename(afn)
+      self.manifest.add(os.path.basename(fn), end, afn)
+      if not (self.rotation.compress is None):
+         log_archiver.put(self.manifest.compress, afn, self.rotation.compress)
+
+
+class RawLogger(_TextLogger):
+   route_raw = True
    def __init__(self, *args, utc=True, time_fmt=None, **kwargs):
       self.utc = utc
       self.time_fmt = time_fmt
       super().__init__(*args, **kwargs)
    
-   def _preprocess_in_msg(self, msg):
-      return msg
-   
    def make_file(self, fn):
       return RawLogFile(fn, self.utc, self.time_fmt)
 
 
-class HRLogger(_Logger):
+class HRLogger(_TextLogger):
    def __init__(self, formatter, *args, **kwargs):
       if (formatter is None):
          raise Exception
@@ -701,71 +1848,586 @@ class HRLogger(_Logger):
       return HRLogFile(fn, self.formatter)
 
 
-class BackLogger(_Logger):
-   make_file = BacklogFile
-   def __init__(self, basedir, bnc, *args, **kwargs):
-      self.bnc = bnc
-      super().__init__(basedir, bnc.nc, *args, **kwargs)
+class SearchLogger(_Logger):
+   """Logger feeding msglike lines into a per-network full-text search index.
+   
+   Index writes are batched, and done on our writer thread if we have one; queued lines are flushed on maintenance.
+   If the index can't be set up (e.g. because the sqlite3 library lacks FTS5), index is None and we do nothing."""
+   maintenance_delay = 8
+   
+   def __init__(self, basedir, nc, *args, batch_size=256, **kwargs):
+      import sqlite3
+      from .log_search import LogSearchIndex
+      fn = os.path.join(basedir, nc.netname.encode(), b'search.sqlite')
+      try:
+         self.index = LogSearchIndex(fn, batch_size=batch_size)
+      except sqlite3.OperationalError as exc:
+         self.log(40, 'Failed to set up search index {0!a}: {1}; log search is disabled.'.format(fn, exc))
+         self.index = None
+      super().__init__(basedir, nc, *args, **kwargs)
+   
+   def _do_maintenance(self):
+      self._run(self.index.flush)
+      self.maintenance_timer.cancel()
+      self.maintenance_timer = None
+   
+   def _put_record_file(self, ctx, r):
+      if (self.index is None):
+         return False
+      return super()._put_record_file(ctx, r)
+   
+   def _write_record(self, ctx, r):
+      if not (isinstance(r, LogLine) and r.is_msglike() and (len(r.msg.parameters) > 1)):
+         return
+      
+      text = r.msg.parameters[1]
+      if (text.startswith(b'\x01ACTION ')):
+         text = b'* ' + text[8:].rstrip(b'\x01')
+      
+      src = r.src
+      if (isinstance(src, IRCAddress) and src.is_nick()):
+         src = src.nick
+      if (isinstance(src, IRCCIString)):
+         src = src.normalize()
+      
+      if not (ctx is None):
+         ctx = ctx.normalize()
+      self.index.add(r.ts, ctx, bytes(src), text.decode('utf-8', 'replace'))
+   
+   def _close_files(self):
+      if not (self.index is None):
+         self.index.flush()
+   
+   def search(self, *args, **kwargs):
+      return self.index.search(*args, **kwargs)
+
+
+class BacklogQuota:
+   """Backlog size limits; each of them can be None for no limit.
+   
+   ctx_records, ctx_bytes, ctx_age: maximum number of records, bytes and age (in seconds) of backlog per context
+   total_bytes: maximum number of bytes of backlog over all contexts of a backlogger
+   
+   Limits are enforced when records are written, by evicting the oldest records of the context written to or, for
+   total_bytes, of the largest context. Byte limits count the data of records still in backlog; until they are
+   compacted, files also hold evicted data of up to the larger of that size and BacklogFile.compact_min."""
+   def __init__(self, ctx_records=None, ctx_bytes=None, ctx_age=None, total_bytes=None):
+      self.ctx_records = ctx_records
+      self.ctx_bytes = ctx_bytes
+      self.ctx_age = ctx_age
+      self.total_bytes = total_bytes
+
+
+class _PickledState:
+   """Small dict of backlog metadata, kept in a pickle file."""
+   logger = logging.getLogger('_PickledState')
+   log = logger.log
+   desc = 'state'
+   
+   def __init__(self, fn):
+      self.fn = fn
+      self.data = {}
+      # Whether data has changed since we last wrote it out
+      self.dirty = False
+      self._load()
+   
+   def _load(self):
+      try:
+         f = open(self.fn, 'rb')
+      except EnvironmentError:
+         return
+      try:
+         self.data = pickle.load(f)
+      except Exception:
+         self.log(40, 'Failed to load {0} from {1!a}; starting over:'.format(self.desc, self.fn), exc_info=True)
+      f.close()
+   
+   @staticmethod
+   def _write(fn, data):
+      dn = os.path.dirname(fn)
+      if (dn):
+         os.makedirs(dn, exist_ok=True)
+      fn_tmp = fn + b'.tmp'
+      f = open(fn_tmp, 'wb')
+      pickle.dump(data, f)
+      f.close()
+      os.rename(fn_tmp, fn)
+   
+   def get_state(self):
+      """Return copy of our data suitable for passing to _write() from another thread."""
+      return dict(self.data)
+
+
+class BacklogFloors(_PickledState):
+   """Per-context record counts (as counted by _get_dcb()) below which a backlogger has discarded records from a
+   shared store."""
+   desc = 'backlog floors'
+   
+   def get(self, ctx):
+      return self.data.get(ctx, 0)
+   
+   def advance(self, ctx, dcb):
+      """Raise floor for ctx to dcb; returns whether it changed."""
+      if (self.get(ctx) >= dcb):
+         return False
+      self.data[ctx] = dcb
+      self.dirty = True
+      return True
+
+
+class BacklogCursors(_PickledState):
+   """Per-client-identity delivery cursors for a backlog.
+   
+   For each registered identity and context, we store the number of records (as counted by _get_dcb()) that have been
+   delivered to that identity."""
+   desc = 'backlog cursors'
+   
+   def get_state(self):
+      return dict((ident, dict(c)) for (ident, c) in self.data.items())
+   
+   def register(self, ident):
+      """Register identity; returns whether it was new."""
+      if (ident in self.data):
+         return False
+      self.data[ident] = {}
+      self.dirty = True
+      return True
+   
+   def forget(self, ident):
+      """Unregister identity."""
+      del(self.data[ident])
+      self.dirty = True
+   
+   def get(self, ident, ctx):
+      """Return cursor of identity for ctx, or None if the identity is not registered."""
+      try:
+         c = self.data[ident]
+      except KeyError:
+         return None
+      return c.get(ctx, 0)
+   
+   def advance(self, ident, ctx, dcb):
+      try:
+         c = self.data[ident]
+      except KeyError:
+         return
+      if (c.get(ctx, 0) < dcb):
+         c[ctx] = dcb
+         self.dirty = True
+   
+   def get_min(self, ctx):
+      """Return lowest cursor over all registered identities for ctx, or None if there are none."""
+      if not (self.data):
+         return None
+      return min(c.get(ctx, 0) for c in self.data.values())
+
+
+class BacklogPartners(_PickledState):
+   """Query partner contexts of a backlog, with the time of their most recent record."""
+   desc = 'backlog query partners'
+   
+   def touch(self, ctx, ts):
+      self.data[ctx] = ts
+      self.dirty = True
+   
+   def remove(self, ctx):
+      if (self.data.pop(ctx, None) is None):
+         return
+      self.dirty = True
+   
+   def get_ctxs(self):
+      """Return partner contexts, most recently active first."""
+      return sorted(self.data, key=self.data.get, reverse=True)
+
+
+class _DeliveryAcks:
+   """Record counts per context delivered to a client, pending confirmation by the PONG to one specific PING."""
+   def __init__(self):
+      self.pp = None
+      self.dcbs = {}
+
+
+class _BacklogStorage(_Logger):
+   """Base class for loggers storing backlog records in BacklogFiles."""
+   records_droppable = False
+   def __init__(self, basedir, nc, *args, quota=None, **kwargs):
+      # Data-count-before values (number of records ever written) for contexts, as seen from the event loop thread.
+      self._dcbs = {}
+      # Protocol capability set of the last network connection we've seen
+      self._pcs = None
+      self.quota = quota
+      # Backlog bytes by context, for enforcing total_bytes quota; only accessed by the thread doing file I/O. Sizes
+      # of contexts we haven't opened yet are estimated from their data file size.
+      self._sizes = {}
+      self._size_total = 0
+      super().__init__(basedir, nc, *args, **kwargs)
+      self.partners = BacklogPartners(self._get_meta_fn(b'partners'))
+      if not ((quota is None) or (quota.total_bytes is None)):
+         self._run(self._scan_sizes)
+   
+   def _get_pcs(self):
+      if not ((self.nc is None) or (not self.nc.conn)):
+         self._pcs = self.nc.get_pcs()
+      return self._pcs
+   
+   def make_file(self, fn):
+      return BacklogFile(fn, pcs=self._get_pcs())
    
    def reset_bl(self, ctx):
+      self._shedule_maintenance()
+      self.partners.remove(ctx)
+      self._run(self._clear_file, ctx)
+   
+   def get_nick_ctxs(self):
+      """Return query partner contexts holding backlog, most recently active first.
+      
+      Older versions kept all private messages in one context, None; if that is still around, it's listed last."""
+      rv = self.partners.get_ctxs()
+      if (os.path.exists(self._get_fn(None))):
+         rv.append(None)
+      return rv
+   
+   def _save_state(self, state):
+      """Write out _PickledState instance, if it has changed."""
+      if not (state.dirty):
+         return
+      self._run(state._write, state.fn, state.get_state())
+      state.dirty = False
+   
+   def _save_partners(self):
+      self._save_state(self.partners)
+   
+   def _do_maintenance(self):
+      self._save_partners()
+      super()._do_maintenance()
+   
+   def _process_process_shutdown(self):
+      self._save_partners()
+      super()._process_process_shutdown()
+   
+   def _clear_file(self, ctx):
       f = self._get_file(ctx)
       f.clear_records()
+      self._set_size(ctx, f)
    
-   def get_bl(self, ctx):
-      return self._get_file(ctx).get_records()
+   def _scan_sizes(self):
+      dn = os.path.join(self.basedir, self.nc.netname.encode())
+      try:
+         fns = os.listdir(dn)
+      except EnvironmentError:
+         return
+      
+      fns_set = set(fns)
+      for fn in fns:
+         if not ((fn + BacklogFile.IDX_SUFFIX) in fns_set):
+            # Not a backlog data file; e.g. an index, metadata, or a leftover temporary file.
+            continue
+         if (fn == b'nicks\x07'):
+            ctx = None
+         elif (b'\x07' in fn):
+            continue
+         else:
+            ctx = IRCCIString(fn)
+         
+         if (ctx in self._sizes):
+            continue
+         try:
+            size = os.path.getsize(os.path.join(dn, fn))
+         except EnvironmentError:
+            continue
+         self._sizes[ctx] = size
+         self._size_total += size
    
-   @classmethod
-   def _map_nick_ctxs(cls, ctx_s):
-      return [None]*bool(ctx_s)
+   def _set_size(self, ctx, f):
+      if ((self.quota is None) or (self.quota.total_bytes is None)):
+         return
+      size = f.get_size()
+      self._size_total += size - self._sizes.get(ctx, 0)
+      self._sizes[ctx] = size
+   
+   def _write_record(self, ctx, r):
+      f = self._get_file(ctx)
+      f.put_record(r)
+      if not (self.quota is None):
+         self._apply_quota(ctx, f)
+   
+   def _evict(self, f, count):
+      f._discard_data(f._discarded_record_count + count, evicted=True)
+   
+   def _apply_quota(self, ctx, f):
+      q = self.quota
+      count = f.get_quota_excess(q.ctx_records, q.ctx_bytes, q.ctx_age)
+      if (count > 0):
+         self._evict(f, count)
+      
+      if (q.total_bytes is None):
+         return
+      
+      self._set_size(ctx, f)
+      while (self._size_total > q.total_bytes):
+         (ctx_l, size) = max(self._sizes.items(), key=lambda i: i[1])
+         f_l = self._get_file(ctx_l)
+         if (f_l.get_size() != size):
+            # Estimated or stale size; fix it up and try again.
+            self._set_size(ctx_l, f_l)
+            continue
+         count = f_l.get_quota_excess(max_bytes=size - (self._size_total - q.total_bytes))
+         if (count <= 0):
+            break
+         self._evict(f_l, count)
+         self._set_size(ctx_l, f_l)
+   
+   def get_bl(self, ctx, start=None, after=None, before=None, last=None, first=None, filter=None):
+      """Return backlog records for ctx, limited as described for BacklogFile.get_records_range()."""
+      self._sync()
+      self._shedule_maintenance()
+      return self._get_file(ctx).get_records_range(start=start, after=after, before=before, last=last, first=first,
+         filter=filter)
+   
+   def has_bl(self, ctx):
+      """Return whether we have a backlog file for ctx, without making one."""
+      self._sync()
+      return ((ctx in self._storage) or os.path.exists(self._get_fn(ctx)))
+   
+   def _get_dcb(self, ctx):
+      """Return number of records ever written to ctx, including ones still queued for writing."""
+      try:
+         return self._dcbs[ctx]
+      except KeyError:
+         pass
+      
+      self._sync()
+      self._shedule_maintenance()
+      rv = self._dcbs[ctx] = self._get_file(ctx)._get_dcb()
+      return rv
+   
+   def _discard_data(self, ctx, dcb):
+      if (dcb >= self._get_dcb(ctx)):
+         self.partners.remove(ctx)
+      self._run(self._discard_file_data, ctx, dcb)
+   
+   def _discard_file_data(self, ctx, dcb):
+      f = self._get_file(ctx)
+      f._discard_data(dcb)
+      self._set_size(ctx, f)
    
    def _put_record_file(self, ctx, r):
-      super()._put_record_file(ctx, r)
+      rv = super()._put_record_file(ctx, r)
+      if not (rv):
+         return rv
+      if (ctx in self._dcbs):
+         self._dcbs[ctx] += 1
+      if (isinstance(r, NickLogLine)):
+         self.partners.touch(ctx, r.ts)
+      return rv
 
 
-class AutoDiscardingBackLogger(BackLogger):
-   """Backlogger which automatically deletes backlog entries after they have been passed to a client."""
-   ping_delay_max = 8
+class SharedBacklogStore(_BacklogStorage):
+   """Backlog records of one network, stored once for all backloggers using this as their store.
+   
+   The backloggers keep their own delivery cursors and filter; records are only discarded from the store once all
+   of them have discarded them."""
    def __init__(self, *args, **kwargs):
+      self.views = []
       super().__init__(*args, **kwargs)
+   
+   def add_view(self, bl):
+      self.views.append(bl)
+   
+   def release(self, ctx):
+      """Discard records of ctx that all backloggers using us have discarded."""
+      dcb = min(bl.floors.get(ctx) for bl in self.views)
+      if (dcb > 0):
+         self._discard_data(ctx, dcb)
+
 
+class BackLogger(_BacklogStorage):
+   """Backlogger for a bnc.
+   
+   If a SharedBacklogStore is passed as store, records are read from and written by that instead of our own files;
+   we then apply our filter when reading records, and track what we've discarded in our floors."""
+   ping_delay_max = 8
+   def __init__(self, basedir, bnc, *args, store=None, **kwargs):
+      self.bnc = bnc
+      self.store = store
+      # Pending delivery acknowledgements by client connection
+      self._acks = {}
+      super().__init__(basedir, bnc.nc, *args, **kwargs)
+      self.cursors = BacklogCursors(self._get_meta_fn(b'cursors'))
+      if not (store is None):
+         self.floors = BacklogFloors(self._get_meta_fn(b'floors'))
+         store.add_view(self)
+   
    def _ems_reg(self):
-      self.bnc.em_client_msg_fwd.new_prio_listener(self._process_msg)
+      if (self.store is None):
+         super()._ems_reg()
+      else:
+         # We still need to write out our metadata.
+         self.nc.sa.ed.em_shutdown.new_listener(self._process_process_shutdown)
+      self._ems_reg_bnc()
+   
+   def _ems_reg_bnc(self):
+      self.bnc.em_client_msg_fwd.new_prio_listener(self._process_msg_fwd)
       self.bnc.em_client_bl_dump.new_prio_listener(self._process_data_fwd)
+   
+   # Shared store access
+   def reset_bl(self, ctx):
+      if (self.store is None):
+         return super().reset_bl(ctx)
+      self._discard_data(ctx, self._get_dcb(ctx))
+   
+   def get_bl(self, ctx, start=None, **kwargs):
+      if (self.store is None):
+         return super().get_bl(ctx, start=start, **kwargs)
+      start = max(start or 0, self.floors.get(ctx))
+      return self.store.get_bl(ctx, start=start, filter=lambda r: self.filter(ctx, r), **kwargs)
+   
+   def _get_dcb(self, ctx):
+      if (self.store is None):
+         return super()._get_dcb(ctx)
+      return self.store._get_dcb(ctx)
+   
+   def get_nick_ctxs(self):
+      if (self.store is None):
+         return super().get_nick_ctxs()
+      return self.store.get_nick_ctxs()
+   
+   def has_bl(self, ctx):
+      if (self.store is None):
+         return super().has_bl(ctx)
+      return self.store.has_bl(ctx)
+   
+   def _discard_data(self, ctx, dcb):
+      if (self.store is None):
+         return super()._discard_data(ctx, dcb)
+      if (self.floors.advance(ctx, dcb)):
+         self._shedule_maintenance()
+         self.store.release(ctx)
+   
+   def _put_record_file(self, ctx, r):
+      if not (self.store is None):
+         # Records are written by the store.
+         return False
+      return super()._put_record_file(ctx, r)
+   
+   # Delivery cursors
+   # Cursors (and floors) are written out on maintenance and shutdown; losing the most recent changes in a crash only
+   # causes some backlog to be delivered again.
+   def _save_cursors(self):
+      self._save_state(self.cursors)
+      if not (self.store is None):
+         self._save_state(self.floors)
+   
+   def _do_maintenance(self):
+      self._save_cursors()
+      super()._do_maintenance()
+   
+   def _process_process_shutdown(self):
+      self._save_cursors()
+      super()._process_process_shutdown()
+   
+   def register_client(self, ipsc):
+      """Register identity of client connection for delivery tracking."""
+      if (self.cursors.register(ipsc.client_id)):
+         self._shedule_maintenance()
+   
+   def forget_client(self, ident):
+      """Stop tracking deliveries to identity."""
+      self.cursors.forget(ident)
+      self._shedule_maintenance()
+   
+   def get_clients(self):
+      return list(self.cursors.data.keys())
+   
+   def get_cursor(self, ipsc, ctx):
+      """Return number of records delivered to ipsc's identity for ctx, or None if it isn't registered."""
+      rv = self.cursors.get(ipsc.client_id, ctx)
+      if (rv is None):
+         return None
+      return min(rv, self._get_dcb(ctx))
+   
+   def _get_acks(self, ipsc):
+      """Return acknowledgement tracker for the next PING to be sent to ipsc."""
+      try:
+         acks = self._acks[ipsc]
+      except KeyError:
+         def process_shutdown():
+            del(self._acks[ipsc])
+         ipsc.em_shutdown.new_prio_listener(process_shutdown)
+         acks = None
       
-      self.nc.em_shutdown.new_prio_listener(self._process_conn_shutdown, -512)
-      self.nc.sa.ed.em_shutdown.new_listener(self._process_process_shutdown)
+      if ((acks is None) or (acks.pp is not ipsc.get_queued_ping())):
+         acks = self._acks[ipsc] = _DeliveryAcks()
+         acks.pp = ipsc.queue_ping(self.ping_delay_max, self._process_acks, (ipsc, acks))
+      return acks
+   
+   def _process_acks(self, ipsc, acks):
+      if (self._acks.get(ipsc) is acks):
+         self._acks[ipsc] = None
+      
+      ident = ipsc.client_id
+      for (ctx, dcb) in acks.dcbs.items():
+         self.cursors.advance(ident, ctx, dcb)
+      self._shedule_maintenance()
+      self._process_cursor_advance(acks.dcbs.keys())
+   
+   def _process_cursor_advance(self, ctx_s):
+      pass
    
    def _process_data_fwd(self, ipscs, ctx_s):
       # If we're called, that means the data has been put into the output buffer to one or more of the clients connected to
       # our bouncer. It does not mean that we've actually pushed it out to the network or that the TCP connection is still
       # alive, and as such the client may never actually see it.
-      # To reliably avoid data loss, we'll queue a ping to all eligible clients here, and only actually discard the data once
-      # we get a reply.
-      
-      if (ipscs):
-         cb_args_s = [(ctx, self._get_file(ctx)._get_dcb()) for ctx in ctx_s]
-         def discard_data(ctx, dcb):
-            self._get_file(ctx)._discard_data(dcb)
-         
-         for ipsc in ipscs:
-            for cb_args in cb_args_s:
-               # Queuing the request at the front means that we get called for our last request associated with this ping
-               # *first*. This allows us to be more efficient in discarding the data.
-               ipsc.queue_ping(self.ping_delay_max, discard_data, cb_args, front=True)
+      # To reliably avoid data loss, we'll queue a ping to all eligible clients here, and only consider the data delivered
+      # once we get a reply. We only need to remember the most recent delivery per context and ping.
+      # Clients fetching history on demand may still want the records they've seen live, so their cursors stay put;
+      # that also keeps auto-discarding backloggers from throwing away history they haven't fetched yet.
+      ipscs = [ipsc for ipsc in ipscs if not (self.bnc.fetches_history(ipsc))]
+      if not (ipscs):
+         return
       
-         del(ipsc)
-      del(ipscs)
-
-   def _process_msg(self, ipscs, msg, outgoing):
-      (is_aux, bl_contexts) = super()._process_msg(msg, outgoing)
+      dcbs = [(ctx, self._get_dcb(ctx)) for ctx in ctx_s]
+      for ipsc in ipscs:
+         # Contexts still waiting for their backlog replay don't count as delivered yet; otherwise live traffic would move
+         # the cursor past records the client hasn't seen.
+         pending = self.bnc.get_attach_pending(ipsc)
+         dcbs_out = [(ctx, dcb) for (ctx, dcb) in dcbs if not (ctx in pending)]
+         if (dcbs_out):
+            self._get_acks(ipsc).dcbs.update(dcbs_out)
+   
+   def _process_fwd_ctxs(self, ipscs, is_aux, bl_contexts):
       if (is_aux):
          # BNCs (currently) don't filter these messages based on client interest, so we need to check for wanted channels here
-         # to prevent spurious backlog message discarding.
+         # to prevent spurious delivery tracking.
          for ipsc in ipscs:
             blc_out = bl_contexts & ipsc.wanted_channels
             self._process_data_fwd((ipsc,), blc_out)
       else:
          self._process_data_fwd(ipscs, bl_contexts)
+   
+   def _process_msg_fwd(self, ipscs, msg, outgoing):
+      if not (ipscs):
+         return
+      (is_aux, bl_contexts, puts) = self._route_msg(msg, outgoing)
+      self._process_fwd_ctxs(ipscs, is_aux, bl_contexts)
+
+
+class AutoDiscardingBackLogger(BackLogger):
+   """Backlogger which automatically deletes backlog entries after they have been passed to all registered clients."""
+   def _ems_reg(self):
+      self._ems_reg_bnc()
+      self.nc.em_shutdown.new_prio_listener(self._process_conn_shutdown, -512)
+      self.nc.sa.ed.em_shutdown.new_listener(self._process_process_shutdown)
+   
+   def _process_cursor_advance(self, ctx_s):
+      for ctx in ctx_s:
+         dcb = self.cursors.get_min(ctx)
+         if not (dcb is None):
+            self._discard_data(ctx, min(dcb, self._get_dcb(ctx)))
+   
+   def _process_msg_fwd(self, ipscs, msg, outgoing):
+      (is_aux, bl_contexts) = self._process_msg(msg, outgoing)
+      self._process_fwd_ctxs(ipscs, is_aux, bl_contexts)
 
 
 def _main():
@@ -776,8 +2438,10 @@ def _main():
    bl._ems_reg = lambda: None
    bl._shedule_maintenance = lambda: None
    fn = b'__loggingselftests.bin.tmp'
-   bl._get_fn = lambda x: fn
-   _Logger.__init__(bl, '.', None)
+   bl._get_fn = lambda x: (fn + b'nicks') if (x is None) else x
+   bl._get_meta_fn = lambda name: fn + name
+   bl.store = None
+   _BacklogStorage.__init__(bl, '.', None)
    
    ctx = IRCCIString(fn)
    ridx = 0
@@ -801,9 +2465,283 @@ def _main():
       
       for dcb in dcb_l:
          bl._get_file(ctx)._discard_data(dcb)
+
+   print('==== Passed. ====')
+   print('==== Executing threaded writer test. ====')
+   bl.writer = LogWriter(queue_max=16)
+   for i in range(16):
+      dcb_l = []
+      for j in range(64):
+         for k in range(16):
+            pr()
+         dcb_l.append(bl._get_dcb(ctx))
+
+      for dcb in dcb_l:
+         bl._discard_data(ctx, dcb)
+
+      recs = bl.get_bl(ctx)
+      if (recs):
+         raise ValueError('Got {0} records after discarding all of them.'.format(len(recs)))
+
+   pr()
+   if (bl.get_bl(ctx) != [(ridx-1,)]):
+      raise ValueError('Record readback failed.')
+   
+   def fail():
+      raise EnvironmentError('Simulated write failure.')
+   bl._run(fail)
+   try:
+      bl._sync()
+   except EnvironmentError:
+      pass
+   else:
+      raise ValueError('Failure of queued file operation got lost.')
+   print('==== Passed. ====')
+   print('==== Executing index lookup test. ====')
+   bl.reset_bl(ctx)
+   base = bl._get_dcb(ctx)
+   for i in range(256):
+      bl._put_record_file(ctx, LogEntry(ts=i//2))
+   
+   def check(expected, **kwargs):
+      tss = [r.ts for r in bl.get_bl(ctx, **kwargs)]
+      if (tss != expected):
+         raise ValueError('Index lookup with {0} returned {1} instead of {2}.'.format(kwargs, tss, expected))
+   
+   check([i//2 for i in range(256)])
+   check([127, 127], last=2)
+   check([10, 11, 11], after=10, before=12, last=3)
+   check([i//2 for i in range(200, 256)], start=base+200)
+   check([99], start=base+199, before=100)
+   check([10, 10, 11], after=10, first=3)
+   check([], after=128)
+   
+   bl._sync()
+   f = bl._get_file(ctx)
+   bl._close_file(ctx)
+   f = bl._get_file(ctx)
+   if (f._get_dcb() != base + 256):
+      raise ValueError('Record count mismatch after reopening file.')
+   check([0, 1, 1], last=3, before=2)
+   bl._close_file(ctx)
+   os.unlink(fn + BacklogFile.IDX_SUFFIX)
+   check([127], last=1)
+   print('==== Passed. ====')
+   print('==== Executing quota test. ====')
+   bl.reset_bl(ctx)
+   bl.quota = BacklogQuota(ctx_records=100)
+   for i in range(1000):
+      pr()
+   recs = bl.get_bl(ctx)
+   if (not isinstance(recs[0], LogBacklogEvicted) or (recs[0].count != 900) or
+         (recs[1:] != [(i,) for i in range(ridx-100, ridx)])):
+      raise ValueError('Quota eviction returned unexpected records.')
+   if (len(bl.get_bl(ctx, start=bl._get_dcb(ctx)-50)) != 50):
+      raise ValueError('Got eviction marker for client that had seen the evicted records.')
+   bl._discard_data(ctx, bl._get_dcb(ctx)-10)
+   if (bl.get_bl(ctx) != [(i,) for i in range(ridx-10, ridx)]):
+      raise ValueError('Eviction marker survived regular discard.')
+   
+   ctx2 = IRCCIString(fn + b'2')
+   bl.quota = BacklogQuota(total_bytes=65536)
+   for i in range(4096):
+      bl._put_record_file(ctx2, (b'x'*64,))
+   for i in range(1024):
+      pr()
+   bl._sync()
+   sizes = [bl._get_file(c).get_size() for c in (ctx, ctx2)]
+   if ((sum(sizes) > 65536) or (bl._size_total != sum(sizes))):
+      raise ValueError('Total quota not enforced: sizes {0}, tracked total {1}.'.format(sizes, bl._size_total))
+   bl.quota = None
+   print('==== Passed. ====')
+   print('==== Executing query partner test. ====')
+   msg = IRCMessage.build_from_line(b':a!b@c PRIVMSG d :e', None)
+   for (nick, ts) in ((b'a', 1), (b'b', 2), (b'a', 3)):
+      bl._put_record_file(IRCCIString(fn + nick), NickLogLine(msg, msg.prefix, False, ts=ts))
+   if (bl.get_nick_ctxs() != [fn + b'a', fn + b'b']):
+      raise ValueError('Unexpected query partner order {0}.'.format(bl.get_nick_ctxs()))
+   bl.reset_bl(IRCCIString(fn + b'a'))
+   if (bl.get_nick_ctxs() != [fn + b'b']):
+      raise ValueError('Query partner survived backlog reset.')
+   print('==== Passed. ====')
+   print('==== Executing shared store test. ====')
+   bl._sync()
+   bl._close_files()
+   store = SharedBacklogStore.__new__(SharedBacklogStore)
+   store._ems_reg = lambda: None
+   store._shedule_maintenance = lambda: None
+   store._get_fn = lambda x: x
+   store._get_meta_fn = lambda name: fn + name
+   SharedBacklogStore.__init__(store, '.', None)
+   store.reset_bl(ctx)
+   def pr():
+      nonlocal ridx
+      store._put_record_file(ctx, (ridx,))
+      ridx += 1
+   views = []
+   for i in range(2):
+      v = BackLogger.__new__(BackLogger)
+      v.store = store
+      v.writer = None
+      v._shedule_maintenance = lambda: None
+      v.floors = BacklogFloors(fn + 'floors{0}'.format(i).encode())
+      store.add_view(v)
+      views.append(v)
+   views[0].filter = lambda ctx, r: (r[0] % 2 == 0)
+   views[1].filter = LogFilter()
    
+   base = ridx
+   for i in range(100):
+      pr()
+   if ((views[0].get_bl(ctx) != [(i,) for i in range(base + base % 2, ridx, 2)]) or
+         (views[1].get_bl(ctx) != [(i,) for i in range(base, ridx)])):
+      raise ValueError('Shared store views returned unexpected records.')
+   evens = [(i,) for i in range(base + base % 2, ridx, 2)]
+   if ((views[0].get_bl(ctx, last=10) != evens[-10:]) or (views[0].get_bl(ctx, first=5) != evens[:5]) or
+         (views[0].get_bl(ctx, last=10, first=3) != evens[-10:-7])):
+      raise ValueError('Shared store view applied record limit before its filter.')
+   
+   dcb = views[0]._get_dcb(ctx)
+   views[0].reset_bl(ctx)
+   if (views[0].get_bl(ctx) or (len(views[1].get_bl(ctx)) != 100)):
+      raise ValueError('Shared store view reset affected other view.')
+   views[1]._discard_data(ctx, dcb - 10)
+   if (store._get_file(ctx)._discarded_record_count != dcb - 10):
+      raise ValueError('Shared store failed to discard records released by all views.')
+   print('==== Passed. ====')
+   print('==== Executing crash recovery test. ====')
+   import bisect
+   import random
+   fn = b'__loggingselftests.crash.tmp'
+   fn_idx = fn + BacklogFile.IDX_SUFFIX
+   def read(fn):
+      with open(fn, 'rb') as f:
+         return f.read()
+   def write(fn, data):
+      with open(fn, 'wb') as f:
+         f.write(data)
+   def check(expected):
+      f = BacklogFile(fn)
+      tss = [r.ts for r in f.get_records()]
+      if (tss != expected):
+         raise ValueError('Recovered backlog file holds records {0} instead of {1}.'.format(tss, expected))
+      return f
+   
+   f = BacklogFile(fn)
+   for i in range(64):
+      f.put_record(LogEntry(ts=i))
+   ends = [f._get_idx_entry(i)[1] for i in range(1, 64)] + [f._data_end]
+   data_start = f._data_start
+   f.close()
+   data = read(fn)
+   idx = read(fn_idx)
+   
+   # Simulate being killed at random points while appending records, possibly with garbage left in the page cache.
+   rng = random.Random(0)
+   for i in range(256):
+      cut = rng.randrange(data_start, len(data) + 1)
+      count = bisect.bisect_right(ends, cut)
+      tail = bytes(rng.randrange(256) for j in range(rng.choice((0, 0, 8, 64))))
+      write(fn, data[:cut] + tail)
+      write(fn_idx, idx[:rng.randrange(BacklogFile.IDX_HEADER.size, len(idx) + 1)])
+      f = check(list(range(count)))
+      f.put_record(LogEntry(ts=count))
+      f.close()
+      check(list(range(count + 1))).close()
+   
+   # Killed between the renames of a rewrite: new data file, old index file.
+   write(fn, data)
+   write(fn_idx, idx)
+   f = BacklogFile(fn)
+   f._discard_data(f._get_dcb())
+   f.close()
+   write(fn_idx, idx)
+   f = check([])
+   if (f._get_dcb() != 64):
+      raise ValueError('Lost discarded record count on index rebuild.')
+   f.close()
+   
+   # Files written by older versions are converted on open.
+   write(fn, pickle.dumps(5) + b''.join(pickle.dumps(LogEntry(ts=i)) for i in range(8)) + b'\x80\x03')
+   os.unlink(fn_idx)
+   f = check(list(range(8)))
+   if ((f._get_dcb() != 13) or f._legacy or not read(fn).startswith(BacklogFile.DATA_MAGIC)):
+      raise ValueError('Conversion of old backlog file failed.')
+   f.close()
+   os.unlink(fn)
+   os.unlink(fn_idx)
+   print('==== Passed. ====')
+   print('==== Executing log rotation test. ====')
+   import shutil
+   import types
+   dn = b'__loggingselftests.rot.tmp'
+   nc = types.SimpleNamespace(netname='net', loggers=[])
+   rl = RawLogger.__new__(RawLogger)
+   rl._ems_reg = lambda: None
+   rl._shedule_maintenance = lambda: None
+   RawLogger.__init__(rl, dn, nc, rotation=LogRotation(daily=True, max_bytes=4096, utc=True))
+   ctx = IRCCIString(b'#chan')
+   day = 86400
+   for ts in (day*10 + 5, day*10 + 6, day*11, day*11 + 1, day*13):
+      rl._write_record(ctx, LogBacklogEvicted(1, ts))
+   for i in range(200):
+      rl._write_record(ctx, LogBacklogEvicted(i, day*13 + i))
+   rl._close_files()
+   log_archiver.sync()
+   
+   m = LogManifest(rl._get_meta_fn(b'manifest'))
+   cfn = os.path.basename(rl._get_fn(ctx))
+   if ((len(m.entries) < 3) or m.get_uncompressed() or ([e[:2] for e in m.entries[:2]] != [[0, day*10 + 6],
+         [day*10 + 6, day*11 + 1]])):
+      raise ValueError('Unexpected manifest contents after rotation: {0}'.format(m.entries))
+   if (len(m.find(cfn, after=day*11 + 2)) != len(m.entries) - 2):
+      raise ValueError('Manifest lookup returned unexpected archives.')
+   import gzip
+   with gzip.open(m.find(cfn, before=day*10 + 7)[0]) as f:
+      if (len(f.readlines()) != 2):
+         raise ValueError('Compressed archive holds unexpected data.')
+   shutil.rmtree(dn)
+   print('==== Passed. ====')
+   print('==== Executing timestamp format cache test. ====')
+   for fmt in ('%Y-%m-%d %H:%M:%S', '%T', '%-M:%_S', '%0M %-d', '%_3S', '%-H:%M', '%c', '%%M {%S}'):
+      for utc in (False, True):
+         tsc = _TSFormatCache(fmt, utc)
+         get_tt = (time.gmtime if utc else time.localtime)
+         for sec in range(1500000000, 1500000000 + 7300, 7):
+            if (tsc.format(sec) != time.strftime(fmt, get_tt(sec))):
+               raise ValueError('Cached rendering of {0!a} for {1} differs from strftime().'.format(fmt, sec))
    print('==== Passed. ====')
    print('===== All done. =====')
 
+def _bench_replay_formatting(count=50000):
+   """Microbenchmark: backlog replay formatting throughput, with and without timestamp caching.
+   
+   Full entries are mostly spent building messages, so timestamp caching only gains a few percent on them."""
+   pcs = S2CProtocolCapabilitySet()
+   msg = IRCMessage.build_from_line(b':nick!user@host PRIVMSG #chan :Some line of backlog text.', None, pcs)
+   # Two entries per second, as in a busy channel.
+   entries = [ChanLogLine(msg, msg.prefix, False, ts=1500000000 + i/2) for i in range(count)]
+   
+   class StrftimeBLFormatter(BLFormatter):
+      def format_ts(self, e):
+         return self.time_cfmt.format(e.get_time_str(self.time_fmt, utc=self.utc)).encode('ascii')
+   
+   print('===== Replay formatting benchmark ({0} entries). ====='.format(count))
+   for (desc, cls) in (('strftime per entry', StrftimeBLFormatter), ('cached timestamps', BLFormatter)):
+      blf = cls(time_fmt='%d %H:%M:%S', time_color=15, utc=False)
+      t0 = time.perf_counter()
+      for e in entries:
+         blf.format_ts(e)
+      t1 = time.perf_counter()
+      for e in entries:
+         blf.format_entry(b'luteus', b'#chan', e)
+      t2 = time.perf_counter()
+      print('{0}: timestamps {1:.0f}/s; full entries {2:.0f}/s.'.format(desc, count/(t1-t0), count/(t2-t1)))
+
+
 if (__name__ == '__main__'):
-   _main()
+   import sys
+   if ('--bench' in sys.argv[1:]):
+      _bench_replay_formatting()
+   else:
+      _main()
@@ -56,6 +56,7 @@ class IRCAddress(bytes):
       (nick, rest) = self.split(b'!',1)
       self.nick = pcs.make_cib(nick)
       (user, hostmask) = rest.split(b'@',1)
+      self.user = user
       self.hostmask = hostmask
    
    def is_server(self):
@@ -160,6 +161,8 @@ class S2CProtocolCapabilitySet(dict):
    """S2C protocol capability set, as communicated by ISUPPORT msgs"""
    logger = logging.getLogger('S2CProtocolCapabilitySet')
    log = logger.log
+   # Incremented on every change to our values, for users caching data derived from them
+   version = 0
    
    def __init__(self, *args, **kwargs):
       dict.__init__(self, *args, **kwargs)
@@ -208,6 +211,7 @@ class S2CProtocolCapabilitySet(dict):
          
          name = bytes(name)
          if ((not (name in self)) or (self[name] != val)):
+            self.version += 1
             self.em_argchange(name, val)
          
          self[name] = val
@@ -366,36 +370,151 @@ class _MultiLineCmdJOIN(_MultiLineCmdBase):
       self.ac = 0
 
 
+# IRCv3 message tag value escapes
+_TAG_ESCAPES = {b';': b'\\:', b' ': b'\\s', b'\\': b'\\\\', b'\r': b'\\r', b'\n': b'\\n'}
+_TAG_UNESCAPES = {b':': b';', b's': b' ', b'\\': b'\\', b'r': b'\r', b'n': b'\n'}
+
+def escape_tag_value(val):
+   return b''.join(_TAG_ESCAPES.get(c, c) for c in (val[i:i+1] for i in range(len(val))))
+
+def unescape_tag_value(val):
+   rv = []
+   i = 0
+   while (i < len(val)):
+      c = val[i:i+1]
+      i += 1
+      if (c == b'\\'):
+         c = val[i:i+1]
+         i += 1
+         c = _TAG_UNESCAPES.get(c, c)
+      rv.append(c)
+   return b''.join(rv)
+
+
 class IRCMessage:
-   """An IRC message, as defined by RFC 2812"""
+   """An IRC message, as defined by RFC 2812, optionally carrying IRCv3 message tags."""
    logger = logging.getLogger()
    log = logger.log
+   # LogRoutes computed for this message, by (outgoing, raw); not copied or pickled.
+   log_routes = None
    
    chan_cmds = set((b'PRIVMSG', b'NOTICE', b'KICK', b'PART', b'JOIN', b'MODE', b'TOPIC'))
    nick_cmds = set((b'PRIVMSG', b'NOTICE'))
    # RFC 1459 and 2812, section 2.3
    LEN_LIMIT = 512
    ARGC_LIMIT = 15
+   # IRCv3 message tags. These are kept in their wire format (without the leading '@') in tags_raw until something asks for
+   # the decoded form, so messages nobody looks at the tags of can be passed on without any tag processing.
+   tags_raw = None
+   _tags = None
    
-   def __init__(self, prefix:IRCAddress, command:bytes, parameters, src=None, pcs=S2CProtocolCapabilitySet()):
+   def __init__(self, prefix:IRCAddress, command:bytes, parameters, src=None, pcs=S2CProtocolCapabilitySet(), tags=None,
+         tags_raw=None):
       self.prefix = prefix
       self.command = command.upper()
       self.parameters = list(parameters)
       self.src = src
       self.pcs = pcs
+      self._tags = tags
+      self.tags_raw = tags_raw
+   
+   def _get_tags(self):
+      if not (self.tags_raw is None):
+         self._tags = self.parse_tags(self.tags_raw)
+         # Our caller may modify the dict, so from here on it's authoritative.
+         self.tags_raw = None
+      return self._tags
+   
+   def _set_tags(self, tags):
+      self._tags = tags
+      self.tags_raw = None
+   
+   tags = property(_get_tags, _set_tags, doc='Dict mapping tag names to values (None for tags without a value), or None.')
+   
+   @staticmethod
+   def parse_tags(tags_raw):
+      rv = {}
+      for tag in tags_raw.split(b';'):
+         if (b'=' in tag):
+            (name, val) = tag.split(b'=', 1)
+            rv[name] = unescape_tag_value(val)
+         elif (tag):
+            rv[tag] = None
+      return rv
+   
+   def get_tag(self, name, default=None):
+      """Return value of tag <name>, without decoding any other tags."""
+      if (self.tags_raw is None):
+         if (self._tags is None):
+            return default
+         return self._tags.get(name, default)
+      
+      rv = default
+      # Later instances of a tag override earlier ones.
+      for tag in self.tags_raw.split(b';'):
+         (tn, sep, val) = tag.partition(b'=')
+         if (tn != name):
+            continue
+         if (sep):
+            rv = unescape_tag_value(val)
+         else:
+            rv = None
+      return rv
+   
+   def set_tag(self, name, val=None):
+      tags = self.tags
+      if (tags is None):
+         tags = self.tags = {}
+      tags[name] = val
+   
+   def has_tags(self):
+      return bool(self.tags_raw or self._tags)
+   
+   def build_tags_raw(self, names=None):
+      """Return wire format of tags, restricted to those in <names> if that's not None; None if there are no tags."""
+      raw = self.tags_raw
+      if (raw is None):
+         tags = self._tags
+         if not (tags):
+            return None
+         rv = b';'.join(name if (val is None) else b'='.join((name, escape_tag_value(val)))
+            for (name, val) in tags.items() if ((names is None) or (name in names)))
+      elif (names is None):
+         rv = raw
+      else:
+         rv = b';'.join(tag for tag in raw.split(b';') if (tag.partition(b'=')[0] in names))
+      return (rv or None)
    
    def copy(self):
-      return self.__class__(self.prefix, self.command, self.parameters, self.src, self.pcs)
+      tags = self._tags
+      if not (tags is None):
+         tags = dict(tags)
+      return self.__class__(self.prefix, self.command, self.parameters, self.src, self.pcs, tags, self.tags_raw)
    
    def __getstate__(self):
       rv = self.__dict__.copy()
       rv['src'] = None
+      rv.pop('log_routes', None)
       return rv
    
+   def __setstate__(self, state):
+      self.__dict__.update(state)
+      # Pickles from before tags were decoded lazily.
+      if ('tags' in state):
+         self._tags = self.__dict__.pop('tags')
+   
    @classmethod
    def build_from_line(cls, line, src, pcs=S2CProtocolCapabilitySet()):
       """Build instance from raw line"""
-      line_split = bytes(line).split(b' ') # RFC 2812 says this is correct.
+      line = bytes(line)
+      tags_raw = None
+      if (line.startswith(b'@')):
+         (tags_raw, sep, line) = line[1:].partition(b' ')
+         line = line.lstrip(b' ')
+         if (line == b''):
+            raise IRCProtocolError('Tags without message.')
+      
+      line_split = line.split(b' ') # RFC 2812 says this is correct.
       if (line.startswith(b':')):
          prefix = pcs.make_irc_addr(line_split[0][1:])
          command = line_split[1]
@@ -419,7 +538,7 @@ class IRCMessage:
          parameters[i] = b' '.join([parameters[i][1:]] + parameters[i+1:])
          del(parameters[i+1:])
          break
-      return cls(prefix, command, parameters, src=src, pcs=pcs)
+      return cls(prefix, command, parameters, src=src, pcs=pcs, tags_raw=tags_raw)
    
    @classmethod
    def build_ml_args(cls, cmd, static_args_b, static_args_e, arg_list,
@@ -467,12 +586,21 @@ class IRCMessage:
       
       return rv
    
-   def line_build(self, sanity_check=True):
+   def line_build(self, sanity_check=True, with_tags=False):
+      """Return raw line for this message.
+      
+      Message tags are only included if with_tags is set; that may be True for all of them, or a collection of the names
+      of those to include."""
       if (self.prefix is None):
          prefix = []
       else:
          prefix = [b':' + self.prefix]
       
+      if (with_tags):
+         tags_raw = self.build_tags_raw(None if (with_tags is True) else with_tags)
+         if not (tags_raw is None):
+            prefix.insert(0, b'@' + tags_raw)
+      
       params_out = list(self.parameters)
       if (params_out and ((b' ' in params_out[-1]) or
          (params_out[-1].startswith(b':')))):
@@ -700,15 +828,27 @@ class IRCChannel:
       self.expect_part = expect_part
       self.cmp = cmp_
       self.syncing_names = False
+      # Whether we've got the full set of channel modes, and which list modes we've got the full lists for.
+      self.modes_synced = False
+      self.lists_synced = set()
+      self.ts_created = None
+   
+   # List modes we know the reply numerics for: (entry, end, end text)
+   LIST_NUMS = {
+      b'b': (b'367', b'368', b'End of channel ban list')
+   }
    
-   def get_uflag_strings(self):
+   def names_known(self):
+      return ((self.users is not None) and not self.syncing_names)
+   
+   def get_uflag_strings(self, multi_prefix=True):
       rv = []
       for (nick, modes) in self.users.items():
-         rv.append(self.cmp.get_uflagstring(modes) + nick)
+         rv.append(self.cmp.get_uflagstring(modes, multi_prefix) + nick)
       return rv
    
-   def make_names_reply(self, target, prefix=None):
-      userstrings = self.get_uflag_strings()
+   def make_names_reply(self, target, prefix=None, multi_prefix=True):
+      userstrings = self.get_uflag_strings(multi_prefix)
       
       msgs = list(IRCMessage.build_ml_onearg(b'353', (target, b'=', self.name),
          (), userstrings, b' ', prefix=prefix))
@@ -716,18 +856,62 @@ class IRCChannel:
       msgs.append(IRCMessage(prefix, b'366', (target, self.name, b'End of NAMES list')))
       return msgs
    
-   def make_join_msgs(self, target, prefix=None):
+   def make_topic_reply(self, target, prefix=None):
       if (self.topic is None):
-         rv = []
-      elif (self.topic is False):
-         rv = [IRCMessage(prefix, b'331', (target, self.name, b'No topic set'))]
-      else:
-         rv = [IRCMessage(prefix, b'332', (target, self.name, self.topic))]
+         return []
+      if (self.topic is False):
+         return [IRCMessage(prefix, b'331', (target, self.name, b'No topic set'))]
+      return [IRCMessage(prefix, b'332', (target, self.name, self.topic))]
+   
+   def make_modes_reply(self, target, prefix=None):
+      modes = [b'+']
+      args = []
+      for (m, val) in sorted(self.modes.items()):
+         if ((val is None) or (val is False) or isinstance(val, set)):
+            continue
+         modes.append(m)
+         if not (val is True):
+            args.append(val)
       
-      rv += self.make_names_reply(target, prefix)
+      rv = [IRCMessage(prefix, b'324', (target, self.name, b''.join(modes)) + tuple(args))]
+      if not (self.ts_created is None):
+         rv.append(IRCMessage(prefix, b'329', (target, self.name, self.ts_created)))
+      return rv
+   
+   def make_list_reply(self, target, mode, prefix=None):
+      (num, num_end, text_end) = self.LIST_NUMS[mode]
+      rv = [IRCMessage(prefix, num, (target, self.name, mask)) for mask in sorted(self.modes[mode])]
+      rv.append(IRCMessage(prefix, num_end, (target, self.name, text_end)))
+      return rv
+   
+   def make_join_msgs(self, target, prefix=None, multi_prefix=True):
+      rv = self.make_topic_reply(target, prefix)
+      rv += self.make_names_reply(target, prefix, multi_prefix)
       return rv
 
    def __repr__(self):
       return '{0}({1}, {2}, {3}, {4}, {5})'.format(self.__class__.__name__,
          self.name, self.topic, self.users, self.modes, self.expect_part)
 
+
+class IRCUser:
+   """Network-wide state of a user sharing a channel with us, as pushed by the server.
+   
+   For account and away, None means unknown, and False means known not to be logged in or away."""
+   def __init__(self, nick, user=None, host=None, account=None, realname=None, away=None):
+      self.nick = nick
+      self.user = user
+      self.host = host
+      self.account = account
+      self.realname = realname
+      self.away = away
+   
+   def update_from_ia(self, ia):
+      if (ia.is_nick() and not (ia.hostmask is None)):
+         self.user = ia.user
+         self.host = ia.hostmask
+   
+   def __repr__(self):
+      return '{0}({1}, {2}, {3}, {4}, {5}, {6})'.format(self.__class__.__name__,
+         self.nick, self.user, self.host, self.account, self.realname, self.away)
+